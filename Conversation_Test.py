@@ -1,8 +1,9 @@
-from sentence_transformers import SentenceTransformer, util
 import re
+import numpy as np
+from utils.embedding import get_embedding_service
 
 # 加载模型
-model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+model = get_embedding_service('paraphrase-multilingual-MiniLM-L12-v2')
 
 # 读取文本
 with open("conversation.txt", "r", encoding="utf-8") as f:
@@ -36,11 +37,15 @@ for i in range(len(merged) - 1):
     if merged[i]["speaker"] != merged[i + 1]["speaker"]:
         pairs.append((merged[i], merged[i + 1]))
 
+# 每条合并后的发言只编码一次（相邻两个发言对共用中间那条），再逐对算余弦相似度
+embeddings = model.encode([m["content"] for m in merged])
+embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+pair_index = [i for i in range(len(merged) - 1) if merged[i]["speaker"] != merged[i + 1]["speaker"]]
+scores = np.sum(embeddings[pair_index] * embeddings[[i + 1 for i in pair_index]], axis=1)
+
 # 输出语义相似度
 for idx, (a, b) in enumerate(pairs, 1):
-    emb1 = model.encode(a["content"], convert_to_tensor=True)
-    emb2 = model.encode(b["content"], convert_to_tensor=True)
-    score = util.cos_sim(emb1, emb2).item()
+    score = scores[idx - 1]
     print(f"\n--- 对话对 {idx} ---")
     print(f"{a['speaker']} ({a['time']}): {a['content']}")
     print(f"{b['speaker']} ({b['time']}): {b['content']}")
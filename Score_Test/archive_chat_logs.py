@@ -1,40 +1,47 @@
-import pandas as pd
+import argparse
+import os
+import sys
 
-# 指定输入输出文件名
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.log_store import archive_incremental, compact_store, import_csv, read_logs
+
+# 指定输入输出位置
 input_file = "chat_logs.csv"
+store_dir = "chat_logs_store"
 output_file = "chat_logs_archive_full.csv"
 
-# 读取 CSV，指定列名和容错设置
-df = pd.read_csv(
-    input_file,
-    header=None,
-    names=["timestamp", "user_id", "user_input", "model_reply", "chat_type", "score"],
-    quoting=1,
-    encoding="utf-8",
-    on_bad_lines="skip"
-)
-
-# 将 timestamp 转换为 datetime
-df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s", errors="coerce")
-
-# 丢弃无法解析时间的行
-df = df.dropna(subset=["timestamp"])
-
-# 按说话人和时间排序
-df = df.sort_values(by=["user_id", "timestamp"])
-
-# 精简列并重命名
-df = df[["timestamp", "user_id", "user_input", "model_reply"]].rename(columns={
-    "timestamp": "时间",
-    "user_id": "说话人",
-    "user_input": "内容",
-    "model_reply": "AI回应"
-})
-
-# 重置索引
-df.reset_index(drop=True, inplace=True)
-
-# 输出归档结果
-df.to_csv(output_file, index=False, encoding="utf-8-sig")
-
-print(f"✅ 成功归档！共 {len(df)} 条记录，输出文件为：{output_file}")
+parser = argparse.ArgumentParser(description="增量归档对话日志到按 日期/用户 分区的 Parquet 存储")
+parser.add_argument("--source", default=input_file, help="原始日志（含轮转出的 .1、.2 …）")
+parser.add_argument("--store", default=store_dir)
+parser.add_argument("--import-csv", nargs="*", default=[], help="一次性导入已有的归档 CSV")
+parser.add_argument("--export", nargs="?", const=output_file, default=None,
+                    help="另外导出一份旧格式的归档 CSV（时间/说话人/内容/AI回应）")
+parser.add_argument("--compact", type=int, nargs="?", const=1, default=None,
+                    help="把文件数超过这个值的分区都合并成一个文件（不带值时合并所有多于 1 个文件的分区）")
+args = parser.parse_args()
+
+# 已有的归档 CSV 只需导入一次
+for path in args.import_csv:
+    import_csv(path, args.store)
+
+# 只处理水位线之后新增的行，追加成新的分区文件
+if os.path.exists(args.source):
+    added = archive_incremental(args.source, args.store)
+    print(f"✅ 成功归档！本次新增 {added} 条记录，存储目录：{args.store}")
+else:
+    print(f"⚠️ 未找到 {args.source}，跳过增量归档")
+
+if args.compact is not None:
+    merged = compact_store(args.store, args.compact)
+    print(f"🗜️ 已合并 {merged} 个分区小文件")
+
+if args.export:
+    df = read_logs(args.store, columns=["timestamp", "user_id", "user_input", "model_reply"])
+    df = df.rename(columns={
+        "timestamp": "时间",
+        "user_id": "说话人",
+        "user_input": "内容",
+        "model_reply": "AI回应"
+    })
+    df.to_csv(args.export, index=False, encoding="utf-8-sig")
+    print(f"✅ 已导出旧格式归档：共 {len(df)} 条记录，输出文件为：{args.export}")
@@ -0,0 +1,267 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+
+import anthropic
+import pandas as pd
+
+MODEL = os.getenv("CLAUDE_SCORE_MODEL", "claude-sonnet-4-20250514")
+
+PROMPT_TEMPLATE = """
+请对以下AI回应进行评分（1-10分）：
+
+用户输入: {context}
+AI回应: {ai_response}
+
+评分要求：
+1. Empathy（共情）: 是否体现理解和支持？
+2. Appropriateness（恰当性）: 语调是否合适？
+3. Relevance（相关性）: 是否切题有意义？
+
+格式：
+Empathy: [分数]
+Appropriateness: [分数]
+Relevance: [分数]
+Explanation: [简短理由]
+"""
+
+# 限流、超时、冲突、过载（529）以及所有 5xx 值得重试
+RETRY_STATUS = {408, 409, 429}
+
+RESULT_COLUMNS = [
+    "Round", "Context", "AI_Response",
+    "Empathy_Current", "Appropriateness_Current", "Relevance_Current",
+    "Empathy_Cumulative", "Appropriateness_Cumulative", "Relevance_Cumulative",
+    "Explanation",
+]
+
+
+def parse_scores(response_text):
+    match_empathy = re.search(r'Empathy:\s*(\d+)', response_text)
+    match_appropriateness = re.search(r'Appropriateness:\s*(\d+)', response_text)
+    match_relevance = re.search(r'Relevance:\s*(\d+)', response_text)
+    match_explanation = re.search(r'Explanation:\s*(.+)', response_text)
+
+    if not (match_empathy and match_appropriateness and match_relevance and match_explanation):
+        raise ValueError(f"Claude回复格式不对，原始输出：\n{response_text}")
+
+    return {
+        "empathy": float(match_empathy.group(1)),
+        "appropriateness": float(match_appropriateness.group(1)),
+        "relevance": float(match_relevance.group(1)),
+        "explanation": match_explanation.group(1).strip(),
+    }
+
+
+# ========== 结果缓存（兼作断点） ==========
+def score_key(context, ai_response, model=MODEL, template=PROMPT_TEMPLATE):
+    # 提示词模板、模型、输入、回复任何一个变了都要重新打分
+    raw = json.dumps([template, model, context, ai_response], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ScoreCache:
+    """
+    追加写的 JSONL，每打完一条立即写一行并刷盘；中途崩溃后重跑，已经打过分的行直接从这里取，
+    只对没打过的（包括上次失败的）发请求。失败的结果不写入。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._scores = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue    # 崩溃时写了一半的最后一行
+                    self._scores[record["key"]] = record["scores"]
+        self._f = None
+
+    def __len__(self):
+        return len(self._scores)
+
+    def get(self, key):
+        return self._scores.get(key)
+
+    def put(self, key, scores):
+        self._scores[key] = scores
+        if self._f is None:
+            self._f = open(self.path, "a", encoding="utf-8")
+        self._f.write(json.dumps({"key": key, "scores": scores}, ensure_ascii=False) + "\n")
+        self._f.flush()
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+# ========== 并发打分 ==========
+class ClaudeScorer:
+    """
+    同时最多 max_concurrency 个请求，可选按 rpm 匀速放行；429 / 529 / 5xx / 连接错误按带抖动的指数退避重试，
+    有 Retry-After 时以它为准。base_url 指向本地桩服务（stub_claude_server.py）即可离线测试。
+    """
+
+    def __init__(self, api_key=None, base_url=None, model=MODEL, max_concurrency=8, max_retries=5,
+                 backoff_base=1.0, backoff_max=30.0, rpm=0, timeout=60):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rpm = rpm
+        self._client_args = {"api_key": api_key, "base_url": base_url, "timeout": timeout,
+                             "max_retries": 0}    # 重试由这里统一做
+        self._next_slot = 0.0
+        self.counters = {"requests": 0, "retries": 0, "failures": 0, "cached": 0}
+
+    async def _throttle(self):
+        if not self.rpm:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 60.0 / self.rpm
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _retry_delay(self, error, attempt):
+        """返回下次重试前要等的秒数；不该重试时返回 None。"""
+        if attempt >= self.max_retries:
+            return None
+        retry_after = None
+        if isinstance(error, anthropic.APIStatusError):
+            if error.status_code not in RETRY_STATUS and error.status_code < 500:
+                return None
+            try:
+                retry_after = float(error.response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        elif not isinstance(error, anthropic.APIConnectionError):
+            return None
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def _score_one(self, client, semaphore, context, ai_response):
+        prompt = PROMPT_TEMPLATE.format(context=context, ai_response=ai_response)
+        attempt = 0
+        while True:
+            await self._throttle()
+            async with semaphore:
+                self.counters["requests"] += 1
+                try:
+                    message = await client.messages.create(
+                        model=self.model,
+                        max_tokens=300,
+                        messages=[{"role": "user", "content": prompt}]
+                    )
+                    return parse_scores(message.content[0].text)
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                    error = e
+            self.counters["retries"] += 1
+            attempt += 1
+            print(f"  ⚠️ 请求失败，{delay:.1f}s 后第 {attempt} 次重试：{error}")
+            await asyncio.sleep(delay)
+
+    async def score_rows(self, rows, cache):
+        """
+        rows 是 [(轮次, 用户输入, AI回应)]。已缓存的直接取，其余并发请求，每完成一条就写进缓存。
+        返回 {轮次: 分数字典或异常}。
+        """
+        outcomes = {}
+        pending = []
+        for round_num, context, ai_response in rows:
+            key = score_key(context, ai_response, self.model)
+            scores = cache.get(key)
+            if scores is not None:
+                outcomes[round_num] = scores
+                self.counters["cached"] += 1
+            else:
+                pending.append((round_num, key, context, ai_response))
+        if not pending:
+            return outcomes
+
+        print(f"缓存命中 {len(outcomes)} 条，需要打分 {len(pending)} 条（并发 {self.max_concurrency}）")
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        done = 0
+        start = time.perf_counter()
+
+        async with anthropic.AsyncAnthropic(**self._client_args) as client:
+            async def run(round_num, key, context, ai_response):
+                nonlocal done
+                try:
+                    scores = await self._score_one(client, semaphore, context, ai_response)
+                    cache.put(key, scores)
+                    outcomes[round_num] = scores
+                    status = f"共情{scores['empathy']}, 恰当{scores['appropriateness']}, 相关{scores['relevance']}"
+                except Exception as e:
+                    self.counters["failures"] += 1
+                    outcomes[round_num] = e
+                    status = f"评分失败: {e}"
+                done += 1
+                print(f"  [{done}/{len(pending)}] 第 {round_num} 轮 {status}")
+
+            await asyncio.gather(*(run(*item) for item in pending))
+
+        print(f"打分用时 {time.perf_counter() - start:.1f}s，{self.counters}")
+        return outcomes
+
+
+def build_results(rows, outcomes):
+    """按轮次顺序算累积分数（与原来一样：只有成功的轮次参与，失败的轮次全记 0）。"""
+    results = []
+    last = None
+    for round_num, context, ai_response in rows:
+        outcome = outcomes[round_num]
+        if isinstance(outcome, Exception):
+            results.append(dict.fromkeys(RESULT_COLUMNS, 0) | {
+                "Round": round_num, "Context": context, "AI_Response": ai_response,
+                "Explanation": f"评分失败: {outcome}",
+            })
+            continue
+
+        current = (outcome["empathy"], outcome["appropriateness"], outcome["relevance"])
+        cumulative = current if last is None else tuple((c + p) / 2 for c, p in zip(current, last))
+        last = cumulative
+        results.append({
+            "Round": round_num,
+            "Context": context,
+            "AI_Response": ai_response,
+            "Empathy_Current": current[0],
+            "Appropriateness_Current": current[1],
+            "Relevance_Current": current[2],
+            "Empathy_Cumulative": cumulative[0],
+            "Appropriateness_Cumulative": cumulative[1],
+            "Relevance_Cumulative": cumulative[2],
+            "Explanation": outcome["explanation"],
+        })
+    return pd.DataFrame(results, columns=RESULT_COLUMNS)
+
+
+def score_dialogue(df, scorer, cache_path):
+    rows = []
+    for round_num, (context, ai_response) in enumerate(zip(df["内容"], df["AI回应"]), start=1):
+        context = "" if pd.isna(context) else str(context).strip()
+        ai_response = "" if pd.isna(ai_response) else str(ai_response).strip()
+        if not context or not ai_response:
+            print(f"  第 {round_num} 轮跳过：空输入")
+            continue
+        rows.append((round_num, context, ai_response))
+
+    cache = ScoreCache(cache_path)
+    try:
+        outcomes = asyncio.run(scorer.score_rows(rows, cache))
+    finally:
+        cache.close()
+    return build_results(rows, outcomes)
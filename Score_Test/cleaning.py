@@ -0,0 +1,191 @@
+import json
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.log_store import AUTO_CONTINUE_INPUT, canonicalize, read_logs
+
+STORE_DIR = "chat_logs_store"
+ARCHIVE_FILE = "chat_logs_archive_full.csv"
+CACHE_DIR = ".cleaning_cache"     # 建在数据源所在目录下，已加入 .gitignore
+CLEANED_FILE = "cleaned_dialogue.csv"
+CACHE_VERSION = 1     # 清洗逻辑或输出列变了就加一，旧缓存自动失效
+
+# 各种表头里的 输入 / 回复 列
+INPUT_COLUMNS = ("user_input", "USER INPUT/AUTO CONTINUE", "内容")
+REPLY_COLUMNS = ("model_reply", "AI REPLY", "AI回应")
+
+
+def default_source():
+    # 有列式存储（archive_chat_logs.py 生成）就用它，否则用归档 CSV
+    return STORE_DIR if os.path.isdir(STORE_DIR) else ARCHIVE_FILE
+
+
+def _pick(df, candidates):
+    for col in candidates:
+        if col in df.columns:
+            return col
+    raise KeyError(f"找不到列 {candidates}")
+
+
+# ========== 合并 auto_continue ==========
+def merge_auto_continue(df, input_col=None, reply_col=None):
+    """
+    把 [auto_continue] 行的回复接到前一条非 auto_continue 行的回复后面（以空格分隔），并去掉这些行。
+    按文件顺序处理，开头没有前一行可接的 auto_continue 直接丢弃，与原来的逐行循环结果一致。
+    """
+    input_col = input_col or _pick(df, INPUT_COLUMNS)
+    reply_col = reply_col or _pick(df, REPLY_COLUMNS)
+
+    is_auto = df[input_col].astype(str).str.strip() == AUTO_CONTINUE_INPUT
+    turn = (~is_auto).cumsum()     # 每条正常输入开启一轮，后面的 auto_continue 属于同一轮
+    tails = is_auto & (turn > 0)
+
+    merged = df.loc[~is_auto].copy()
+    if not tails.any():
+        return merged
+
+    extra = (" " + df.loc[tails, reply_col].fillna("").astype(str).str.strip()).groupby(turn[tails]).agg("".join)
+
+    appended = turn[~is_auto].map(extra)
+    has_extra = appended.notna()
+    merged.loc[has_extra, reply_col] = merged.loc[has_extra, reply_col] + appended[has_extra]
+    return merged
+
+
+def legacy_merge_auto_continue(df, input_col, reply_col):
+    # 原来两个打分脚本里的逐行循环，只用于 --verify 对照
+    merged_rows = []
+    last_row = None
+
+    for _, row in df.iterrows():
+        user_input = str(row[input_col]).strip()
+        ai_reply = str(row[reply_col]).strip()
+
+        if user_input == AUTO_CONTINUE_INPUT:
+            if last_row is not None:
+                last_row[reply_col] += " " + ai_reply
+        else:
+            if last_row is not None:
+                merged_rows.append(last_row)
+            last_row = row.copy()
+
+    if last_row is not None:
+        merged_rows.append(last_row)
+    return pd.DataFrame(merged_rows)
+
+
+# ========== 带缓存的清洗结果 ==========
+def source_fingerprint(source):
+    # 存储目录按所有分区文件的 路径/大小/修改时间，CSV 按文件大小/修改时间
+    if os.path.isdir(source):
+        files = []
+        for root, _, names in os.walk(source):
+            for name in names:
+                if name.endswith(".parquet"):
+                    st = os.stat(os.path.join(root, name))
+                    files.append([os.path.relpath(os.path.join(root, name), source), st.st_size, st.st_mtime])
+        return {"version": CACHE_VERSION, "source": os.path.abspath(source), "files": sorted(files)}
+    st = os.stat(source)
+    return {"version": CACHE_VERSION, "source": os.path.abspath(source), "size": st.st_size, "mtime": st.st_mtime}
+
+
+def default_cache_path(source):
+    # 每个数据源一份缓存，放在数据源旁边的缓存目录里，不落在当前工作目录
+    source = os.path.abspath(source).rstrip(os.sep)
+    return os.path.join(os.path.dirname(source), CACHE_DIR, os.path.basename(source) + ".cleaned.parquet")
+
+
+def load_raw(source):
+    if os.path.isdir(source):
+        return read_logs(source)
+    df = pd.read_csv(source, encoding="utf-8-sig", dtype=str, keep_default_na=False, na_values=[""])
+    # 归档 CSV 的时间被表格软件改过格式（如 "38:25.1"），解析不出来，原文留着写回 cleaned_dialogue.csv
+    time_col = _pick(df, ("TIME", "时间"))
+    return canonicalize(df).assign(time_text=df[time_col])
+
+
+def load_cleaned(source=None, cache_path=None, refresh=False):
+    """
+    返回合并好 auto_continue 的对话（统一结构的列），结果缓存在 cache_path（默认见 default_cache_path），
+    数据源没变就直接读缓存，两个打分脚本共用同一份。
+    """
+    source = source or default_source()
+    cache_path = cache_path or default_cache_path(source)
+    stamp = source_fingerprint(source)
+    meta_path = cache_path + ".meta.json"
+    if not refresh and os.path.exists(cache_path) and os.path.exists(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            if json.load(f) == stamp:
+                return pd.read_parquet(cache_path)
+
+    start = time.perf_counter()
+    raw = load_raw(source)
+    cleaned = merge_auto_continue(raw).reset_index(drop=True)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    cleaned.to_parquet(cache_path, index=False)
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(stamp, f, ensure_ascii=False)
+    print(f"🧹 清洗完成：{len(raw)} → {len(cleaned)} 条（{time.perf_counter() - start:.2f}s），已缓存到 {cache_path}")
+    return cleaned
+
+
+def write_cleaned_csv(cleaned, path=CLEANED_FILE):
+    # 旧的 cleaned_dialogue.csv 表头
+    time_col = "time_text" if "time_text" in cleaned else "timestamp"
+    df = cleaned[[time_col, "user_id", "user_input", "model_reply"]].rename(columns={
+        time_col: "TIME",
+        "user_id": "USER NAME",
+        "user_input": "内容",
+        "model_reply": "AI回应"
+    })
+    df.to_csv(path, index=False, encoding="utf-8-sig")
+    return path
+
+
+# ========== 与原循环逐字节对照 ==========
+def verify(paths):
+    ok = True
+    for path in paths:
+        if path.endswith("chat_logs.csv"):
+            # 原始日志：表头 5 列、后来追加的行 6 列，与 archive_chat_logs.py 原来的读法一致
+            df = pd.read_csv(path, header=None, skiprows=1, quoting=1, on_bad_lines="skip",
+                             names=["timestamp", "user_id", "user_input", "model_reply", "chat_type", "score"])
+        else:
+            df = pd.read_csv(path)
+        input_col, reply_col = _pick(df, INPUT_COLUMNS), _pick(df, REPLY_COLUMNS)
+
+        start = time.perf_counter()
+        expected = legacy_merge_auto_continue(df, input_col, reply_col)
+        legacy_s = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = merge_auto_continue(df, input_col, reply_col)
+        vector_s = time.perf_counter() - start
+
+        # 全是 auto_continue 时原循环返回没有列的空表，只比较是否都为空
+        same = actual.empty if expected.empty else expected.to_csv(index=False) == actual.to_csv(index=False)
+        ok &= same
+        print(f"{'✅' if same else '❌'} {path}：{len(df)} → {len(actual)} 条，"
+              f"逐行 {legacy_s * 1000:.1f}ms / 向量化 {vector_s * 1000:.1f}ms")
+    return ok
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="合并 auto_continue，生成（并缓存）cleaned_dialogue")
+    parser.add_argument("--source", default=None, help="列式存储目录或归档 CSV，默认优先用 chat_logs_store")
+    parser.add_argument("--refresh", action="store_true", help="忽略缓存重新清洗")
+    parser.add_argument("--verify", nargs="*", default=None,
+                        help="与原逐行循环对照，默认对照仓库里的几份 CSV")
+    args = parser.parse_args()
+
+    if args.verify is not None:
+        paths = args.verify or ["chat_logs_archive_full.csv", "chat_logs_archive.csv", "chat_logs.csv"]
+        sys.exit(0 if verify(paths) else 1)
+
+    cleaned = load_cleaned(args.source, refresh=args.refresh)
+    print(f"✅ 已输出清洗结果：{write_cleaned_csv(cleaned)}")
@@ -1,89 +1,84 @@
+import os
+import sys
 import pandas as pd
 import numpy as np
 import nltk
-from sklearn.metrics.pairwise import cosine_similarity
-from sentence_transformers import SentenceTransformer
-import jieba
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.embedding import get_embedding_service
+from utils.lsm import speaker_lsm, warm_up
 
 nltk.download('punkt')
 nltk.download('stopwords')
 
-# 正确读取有标题的 CSV 文件
-df = pd.read_csv("chat_logs_archive_full.csv")
-
-# 修复 auto_continue 合并逻辑
-merged_rows = []
-last_row = None
-
-for _, row in df.iterrows():
-    user = str(row["USER NAME"]).strip()
-    user_input = str(row["USER INPUT/AUTO CONTINUE"]).strip()
-    ai_reply = str(row["AI REPLY"]).strip()
-
-    if user_input == "[auto_continue]":
-        if last_row is not None:
-            last_row["AI REPLY"] += " " + ai_reply
-    else:
-        if last_row is not None:
-            merged_rows.append(last_row)
-        last_row = row.copy()
-
-if last_row is not None:
-    merged_rows.append(last_row)
-
-clean_df = pd.DataFrame(merged_rows)
-
-# 分组并计算分数
-def get_function_words(text):
-    tokens = jieba.lcut(str(text))
-    stopwords = ['的', '了', '是', '我', '你', '他', '她', '就', '不', '在', '啊', '啦', '嘛', '呢']
-    return [t for t in tokens if t in stopwords]
-
-def calc_lsm(text1, text2):
-    words1 = get_function_words(text1)
-    words2 = get_function_words(text2)
-    overlap = len(set(words1) & set(words2))
-    denom = len(set(words1) | set(words2)) + 1e-6
-    return round(overlap / denom, 4)
-
-model = SentenceTransformer("all-MiniLM-L6-v2")
-grouped = clean_df.groupby("USER NAME")
-results = []
-
-for user, group in grouped:
-    group = group.sort_values("TIME")
-    user_texts = group["USER INPUT/AUTO CONTINUE"].dropna().tolist()
-    ai_texts = group["AI REPLY"].dropna().tolist()
-
-    user_corpus = " ".join(user_texts)
-    ai_corpus = " ".join(ai_texts) if ai_texts else ""
-
-    lsm_score = calc_lsm(user_corpus, ai_corpus)
-
-    user_vecs = model.encode(user_texts)
-    ai_vecs = model.encode(ai_texts) if ai_texts else model.encode([""]) * len(user_vecs)
-    min_len = min(len(user_vecs), len(ai_vecs))
-    user_vecs = model.encode(user_texts)
-    ai_vecs = model.encode(ai_texts) if ai_texts else model.encode([""]) * len(user_vecs)
-    min_len = min(len(user_vecs), len(ai_vecs))
-
-    # 计算逐轮加权 nCLiD
-    weighted_score = 0.0
-    for i in range(min_len):
-        dist = 1 - cosine_similarity([user_vecs[i]], [ai_vecs[i]])[0][0]
-        if i == 0:
-            weighted_score = dist
-        else:
-            weighted_score = (dist + weighted_score) / 2
-    nclid_score = round(weighted_score, 4)
-
-    results.append({
-        "说话人": user,
-        "LSM": lsm_score,
-        "nCLiD": nclid_score,
-        "总轮数": len(group)
-    })
-
-result_df = pd.DataFrame(results)
+# 清洗数据，合并 auto_continue（与 empathy_classifier.py 共用 cleaning.py，结果有缓存）
+from cleaning import load_cleaned
+
+clean_df = load_cleaned()
+
+# jieba 词典在这里加载，不算进打分耗时
+print(f"jieba 词典预热 {warm_up():.2f}s")
+
+# ========== nCLiD：整个数据集一次编码，按矩阵计算 ==========
+def aligned_turns(df):
+    """
+    每个说话人的第 i 条用户输入与第 i 条 AI 回应配对（两边各自去掉空值后对齐，与原来的逐轮循环一致）。
+    没有任何 AI 回应的说话人，第一条输入与空串配对。返回 user_id、pos、user_text、ai_text 四列。
+    """
+    user = df.loc[df["user_input"].notna(), ["user_id", "user_input"]]
+    user = user.assign(pos=user.groupby("user_id").cumcount())
+    ai = df.loc[df["model_reply"].notna(), ["user_id", "model_reply"]]
+    ai = ai.assign(pos=ai.groupby("user_id").cumcount())
+    pairs = user.merge(ai, on=["user_id", "pos"], how="inner")
+
+    no_reply = user[(user["pos"] == 0) & ~user["user_id"].isin(ai["user_id"])].assign(model_reply="")
+    pairs = pd.concat([pairs, no_reply], ignore_index=True).sort_values(["user_id", "pos"], kind="stable")
+    return pairs.rename(columns={"user_input": "user_text", "model_reply": "ai_text"}).reset_index(drop=True)
+
+
+def encode_unique(model, texts):
+    # 所有说话人的句子去重后一次大批量编码，返回 (向量矩阵, 每条文本对应的行号)
+    codes, uniques = pd.factorize(pd.Series(texts, dtype=object))
+    return np.asarray(model.encode(list(uniques)), dtype=np.float64), codes
+
+
+def row_cosine_distance(a, b):
+    # 逐行 1 - cos，零向量的相似度记为 0（与 sklearn 的 cosine_similarity 一致）
+    def unit(m):
+        norms = np.linalg.norm(m, axis=1, keepdims=True)
+        return m / np.where(norms == 0, 1.0, norms)
+    return 1.0 - np.einsum("ij,ij->i", unit(a), unit(b))
+
+
+def decayed_nclid(pairs, distances):
+    """
+    原来逐轮递推 w = (d_i + w) / 2（w 从 d_0 开始），展开后第 i 轮的权重是 0.5 ** (n - i)，
+    第 0 轮与第 1 轮同权 0.5 ** (n - 1)。按说话人求加权和，一次算完。
+    """
+    n = pairs.groupby("user_id")["pos"].transform("size").to_numpy()
+    pos = pairs["pos"].to_numpy()
+    weights = 0.5 ** (n - np.maximum(pos, 1))
+    return pd.Series(weights * distances, index=pairs["user_id"].to_numpy()).groupby(level=0).sum()
+
+
+model = get_embedding_service("all-MiniLM-L6-v2")
+# 归档 CSV 保留了原始时间文本，按它排序与原来一致；列式存储按时间戳排序
+time_col = "time_text" if "time_text" in clean_df else "timestamp"
+clean_df = clean_df.sort_values(["user_id", time_col], kind="stable")
+pairs = aligned_turns(clean_df)
+vectors, codes = encode_unique(model, pairs["user_text"].tolist() + pairs["ai_text"].tolist())
+distances = row_cosine_distance(vectors[codes[:len(pairs)]], vectors[codes[len(pairs):]])
+nclid_scores = decayed_nclid(pairs, distances)
+
+# ========== LSM：逐句分词（有缓存），所有说话人一起按功能词类别计数 ==========
+lsm_scores = speaker_lsm(clean_df, pairs)
+
+result_df = pd.DataFrame({
+    "说话人": lsm_scores.index,
+    "LSM": lsm_scores["LSM"].round(4).to_numpy(),
+    "逐轮LSM": lsm_scores["LSM_turn"].round(4).to_numpy(),
+    "nCLiD": nclid_scores.reindex(lsm_scores.index, fill_value=0.0).round(4).to_numpy(),
+    "总轮数": clean_df.groupby("user_id").size().reindex(lsm_scores.index).to_numpy()
+})
 result_df.to_csv("speaker_scores.csv", index=False, encoding="utf-8-sig")
 print("✅ 打分完成，结果已保存为 speaker_scores.csv")
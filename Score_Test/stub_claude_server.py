@@ -0,0 +1,93 @@
+"""
+本地 Claude Messages 接口桩服务，用来离线测试 claude_scorer：
+
+    python stub_claude_server.py --port 8765 --fail-rate 0.2 --delay 0.3
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765 ANTHROPIC_API_KEY=stub python empathy_classifier.py
+
+按 fail-rate 随机返回 429（带 Retry-After）或 529，其余返回固定格式的随机分数。
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+counters = {"requests": 0, "ok": 0, "rate_limited": 0, "overloaded": 0}
+counters_lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    fail_rate = 0.0
+    delay = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _count(self, key):
+        with counters_lock:
+            counters["requests"] += 1
+            counters[key] += 1
+
+    def do_GET(self):
+        if self.path == "/stats":
+            with counters_lock:
+                self._send(200, dict(counters))
+        else:
+            self._send(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.delay:
+            time.sleep(random.uniform(0, 2 * self.delay))
+
+        if random.random() < self.fail_rate:
+            if random.random() < 0.5:
+                self._count("rate_limited")
+                self._send(429, {"type": "error", "error": {"type": "rate_limit_error", "message": "stub rate limit"}},
+                           {"Retry-After": "1"})
+            else:
+                self._count("overloaded")
+                self._send(529, {"type": "error", "error": {"type": "overloaded_error", "message": "stub overloaded"}})
+            return
+
+        self._count("ok")
+        text = (f"Empathy: {random.randint(1, 10)}\n"
+                f"Appropriateness: {random.randint(1, 10)}\n"
+                f"Relevance: {random.randint(1, 10)}\n"
+                f"Explanation: stub score")
+        self._send(200, {
+            "id": f"msg_stub_{counters['requests']}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model", "stub"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": 0, "output_tokens": 0},
+        })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地 Claude Messages 接口桩服务")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="返回 429 / 529 的比例")
+    parser.add_argument("--delay", type=float, default=0.2, help="平均响应延迟（秒）")
+    args = parser.parse_args()
+
+    StubHandler.fail_rate = args.fail_rate
+    StubHandler.delay = args.delay
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), StubHandler)
+    print(f"🧪 桩服务已启动：http://127.0.0.1:{args.port}")
+    server.serve_forever()
@@ -5,11 +5,15 @@ import time
 import random
 import msvcrt
 from dotenv import load_dotenv
-from openai import OpenAI
-import faiss
-from sentence_transformers import SentenceTransformer
-from utils.preprocess import load_esconv
-from utils.vector_index import encode_text
+from utils.llm import create_llm_gateway
+from utils.vector_index import encode_text, DEFAULT_MODEL, MULTILINGUAL_INDEX_PATH
+from utils.ingest import RetrievalIndex
+from utils.context_injection import ContextInjector, QueryCache
+from utils.embedding import get_embedding_service
+from utils.context_window import BackgroundCompactor, ContextWindow, make_summarizer
+from utils.translation import Translator
+from utils.scoring import ScoringPipeline
+from utils.log_writer import create_log_writer
 import threading
 import queue
 from tencentcloud.common import credential
@@ -70,43 +74,63 @@ MOONSHOT_API_KEY = os.getenv("MOONSHOT_API_KEY")
 MOONSHOT_BASE_URL = os.getenv("MOONSHOT_BASE_URL")
 
 # ========== 初始化客户端 ==========
-client = OpenAI(api_key=MOONSHOT_API_KEY, base_url=MOONSHOT_BASE_URL)
+# 所有模型调用都走共享网关：连接池、并发上限、429/5xx 退避重试、按模型超时
+llm = create_llm_gateway(MOONSHOT_API_KEY, MOONSHOT_BASE_URL)
+translator = Translator(llm, cache_path=os.getenv("TRANSLATION_CACHE_PATH", "Data/translation_cache.sqlite3"))
 
-# ========== 加载 FAISS 与语料 ==========
-print("📦 正在加载向量索引与语料库...")
+# ========== FAISS 与语料（第一次检索时才加载，import 本模块不付这笔开销）==========
 index_path = "Data/esconv_faiss.index"
 json_path = "Data/ESConv.json"
-faiss_index = faiss.read_index(index_path)
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
-corpus_pairs = load_esconv(json_path)
+
+# ========== 检索模式 ==========
+# multilingual：中文查询直接用多语言编码器编码检索（需先 python -m utils.vector_index --multilingual）
+# translate：先调用模型翻译成英文，再用 all-MiniLM-L6-v2 检索（旧流程，作为回退）
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "multilingual")
+retrieval = None
+retrieval_model = None
+retrieval_lock = threading.Lock()
+
+def load_retrieval():
+    global RETRIEVAL_MODE, retrieval, retrieval_model
+    with retrieval_lock:
+        if retrieval is not None:
+            return
+        print("📦 正在加载向量索引与语料库...")
+        if RETRIEVAL_MODE == "multilingual" and not os.path.exists(MULTILINGUAL_INDEX_PATH):
+            print(f"⚠️ 未找到多语言索引 {MULTILINGUAL_INDEX_PATH}，回退到翻译检索")
+            RETRIEVAL_MODE = "translate"
+
+        # 索引类型、度量、搜索宽度和编码模型都以索引旁边的 .meta.json 为准；
+        # python -m utils.ingest 发布新版本后会在后台切换过去，不用重启
+        index = RetrievalIndex(MULTILINGUAL_INDEX_PATH if RETRIEVAL_MODE == "multilingual" else index_path, json_path)
+        retrieval_model = get_embedding_service(index.meta["model"])
+        retrieval = index
+        print(f"🔎 检索模式：{RETRIEVAL_MODE}（{index.meta['index_type']}/{index.meta['metric']}）")
 
 # ========== 读取 system prompt ==========
 with open("system_prompt.txt", "r", encoding="utf-8") as f:
     system_prompt = {"role": "system", "content": f.read()}
 
 chat_history = [system_prompt]
-context_injected = False
-top_k = 3
+
+# ========== 上下文窗口：人设 + 最近几轮原文 + 更早轮次的滚动摘要 ==========
+context_window = ContextWindow(
+    summarize=make_summarizer(llm),
+    keep_turns=int(os.getenv("CONTEXT_KEEP_TURNS", "6")),
+    max_prompt_tokens=int(os.getenv("CONTEXT_MAX_TOKENS", "6000")),
+)
+# 摘要在回复打印出来之后由后台线程生成，下一次调用模型前再写回 chat_history
+context_compactor = BackgroundCompactor(context_window)
 
 #=========语义协同打分==========
 def evaluate_understanding(user_text, model_reply):
     try:
-        # 翻译为英文
-        def zh2en(text):
-            response = client.chat.completions.create(
-                model="moonshot-v1-8k",
-                messages=[
-                    {"role": "system", "content": "请将以下中文翻译为英文，不要输出任何其他内容。"},
-                    {"role": "user", "content": text}
-                ],
-                temperature=0.7,
-            )
-            return response.choices[0].message.content.strip()
-
-        user_en = zh2en(user_text)
-        reply_en = zh2en(model_reply)
+        # 翻译为英文：打分用的是英文模型，两句都要翻译。只有 RETRIEVAL_MODE=translate 时 user_text 已在检索时翻译过、
+        # 能命中缓存；默认的 multilingual 模式检索不翻译，这里两句都是新的模型调用
+        user_en, reply_en = translator.translate_many([user_text, model_reply])
 
         # 编码向量
+        embedding_model = get_embedding_service(DEFAULT_MODEL)
         u_vec = encode_text(user_en, embedding_model)
         r_vec = encode_text(reply_en, embedding_model)
 
@@ -122,13 +146,46 @@ def evaluate_understanding(user_text, model_reply):
         print("⚠️ 理解评分失败：", str(e))
         return 0.0
 
+# ========== 后台理解感打分 + 对话日志 ==========
+score_log_path = "chat_logs_console.csv"
+score_log_fields = ["timestamp", "user_input", "model_reply", "chat_type", "score"]
+score_log = create_log_writer(score_log_path, score_log_fields)
+
+def write_score_log(record):
+    score_log.write(record)
+
+def on_scored(record):
+    if record.get("score") is not None:
+        print(f"\n📊 理解感评分：{record['score']:.2f}")
+    write_score_log(record)
+
+scoring = ScoringPipeline(
+    evaluate_understanding,
+    on_scored=on_scored,
+    workers=int(os.getenv("SCORE_WORKERS", "2")),
+    sample_rate=float(os.getenv("SCORE_SAMPLE_RATE", "1.0")),
+)
+
+def log_turn(user_text, model_reply, chat_type):
+    # 回复发出后立即返回；抽中的轮次打完分再落盘，没抽中的直接落盘
+    record = {
+        "timestamp": time.time(),
+        "user_input": user_text,
+        "model_reply": model_reply,
+        "chat_type": chat_type,
+        "score": "",
+    }
+    if not scoring.submit(user_text, model_reply, record):
+        write_score_log(record)
+
 # ========== 回复函数 ==========
 def get_reply(prompt_messages, max_tokens=60):
-    response = client.chat.completions.create(
-        model="moonshot-v1-128k",
-        messages=prompt_messages,
+    context_compactor.apply("default", prompt_messages)
+    messages, model = context_window.prepare(prompt_messages, max_tokens)
+    response = llm.complete(
+        model=model,
+        messages=messages,
         temperature=0.8,
-        timeout=20,
         response_format={"type": "json_object"},
         max_tokens=max_tokens
     )
@@ -165,95 +222,105 @@ def safe_input_with_timeout(prompt, timeout):
 
 
 # ========== 语料注入函数 ==========
+def encode_query(user_text):
+    if RETRIEVAL_MODE == "multilingual":
+        return encode_text(user_text, retrieval_model)
+    return encode_text(translator.translate(user_text), retrieval_model)
+
+def search_query(query_vector, k):
+    retrieval.maybe_reload()
+    return retrieval.search(query_vector, k)
+
+# 已注入且没到刷新轮次时整条检索链路都跳过；需要检索时先查缓存（原文精确 / 向量近似），索引换版本时缓存失效
+context_injector = ContextInjector(
+    encode=encode_query,
+    search=search_query,
+    generation=lambda: retrieval.version,
+    cache=QueryCache(
+        ttl=int(os.getenv("RETRIEVAL_CACHE_TTL", "600")),
+        similarity=float(os.getenv("RETRIEVAL_CACHE_SIMILARITY", "0.95")),
+    ),
+    top_k=3,
+    refresh_every=int(os.getenv("CONTEXT_REFRESH_TURNS", "3")),
+)
+
 def inject_context(user_text, chat_history, context_injected_flag):
     try:
-        translation_response = client.chat.completions.create(
-            model="moonshot-v1-8k",
-            messages=[
-                {"role": "system", "content": "请将以下中文翻译为英文，不要输出任何其他内容。"},
-                {"role": "user", "content": user_text}
-            ],
-            temperature=0.7,
-        )
-        translated_query = translation_response.choices[0].message.content.strip()
-        query_vector = encode_text(translated_query, embedding_model)
-        D, I = faiss_index.search(query_vector, top_k)
-
-        matched_contexts = []
-        for idx in I[0]:
-            if idx < len(corpus_pairs):
-                entry = corpus_pairs[idx]
-                matched_contexts.append(f"Q: {entry['question']}\nA: {entry['answer']}")
-
-        if matched_contexts and not context_injected_flag:
-            combined_context = "\n\n---\n\n".join(matched_contexts)
-            chat_history.insert(1, {
-                "role": "system",
-                "content": f"以下是知识库背景信息，请在回答中参考但不要重复内容：\n\n{combined_context}"
-            })
-            return True
+        load_retrieval()
+        return context_injector(user_text, chat_history)
     except Exception as e:
         print("❌ 插入语料失败：", str(e))
     return context_injected_flag
 
 
-while True:
-    try:
-        user_input = safe_input_with_timeout("你：", timeout=9999)
-
-        if user_input.lower() in ["exit", "quit"]:
-            break
-
-        if not user_input:
-            print("⚠️ 没有听到你的回应，要不你说点什么？")
-            continue
-
-        # === 上下文注入 + 回复 ===
-        context_injected = inject_context(user_input, chat_history, context_injected)
-        chat_history.append({"role": "user", "content": user_input})
-
-        first_sentence = get_reply(chat_history, max_tokens=200)
-        print("\n🤖 Kimi：", first_sentence)
-        score = evaluate_understanding(user_input, first_sentence)
-        print(f"📊 理解感评分：{score:.2f}")
-        #speak(first_sentence)
-        chat_history.append({"role": "assistant", "content": first_sentence})
-
-        # === 沉默监听 + 自动续说 ===
-        silent_rounds = 0
-        while silent_rounds < 5:
-            print("\n(你可以接着说，也可以沉默 20 秒让我继续)\n")
-            follow_up = safe_input_with_timeout("你：", timeout=20)
-            last_input_empty = not follow_up.strip()
-
-            if follow_up.strip():
-                # 用户继续说
-                context_injected = inject_context(follow_up, chat_history, context_injected)
-                chat_history.append({"role": "user", "content": follow_up})
-
-                follow_reply = get_reply(chat_history, max_tokens=200)
-                print("\n🤖 Kimi：", follow_reply)
-                #speak(follow_reply)
-                score = evaluate_understanding(user_input, follow_reply)
-                print(f"📊 理解感评分：{score:.2f}")
-                chat_history.append({"role": "assistant", "content": follow_reply})
-                silent_rounds = 0  # 重置沉默计数器
-            else:
-                # 用户沉默，AI 主动继续说
-                auto_prompt = random.choice(AUTO_CONTINUE_TEMPLATES)
-                chat_history.append({
-                    "role": "system",
-                    "content": f"用户沉默了，请你以温柔朋友的语气继续说一些话，参考这条提示：{auto_prompt}"
-                })
-
-                continuation = get_reply(chat_history, max_tokens=200)
-                if continuation.strip():
-                    print("🤖 Kimi（继续）：", continuation)
-                    #speak(continuation)
-                    score = evaluate_understanding(user_input, continuation)
-                    print(f"📊 理解感评分：{score:.2f}")
-                    chat_history.append({"role": "assistant", "content": continuation})
-                silent_rounds += 1
+def main():
+    context_injected = False
 
-    except Exception as e:
-        print("❌ 出现错误：", str(e))
\ No newline at end of file
+    while True:
+        try:
+            user_input = safe_input_with_timeout("你：", timeout=9999)
+
+            if user_input.lower() in ["exit", "quit"]:
+                break
+
+            if not user_input:
+                print("⚠️ 没有听到你的回应，要不你说点什么？")
+                continue
+
+            # === 上下文注入 + 回复 ===
+            context_injected = inject_context(user_input, chat_history, context_injected)
+            chat_history.append({"role": "user", "content": user_input})
+
+            first_sentence = get_reply(chat_history, max_tokens=200)
+            print("\n🤖 Kimi：", first_sentence)
+            log_turn(user_input, first_sentence, "reply")
+            #speak(first_sentence)
+            chat_history.append({"role": "assistant", "content": first_sentence})
+            context_compactor.submit("default", chat_history)
+
+            # === 沉默监听 + 自动续说 ===
+            silent_rounds = 0
+            while silent_rounds < 5:
+                print("\n(你可以接着说，也可以沉默 20 秒让我继续)\n")
+                follow_up = safe_input_with_timeout("你：", timeout=20)
+                last_input_empty = not follow_up.strip()
+
+                if follow_up.strip():
+                    # 用户继续说
+                    context_injected = inject_context(follow_up, chat_history, context_injected)
+                    chat_history.append({"role": "user", "content": follow_up})
+
+                    follow_reply = get_reply(chat_history, max_tokens=200)
+                    print("\n🤖 Kimi：", follow_reply)
+                    #speak(follow_reply)
+                    log_turn(user_input, follow_reply, "follow_up")
+                    chat_history.append({"role": "assistant", "content": follow_reply})
+                    context_compactor.submit("default", chat_history)
+                    silent_rounds = 0  # 重置沉默计数器
+                else:
+                    # 用户沉默，AI 主动继续说
+                    auto_prompt = random.choice(AUTO_CONTINUE_TEMPLATES)
+                    chat_history.append({
+                        "role": "system",
+                        "content": f"用户沉默了，请你以温柔朋友的语气继续说一些话，参考这条提示：{auto_prompt}"
+                    })
+
+                    continuation = get_reply(chat_history, max_tokens=200)
+                    if continuation.strip():
+                        print("🤖 Kimi（继续）：", continuation)
+                        #speak(continuation)
+                        log_turn(user_input, continuation, "auto_continue")
+                        chat_history.append({"role": "assistant", "content": continuation})
+                        context_compactor.submit("default", chat_history)
+                    silent_rounds += 1
+
+        except Exception as e:
+            print("❌ 出现错误：", str(e))
+
+    # 退出前把还在排队的打分跑完，再把日志写完
+    scoring.shutdown()
+    score_log.close()
+
+
+if __name__ == "__main__":
+    main()
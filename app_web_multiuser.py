@@ -6,12 +6,22 @@ import os
 import json
 import time
 import random
-import csv
+import queue
 import threading
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
-from openai import OpenAI
+from utils.llm import create_llm_gateway
+from utils.json_stream import TextFieldExtractor
+from utils.push_hub import PushHub
+from utils.scheduler import DeadlineScheduler
+from utils.session_store import create_session_store
+from utils.context_window import BackgroundCompactor, ContextWindow, make_summarizer
+from utils.translation import Translator
+from utils.log_writer import create_log_writer, LOG_FIELDS
+from utils.admission import AdmissionController, SessionLocks, RequestCoalescer, Overloaded
+from utils.session_metrics import create_session_metrics
+from utils.instrumentation import metrics, timed
 
 
 
@@ -24,7 +34,11 @@ CORS(app)
 #=====表单记录======
 
 
-log_fields = ["timestamp", "user_id", "user_input", "model_reply", "chat_type", "elapsed"]
+# 单个后台线程批量写入（格式与轮转见 utils/log_writer.py，CHAT_LOG_SINKS 可加 jsonl / sqlite）
+chat_log = create_log_writer("chat_logs.csv", LOG_FIELDS)
+
+# 每记一轮就更新该会话的 LSM / nCLiD 累加器（后台线程计算），/metrics/session/<user_id> 随时可查
+session_metrics = create_session_metrics()
 
 
 
@@ -34,18 +48,15 @@ log_fields = ["timestamp", "user_id", "user_input", "model_reply", "chat_type",
 
 
 def write_log(timestamp, user_id, user_input, model_reply, chat_type="manual", elapsed=None):
-   with open("chat_logs.csv", "a", encoding="utf-8", newline="") as f:
-       writer = csv.DictWriter(f, fieldnames=log_fields, quoting=csv.QUOTE_ALL)
-       if f.tell() == 0:
-           writer.writeheader()
-       writer.writerow({
-           "timestamp": timestamp,
-           "user_id": user_id,
-           "user_input": user_input,
-           "model_reply": model_reply,
-           "chat_type": chat_type,
-           "elapsed": elapsed
-       })
+   chat_log.write({
+       "timestamp": timestamp,
+       "user_id": user_id,
+       "user_input": user_input,
+       "model_reply": model_reply,
+       "chat_type": chat_type,
+       "elapsed": elapsed
+   })
+   session_metrics.observe(user_id, user_input, model_reply, chat_type)
 
 
 
@@ -60,7 +71,9 @@ def write_log(timestamp, user_id, user_input, model_reply, chat_type="manual", e
 load_dotenv("API.env")
 MOONSHOT_API_KEY = os.getenv("MOONSHOT_API_KEY")
 MOONSHOT_BASE_URL = os.getenv("MOONSHOT_BASE_URL")
-client = OpenAI(api_key=MOONSHOT_API_KEY, base_url=MOONSHOT_BASE_URL)
+# 所有模型调用都走共享网关：连接池、并发上限、429/5xx 退避重试、按模型超时
+llm = create_llm_gateway(MOONSHOT_API_KEY, MOONSHOT_BASE_URL)
+translator = Translator(llm, cache_path=os.getenv("TRANSLATION_CACHE_PATH", "Data/translation_cache.sqlite3"))
 
 
 
@@ -88,22 +101,92 @@ AUTO_CONTINUE_TEMPLATES = [
 
 
 
-# === 多用户记忆系统 ===
-session_memory = {}
+# === 上下文窗口：人设 + 最近几轮原文 + 更早轮次的滚动摘要 ===
+context_window = ContextWindow(
+    summarize=make_summarizer(llm),
+    keep_turns=int(os.getenv("CONTEXT_KEEP_TURNS", "6")),
+    max_prompt_tokens=int(os.getenv("CONTEXT_MAX_TOKENS", "6000")),
+)
+# 摘要在回复发出之后由后台线程生成，下一轮请求在会话锁内写回，不占用户等回复的时间
+context_compactor = BackgroundCompactor(context_window)
+
+
+
+
+# === 多用户记忆系统（空闲淘汰 + 内存预算，后端见 SESSION_BACKEND）===
+def on_session_evict(uid):
+  auto_continue_scheduler.cancel(uid)
+  context_compactor.discard(uid)
+
+
+session_memory = create_session_store(on_evict=on_session_evict)
+
+
+# === 准入控制：模型并发打满后排队，排不上就 429 + Retry-After；同一会话的请求串行，重复提交合并 ===
+admission = AdmissionController(
+    max_active=int(os.getenv("ADMISSION_MAX_ACTIVE", str(llm.max_concurrency))),
+    max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", str(llm.max_concurrency * 2))),
+    queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5")),
+)
+# SQLite 会话库由多个 worker 共用时，会话锁也要跨进程（锁文件放在后端给的 lock_dir 下）
+session_locks = SessionLocks(timeout=float(os.getenv("SESSION_LOCK_TIMEOUT", "30")),
+                             lock_dir=session_memory.backend.lock_dir)
+chat_coalescer = RequestCoalescer(ttl=int(os.getenv("IDEMPOTENCY_TTL", "300")))
+
+
+def overloaded_response(e):
+    metrics.inc("admission_rejected_total", reason=e.reason)
+    return (
+        jsonify({"text": "⚠️ 当前请求较多，请稍后再试", "error": e.reason, "retry_after": e.retry_after}),
+        429,
+        {"Retry-After": str(e.retry_after)},
+    )
+
+
+def coalesce_key(data, user_id, user_input):
+    # 带幂等键的按键去重（完成后还保留一段时间），否则只合并同时在途的相同文本
+    key = request.headers.get("Idempotency-Key") or data.get("idempotency_key")
+    if key:
+        return ("idempotency", user_id, key), True
+    return ("text", user_id, user_input), False
+
+
+# === 自动续说推送通道（SSE），没有在线连接时回退到 /check_update 轮询 ===
+push_hub = PushHub()
+PUSH_HEARTBEAT_SECONDS = 15
+PUSH_ACK_TIMEOUT = 2     # 确认送达时等会话锁的秒数
+
+
+
+
+# === 自动续说配置：沉默 30 秒触发，每轮最多 2 次 ===
+AUTO_CONTINUE_SILENCE = 30
+AUTO_CONTINUE_MAX = 2
+AUTO_CONTINUE_RETRY = 10
+AUTO_CONTINUE_WORKERS = int(os.getenv("AUTO_CONTINUE_WORKERS", "8"))
+
+
+
+
+def touch_session(user_id):
+  # 初始化或刷新用户会话，并按新的沉默截止时间排队自动续说
+  session = session_memory.get_or_create(user_id, lambda: {
+      "history": [system_prompt],
+      "last_active": time.time(),
+      "auto_continue_count": 0
+  })
+  session["last_active"] = time.time()
+  session["auto_continue_count"] = 0
+  context_compactor.apply(user_id, session["history"])
+  session_memory.save(user_id, session)
+  auto_continue_scheduler.schedule(user_id, session["last_active"] + AUTO_CONTINUE_SILENCE)
+  return session
 
 
 
 
 def encode_zh(text):
-  res = client.chat.completions.create(
-      model="moonshot-v1-8k",
-      messages=[
-          {"role": "system", "content": "请将以下中文翻译为英文，不要输出任何其他内容。"},
-          {"role": "user", "content": text}
-      ],
-      temperature=0.7,
-  )
-  return res.choices[0].message.content.strip()
+  return translator.translate(text)
 
 
 
@@ -111,11 +194,11 @@ def encode_zh(text):
 
 
 def get_reply(history, max_tokens=200):
-  res = client.chat.completions.create(
-      model="moonshot-v1-128k",
-      messages=history,
+  messages, model = context_window.prepare(history, max_tokens)
+  res = llm.complete(
+      model=model,
+      messages=messages,
       temperature=0.8,
-      timeout=20,
       response_format={"type": "json_object"},
       max_tokens=max_tokens
   )
@@ -128,6 +211,39 @@ def get_reply(history, max_tokens=200):
 
 
 
+# === 流式回复：边生成边吐出 "text" 字段 ===
+def stream_reply(history, max_tokens=200):
+    messages, model = context_window.prepare(history, max_tokens)
+    stream = llm.stream(
+        model=model,
+        messages=messages,
+        temperature=0.8,
+        response_format={"type": "json_object"},
+        max_tokens=max_tokens
+    )
+    extractor = TextFieldExtractor("text")
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            text = extractor.feed(delta)
+            if text:
+                yield text
+    rest = extractor.finish()
+    if rest:
+        yield rest
+
+
+def sse_event(payload, event=None):
+    data = json.dumps(payload, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {data}\n\n"
+    return f"data: {data}\n\n"
+
+
+
+
 @app.route("/chat", methods=["POST"])
 def chat():
    data = request.json
@@ -143,55 +259,150 @@ def chat():
 
 
 
-   # 初始化用户
-   if user_id not in session_memory:
-       session_memory[user_id] = {
-           "history": [system_prompt],
-           "last_active": time.time(),
-           "auto_continue_count": 0
-       }
+   @timed("chat_request")
+   def handle():
+       # 先排同一会话的队，再占全局名额，避免占着名额干等
+       with session_locks.hold(user_id), admission.slot():
+           # 初始化用户
+           session = touch_session(user_id)
+           history = session["history"]
 
 
+           history.append({"role": "user", "content": user_input})
 
 
-   session = session_memory[user_id]
-   session["last_active"] = time.time()
-   session["auto_continue_count"] = 0
-   history = session["history"]
+           # ⏱️ 计算响应时间
+           start = time.time()
+           reply = f"[reply] {get_reply(history)}"
+           elapsed = round(time.time() - start, 2)
 
 
+           history.append({"role": "assistant", "content": reply})
+           session_memory.save(user_id, session)
+           context_compactor.submit(user_id, history)
 
 
-   history.append({"role": "user", "content": user_input})
+           print(f"[{user_id}] 👤 {user_input}")
 
 
+           # ✅ 补上 chat_type 和 elapsed
+           write_log(time.time(), user_id, user_input, reply, chat_type="manual", elapsed=elapsed)
+           return reply
 
 
-   # ⏱️ 计算响应时间
-   start = time.time()
-   reply = f"[reply] {get_reply(history)}"
-   elapsed = round(time.time() - start, 2)
+   key, remember = coalesce_key(data, user_id, user_input)
+   try:
+       reply = chat_coalescer.run(key, handle, remember=remember)
+   except Overloaded as e:
+       return overloaded_response(e)
 
 
 
 
-   history.append({"role": "assistant", "content": reply})
+   return jsonify({"text": reply})
 
 
 
 
-   print(f"[{user_id}] 👤 {user_input}")
+# 流式回复中途出错或客户端断开时，已生成的部分回复带上这个标记记入 history 和日志
+INTERRUPTED_MARK = "[interrupted]"
 
 
+@app.route("/chat_stream", methods=["POST"])
+def chat_stream():
+   data = request.json
+   user_input = data.get("text", "").strip()
+   user_id = data.get("user_id", "anonymous")
 
 
-   # ✅ 补上 chat_type 和 elapsed
-   write_log(time.time(), user_id, user_input, reply, chat_type="manual", elapsed=elapsed)
+   if not user_input:
+       return jsonify({"text": "⚠️ 请输入内容"})
 
 
+   # 会话锁和准入名额要一直占到流结束，在生成器结束或连接关闭时释放（只释放一次）
+   if not session_locks.acquire(user_id):
+       return overloaded_response(Overloaded(1, reason="session busy"))
+   try:
+       admitted_at = admission.acquire()
+   except Overloaded as e:
+       session_locks.release(user_id)
+       return overloaded_response(e)
+   released = threading.Lock()
 
+   def release():
+       if released.acquire(blocking=False):
+           admission.release(admitted_at)
+           session_locks.release(user_id)
 
-   return jsonify({"text": reply})
+   try:
+       session = touch_session(user_id)
+       history = session["history"]
+   except Exception:
+       release()
+       raise
+
+
+   def generate():
+       # 用户消息在开始生成时才写进 history；客户端在此之前断开，本轮不留痕迹
+       user_msg = {"role": "user", "content": user_input}
+       history.append(user_msg)
+       print(f"[{user_id}] 👤 {user_input}")
+
+       start = time.time()
+       first_token_at = None
+       parts = []
+       completed = False
+       failure = None
+       try:
+           for delta in stream_reply(history):
+               if first_token_at is None:
+                   first_token_at = time.time()
+                   delta = "[reply] " + delta
+               parts.append(delta)
+               yield sse_event({"delta": delta})
+           completed = True
+       except Exception as e:
+           failure = e
+           print(f"[{user_id}] ❌ 流式回复失败: {e}")
+       finally:
+           # 正常结束、出错、客户端断开（GeneratorExit）都在这里收尾：
+           # 有内容就记下（中断的加标记），一个字都没有就撤回这条用户消息，保证 history 不会出现连续两条用户消息
+           reply = "".join(parts).strip()
+           if completed:
+               reply = reply or "[reply]"
+           elif reply:
+               reply += f" {INTERRUPTED_MARK}"
+           elapsed = round(time.time() - start, 2)
+           if reply:
+               history.append({"role": "assistant", "content": reply})
+           elif history and history[-1] is user_msg:
+               history.pop()
+           session_memory.save(user_id, session)
+           context_compactor.submit(user_id, history)
+           release()
+           if reply:
+               write_log(time.time(), user_id, user_input, reply, chat_type="manual", elapsed=elapsed)
+
+       if not completed:
+           yield sse_event({"error": str(failure)}, event="error")
+           return
+
+       ttft = round(first_token_at - start, 2) if first_token_at else None
+       metrics.observe("stage_seconds", time.time() - start, stage="chat_stream")
+       if first_token_at:
+           metrics.observe("stage_seconds", first_token_at - start, stage="chat_stream_first_token")
+       print(f"[{user_id}] ⚡ 首字 {ttft}s / 全程 {elapsed}s")
+
+       yield sse_event({"text": reply, "ttft": ttft, "elapsed": elapsed}, event="done")
+
+
+   response = Response(
+       stream_with_context(generate()),
+       mimetype="text/event-stream",
+       headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+   )
+   response.call_on_close(release)
+   return response
 
 
 
@@ -213,60 +424,220 @@ def check_update():
 
 
 
-  if user_id not in session_memory:
+  # 会话正忙（正在回复或自动续说）就等下一次轮询
+  if not session_locks.acquire(user_id, timeout=0):
       return jsonify({"update": False})
+  try:
+      session = session_memory.get(user_id)
+      if session is None:
+          return jsonify({"update": False})
 
 
+      pending_reply = session.get("pending_auto_reply", None)
 
 
-  session = session_memory[user_id]
-  pending_reply = session.get("pending_auto_reply", None)
+      if pending_reply:
+          session["pending_auto_reply"] = None  # 清除已读
+          session_memory.save(user_id, session)
+          return jsonify({"update": True, "text": pending_reply})
+      else:
+          return jsonify({"update": False})
+  finally:
+      session_locks.release(user_id)
 
 
 
 
-  if pending_reply:
-      session["pending_auto_reply"] = None  # 清除已读
-      return jsonify({"update": True, "text": pending_reply})
-  else:
-      return jsonify({"update": False})
+def ack_auto_reply(user_id, text):
+  # 只清掉与已送达内容相同的那条，期间又生成了新的就留着；会话一直忙就先不清，宁可重复也不丢
+  if not session_locks.acquire(user_id, timeout=PUSH_ACK_TIMEOUT):
+      return
+  try:
+      session = session_memory.get(user_id)
+      if session and session.get("pending_auto_reply") == text:
+          session["pending_auto_reply"] = None
+          session_memory.save(user_id, session)
+  finally:
+      session_locks.release(user_id)
+
+
+@app.route("/events", methods=["GET"])
+def events():
+  user_id = request.args.get("user_id", "anonymous")
+  q = push_hub.subscribe(user_id)
+
+  # 断线期间攒下的自动续说，连上后先补发；和实时推送一样，写出之后才算送达
+  session = session_memory.get(user_id)
+  if session and session.get("pending_auto_reply"):
+      q.put_nowait({"text": session["pending_auto_reply"]})
+
+  def generate():
+      last_sent = None
+      try:
+          yield "retry: 3000\n\n"
+          while True:
+              try:
+                  payload = q.get(timeout=PUSH_HEARTBEAT_SECONDS)
+              except queue.Empty:
+                  # 多个 worker 时自动续说可能在别的进程里生成，推不到这个连接的队列，心跳时到会话库里看一眼
+                  session = session_memory.get(user_id)
+                  pending = session.get("pending_auto_reply") if session else None
+                  if not pending or pending == last_sent:
+                      yield ": ping\n\n"
+                      continue
+                  payload = {"text": pending}
+              if payload.get("text") == last_sent:
+                  # 心跳补发过的同一条又从本进程的队列里出来了，不再重复发
+                  ack_auto_reply(user_id, last_sent)
+                  continue
+              yield sse_event(payload, event="auto_reply")
+              last_sent = payload.get("text")
+              # 能走到这里说明服务器已经写出上一条、来取下一条了，这时才清掉待取的回复
+              ack_auto_reply(user_id, payload.get("text"))
+      finally:
+          push_hub.unsubscribe(user_id, q)
+
+  return Response(
+      stream_with_context(generate()),
+      mimetype="text/event-stream",
+      headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+  )
+
+
+
+
+def auto_continue_check(uid, deadline):
+   # 会话正在处理用户消息时不插话；模型并发打满时让路给用户请求，稍后再试
+   if not session_locks.acquire(uid, timeout=0):
+       auto_continue_scheduler.schedule(uid, time.time() + AUTO_CONTINUE_RETRY)
+       return
+   try:
+       with admission.slot():
+           run_auto_continue(uid)
+   except Overloaded as e:
+       auto_continue_scheduler.schedule(uid, time.time() + e.retry_after)
+   finally:
+       session_locks.release(uid)
+
+
+
+
+@timed("auto_continue")
+def run_auto_continue(uid):
+   session = session_memory.get(uid)
+   if session is None:
+       return
+
+   now = time.time()
+   last_time = session.get("last_active", now)
+   count = session.get("auto_continue_count", 0)
+
+
+   # 每个用户最多自动续说2次，且30秒未活跃
+   if count >= AUTO_CONTINUE_MAX:
+       return
+   if now - last_time < AUTO_CONTINUE_SILENCE:
+       auto_continue_scheduler.schedule(uid, last_time + AUTO_CONTINUE_SILENCE)
+       return
+
+
+   try:
+       history = session["history"]
+       context_compactor.apply(uid, history)
+       prompt = random.choice(AUTO_CONTINUE_TEMPLATES)
+       history.append({
+           "role": "system",
+           "content": f"用户沉默了，请你以温柔朋友的语气继续说一些话，参考这条提示：{prompt}"
+       })
+
+
+       reply = f"[auto] {get_reply(history)}"
+       history.append({"role": "assistant", "content": reply})
+
+
+       # 先记成待取，再推给在线连接：放进队列不等于送达（标签页可能刚断开），
+       # /events 真正写出这条后才清掉，否则留给重连补发或 /check_update 轮询取走
+       session["pending_auto_reply"] = reply
+       session["auto_continue_count"] = count + 1
+       session["last_active"] = now
+       session_memory.save(uid, session)
+       context_compactor.submit(uid, history)
+       push_hub.publish(uid, {"text": reply})
+
+
+       write_log(time.time(), uid, "[auto_continue]", reply, chat_type="auto_continue", elapsed=None)
+       print(f"[{uid}] 🤖 自动续说：{reply}")
+
+       # 还没用完次数就排下一次
+       if session["auto_continue_count"] < AUTO_CONTINUE_MAX:
+           auto_continue_scheduler.schedule(uid, now + AUTO_CONTINUE_SILENCE)
+   except Exception as e:
+       print(f"[{uid}] ❌ 自动续说失败: {e}")
+       auto_continue_scheduler.schedule(uid, time.time() + AUTO_CONTINUE_RETRY)
+
+
+
+
+auto_continue_scheduler = DeadlineScheduler(auto_continue_check, max_workers=AUTO_CONTINUE_WORKERS, name="auto-continue")
+
+
+
+
+@app.route("/scheduler/metrics", methods=["GET"])
+def scheduler_metrics():
+    return jsonify(auto_continue_scheduler.metrics())
+
+
+@app.route("/translation/stats", methods=["GET"])
+def translation_stats():
+    return jsonify(translator.stats())
+
+
+@app.route("/llm/stats", methods=["GET"])
+def llm_stats():
+    return jsonify(llm.stats())
+
+
+@app.route("/admission/stats", methods=["GET"])
+def admission_stats():
+    return jsonify({**admission.stats(), "coalescer": chat_coalescer.stats()})
 
 
+@app.route("/logs/stats", methods=["GET"])
+def log_stats():
+    return jsonify(chat_log.stats())
 
 
-def auto_continue_check():
-   while True:
-       time.sleep(10)
-       now = time.time()
-       for uid, session in list(session_memory.items()):
-           try:
-               last_time = session.get("last_active", now)
-               count = session.get("auto_continue_count", 0)
+@app.route("/sessions/stats", methods=["GET"])
+def session_stats():
+    return jsonify(session_memory.stats())
 
 
-               # 每个用户最多自动续说2次，且30秒未活跃
-               if now - last_time > 30 and count < 2:
-                   history = session["history"]
-                   prompt = random.choice(AUTO_CONTINUE_TEMPLATES)
-                   history.append({
-                       "role": "system",
-                       "content": f"用户沉默了，请你以温柔朋友的语气继续说一些话，参考这条提示：{prompt}"
-                   })
+# === Prometheus 指标：各阶段耗时直方图、错误 / 重试计数，以及下面这些即时值（METRICS_ENABLED=0 关闭计时）===
+metrics.gauge("active_sessions", lambda: session_memory.stats()["sessions"], "Sessions held in memory")
+metrics.gauge("llm_in_flight", lambda: llm.stats()["in_flight"], "Model calls currently in flight")
+metrics.gauge("llm_waiting", lambda: llm.stats()["waiting"], "Model calls waiting for a concurrency slot")
+metrics.gauge("admission_active", lambda: admission.stats()["active"], "Requests holding an admission slot")
+metrics.gauge("admission_waiting", lambda: admission.stats()["waiting"], "Requests queued for an admission slot")
+metrics.gauge("log_queue", lambda: chat_log.stats()["queued"], "Chat log records waiting to be written")
 
 
-                   reply = f"[auto] {get_reply(history)}"
-                   history.append({"role": "assistant", "content": reply})
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
-                   session["pending_auto_reply"] = reply
-                   session["auto_continue_count"] = count + 1
-                   session["last_active"] = now
+@app.route("/metrics/aggregate", methods=["GET"])
+def metrics_aggregate():
+    return jsonify(session_metrics.aggregate())
 
 
-                   write_log(time.time(), uid, "[auto_continue]", reply, chat_type="auto_continue", elapsed=None)
-                   print(f"[{uid}] 🤖 自动续说：{reply}")
-           except Exception as e:
-               print(f"[{uid}] ❌ 自动续说失败: {e}")
+@app.route("/metrics/session/<user_id>", methods=["GET"])
+def metrics_session(user_id):
+    snapshot = session_metrics.session(user_id)
+    if snapshot is None:
+        return jsonify({"error": "unknown session", "user_id": user_id}), 404
+    return jsonify(snapshot)
 
 
 
@@ -277,7 +648,7 @@ def test_connection():
 
 
 if __name__ == "__main__":
-    threading.Thread(target=auto_continue_check, daemon=True).start()
+    auto_continue_scheduler.start()
     app.run(host="0.0.0.0", port=5005, debug=False)
 
 
@@ -0,0 +1,217 @@
+import hashlib
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from utils.file_lock import FileLock
+
+
+class Overloaded(Exception):
+    """请求没能在限定时间内拿到执行名额，retry_after 是建议客户端等待的秒数。"""
+
+    def __init__(self, retry_after, reason="overloaded"):
+        super().__init__(f"{reason}, retry after {retry_after}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+# ========== 全局准入控制 ==========
+class AdmissionController:
+    """
+    同时最多放行 max_active 个请求（与模型网关的并发上限对齐），
+    其余最多 max_queue 个排队等待 queue_timeout 秒；队列已满或等待超时就抛 Overloaded，
+    由调用方返回 429 + Retry-After，让延迟保持有界，而不是所有请求一起拖到超时。
+    """
+
+    def __init__(self, max_active=8, max_queue=16, queue_timeout=5.0):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._service_avg = 2.0     # 单个请求平均耗时（秒），指数滑动平均
+        self.counters = {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0}
+
+    def retry_after(self):
+        # 按前面排着的请求数和平均耗时估算，至少 1 秒
+        backlog = self._waiting + 1
+        return max(1, math.ceil(self._service_avg * backlog / self.max_active))
+
+    def acquire(self):
+        with self._cond:
+            if self._active >= self.max_active:
+                if self._waiting >= self.max_queue:
+                    self.counters["rejected"] += 1
+                    raise Overloaded(self.retry_after())
+                self.counters["queued"] += 1
+                self._waiting += 1
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while self._active >= self.max_active:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.counters["timed_out"] += 1
+                            raise Overloaded(self.retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._active += 1
+            self.counters["admitted"] += 1
+        return time.monotonic()
+
+    def release(self, started=None):
+        with self._cond:
+            self._active -= 1
+            if started is not None:
+                self._service_avg = 0.8 * self._service_avg + 0.2 * (time.monotonic() - started)
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self):
+        started = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(started)
+
+    def stats(self):
+        with self._cond:
+            return dict(self.counters, active=self._active, waiting=self._waiting,
+                        max_active=self.max_active, max_queue=self.max_queue,
+                        service_avg=round(self._service_avg, 3))
+
+
+# ========== 每个会话串行 ==========
+class SessionLocks:
+    """
+    每个 user_id 一把锁，同一会话的请求（包括自动续说）依次修改 history。没人用的锁会被回收。
+    给了 lock_dir 时（多个 worker 进程共用 SQLite 会话库），拿到进程内的锁后再占 lock_dir 下的锁文件，
+    跨进程也是串行的。锁文件按 user_id 的哈希分成 stripes 个，不会随用户数增长；
+    不同用户偶尔撞到同一个文件只是多等一会儿。进程退出时操作系统会释放它占着的锁文件。
+    """
+
+    def __init__(self, timeout=30.0, lock_dir=None, stripes=1024):
+        self.timeout = timeout
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self._locks = {}    # user_id -> [锁, 引用数, 锁文件]
+        self._lock = threading.Lock()
+
+    def _lock_file(self, user_id):
+        stripe = int(hashlib.sha1(str(user_id).encode("utf-8")).hexdigest(), 16) % self.stripes
+        return FileLock(os.path.join(self.lock_dir, f"{stripe:04d}.lock"))
+
+    def acquire(self, user_id, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        give_up = time.monotonic() + timeout
+        with self._lock:
+            entry = self._locks.setdefault(user_id, [threading.Lock(), 0, None])
+            entry[1] += 1
+        if not entry[0].acquire(timeout=timeout):
+            self._unref(user_id)
+            return False
+        if self.lock_dir is None:
+            return True
+        file_lock = self._lock_file(user_id)
+        if file_lock.acquire(blocking=timeout > 0, poll=0.05, timeout=max(0.0, give_up - time.monotonic())):
+            entry[2] = file_lock
+            return True
+        entry[0].release()
+        self._unref(user_id)
+        return False
+
+    def release(self, user_id):
+        with self._lock:
+            entry = self._locks[user_id]
+        if entry[2] is not None:
+            entry[2].release()
+            entry[2] = None
+        entry[0].release()
+        self._unref(user_id)
+
+    def _unref(self, user_id):
+        with self._lock:
+            entry = self._locks[user_id]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    @contextmanager
+    def hold(self, user_id):
+        if not self.acquire(user_id):
+            raise Overloaded(1, reason="session busy")
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+
+# ========== 合并重复请求 ==========
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RequestCoalescer:
+    """
+    相同 key 的请求在途时只执行一次，后到的直接等同一个结果（双击、客户端重试）。
+    带幂等键的请求完成后结果再保留 ttl 秒，同一个键再来直接返回原结果。出错的结果不缓存。
+    """
+
+    def __init__(self, ttl=300, max_items=10000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._inflight = {}
+        self._completed = {}    # key -> (完成时间, 结果)
+        self._lock = threading.Lock()
+        self.counters = {"executed": 0, "coalesced": 0, "replayed": 0}
+
+    def _expire(self, now):
+        cutoff = now - self.ttl
+        for key in [k for k, (ts, _) in self._completed.items() if ts < cutoff]:
+            del self._completed[key]
+        while len(self._completed) > self.max_items:
+            self._completed.pop(next(iter(self._completed)))
+
+    def run(self, key, fn, remember=False):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            if key in self._completed:
+                self.counters["replayed"] += 1
+                return self._completed[key][1]
+            call = self._inflight.get(key)
+            owner = call is None
+            if owner:
+                call = self._inflight[key] = _Call()
+                self.counters["executed"] += 1
+            else:
+                self.counters["coalesced"] += 1
+
+        if not owner:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                if remember and call.error is None:
+                    self._completed[key] = (time.time(), call.result)
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, inflight=len(self._inflight), remembered=len(self._completed))
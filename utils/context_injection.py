@@ -0,0 +1,182 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+KNOWLEDGE_MARK = "以下是知识库背景信息"
+
+
+def normalize_query(text):
+    return re.sub(r"\s+", " ", str(text)).strip().lower()
+
+
+def format_knowledge(entries):
+    combined = "\n\n---\n\n".join(f"Q: {e['question']}\nA: {e['answer']}" for e in entries)
+    return f"{KNOWLEDGE_MARK}，请在回答中参考但不要重复内容：\n\n{combined}"
+
+
+def find_knowledge_slot(history):
+    for i, m in enumerate(history):
+        if m.get("role") == "system" and m.get("content", "").startswith(KNOWLEDGE_MARK):
+            return i
+    return None
+
+
+# ========== 检索结果缓存 ==========
+class QueryCache:
+    """
+    检索结果缓存：先按规范化后的原文精确匹配（命中时连翻译和编码都省掉），
+    再按查询向量找余弦相似度不低于 similarity 的近似重复查询（省掉 FAISS 检索）。
+    条目 ttl 秒后过期，超过 max_items 按 LRU 淘汰；索引版本（generation）变化时整体清空。
+    """
+
+    def __init__(self, ttl=600, max_items=1024, similarity=0.95):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.similarity = similarity
+        self._entries = OrderedDict()    # 规范化文本 -> (时间, 单位向量, 结果)
+        self._matrix = None
+        self._keys = []
+        self._generation = None
+        self._lock = threading.Lock()
+        self.counters = {"exact_hits": 0, "near_hits": 0, "misses": 0}
+
+    def _check_generation(self, generation):
+        if generation != self._generation:
+            self._entries.clear()
+            self._matrix = None
+            self._generation = generation
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        expired = [k for k, (ts, _, _) in self._entries.items() if ts < cutoff]
+        for k in expired:
+            del self._entries[k]
+        if expired:
+            self._matrix = None
+
+    def get_text(self, text, generation=None):
+        key = normalize_query(text)
+        with self._lock:
+            self._check_generation(generation)
+            self._expire()
+            hit = self._entries.get(key)
+            if hit is None:
+                return None
+            self._entries.move_to_end(key)
+            self.counters["exact_hits"] += 1
+            return hit[2]
+
+    def get_vector(self, vector, generation=None):
+        vector = _unit(vector)
+        with self._lock:
+            self._check_generation(generation)
+            self._expire()
+            if not self._entries:
+                self.counters["misses"] += 1
+                return None
+            if self._matrix is None:
+                self._keys = list(self._entries)
+                self._matrix = np.vstack([self._entries[k][1] for k in self._keys])
+            sims = self._matrix @ vector
+            best = int(np.argmax(sims))
+            if sims[best] < self.similarity:
+                self.counters["misses"] += 1
+                return None
+            key = self._keys[best]
+            self._entries.move_to_end(key)
+            self.counters["near_hits"] += 1
+            return self._entries[key][2]
+
+    def put(self, text, vector, entries, generation=None):
+        key = normalize_query(text)
+        with self._lock:
+            self._check_generation(generation)
+            self._entries[key] = (time.time(), _unit(vector), entries)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self._entries)
+        lookups = stats["exact_hits"] + stats["near_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["exact_hits"] + stats["near_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+# ========== 知识库背景注入 ==========
+class ContextInjector:
+    """
+    往 history 里维护唯一一条知识库背景消息（紧跟在人设之后）。
+    已经注入过且还没到刷新轮次时直接返回，不做任何翻译、编码和检索；
+    到了刷新轮次就重新检索，内容有变化时原地替换那条消息，不会越插越多。
+    refresh_every=0 表示只在第一次注入，之后不再刷新。
+
+    encode(text) 返回查询向量，search(vector, top_k) 返回问答对列表，
+    generation() 返回当前索引版本，版本变化时缓存失效。
+    """
+
+    def __init__(self, encode, search, generation=lambda: None, cache=None, top_k=3, refresh_every=3):
+        self.encode = encode
+        self.search = search
+        self.generation = generation
+        self.cache = cache or QueryCache()
+        self.top_k = top_k
+        self.refresh_every = refresh_every
+        self._turns = {}    # 会话 -> 距上次检索过了几轮
+        self.counters = {"skipped": 0, "retrieved": 0, "inserted": 0, "refreshed": 0}
+
+    def retrieve(self, text):
+        generation = self.generation()
+        entries = self.cache.get_text(text, generation)
+        if entries is not None:
+            return entries
+        vector = self.encode(text)
+        entries = self.cache.get_vector(vector, generation)
+        if entries is None:
+            entries = self.search(vector, self.top_k)
+            self.cache.put(text, vector, entries, generation)
+        return entries
+
+    def __call__(self, user_text, history, session="default"):
+        """按需检索并写入 history，返回 history 里是否已有知识库背景。"""
+        slot = find_knowledge_slot(history)
+        if slot is not None:
+            turns = self._turns.get(session, 0) + 1
+            if not self.refresh_every or turns < self.refresh_every:
+                self._turns[session] = turns
+                self.counters["skipped"] += 1
+                return True
+
+        self._turns[session] = 0
+        self.counters["retrieved"] += 1
+        entries = self.retrieve(user_text)
+        if not entries:
+            return slot is not None
+
+        message = {"role": "system", "content": format_knowledge(entries)}
+        if slot is None:
+            history.insert(1, message)
+            self.counters["inserted"] += 1
+        elif history[slot]["content"] != message["content"]:
+            history[slot] = message
+            self.counters["refreshed"] += 1
+        return True
+
+    def forget(self, session):
+        self._turns.pop(session, None)
+
+    def stats(self):
+        return dict(self.counters, cache=self.cache.stats())
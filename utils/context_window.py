@@ -0,0 +1,245 @@
+import queue
+import re
+import threading
+
+
+AUTO_CONTINUE_MARK = "用户沉默了"
+SUMMARY_MARK = "以下是之前对话的摘要"
+
+# 从小到大排列，优先用便宜的小窗口模型
+MODEL_CONTEXT_LIMITS = [
+    ("moonshot-v1-8k", 8192),
+    ("moonshot-v1-32k", 32768),
+    ("moonshot-v1-128k", 131072),
+]
+
+_CJK = re.compile(r"[　-〿㐀-䶿一-鿿＀-￯]")
+
+
+# ========== token 估算 ==========
+def estimate_tokens(text):
+    # 中文及全角标点按 1 字 1 token 计（偏保守），其余按 4 字符 1 token 计
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(messages):
+    # 每条消息额外算上角色等格式开销
+    return sum(estimate_tokens(m.get("content", "")) + 4 for m in messages)
+
+
+def pick_model(prompt_tokens, max_tokens, safety=0.9):
+    needed = prompt_tokens + max_tokens
+    for model, limit in MODEL_CONTEXT_LIMITS:
+        if needed <= limit * safety:
+            return model
+    return MODEL_CONTEXT_LIMITS[-1][0]
+
+
+def is_auto_continue_note(message):
+    return message.get("role") == "system" and message.get("content", "").startswith(AUTO_CONTINUE_MARK)
+
+
+def is_summary(message):
+    return message.get("role") == "system" and message.get("content", "").startswith(SUMMARY_MARK)
+
+
+# ========== 摘要 ==========
+def make_summarizer(client, model="moonshot-v1-8k", max_chars=400):
+    def summarize(previous_summary, messages):
+        lines = []
+        if previous_summary:
+            lines.append(f"【之前的摘要】{previous_summary}")
+        for m in messages:
+            speaker = "用户" if m["role"] == "user" else "Kimi"
+            lines.append(f"{speaker}：{m['content']}")
+
+        res = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": (
+                    f"请把下面的聊天记录压缩成一段不超过{max_chars}字的中文摘要，"
+                    "保留用户的处境、情绪变化、提到的关键人和事以及已经聊过的话题，不要评价，不要输出任何其他内容。"
+                )},
+                {"role": "user", "content": "\n".join(lines)}
+            ],
+            temperature=0.3,
+        )
+        return res.choices[0].message.content.strip()
+
+    return summarize
+
+
+# ========== 上下文窗口 ==========
+class ContextWindow:
+    """
+    控制每次发给模型的上下文长度：开头的 system 消息（人设、知识库背景、摘要）固定保留，
+    最近 keep_turns 轮原样保留，更早的轮次滚动压缩进一条摘要消息并写回 history，
+    所以摘要只在旧轮次累积到一定数量时才重新生成一次。只有最后一条自动续说提示会被发出去。
+    prepare 只读 history 里现有的摘要，不调用模型；摘要由 BackgroundCompactor 在回复之后生成。
+    """
+
+    def __init__(self, summarize=None, keep_turns=6, max_prompt_tokens=6000, compact_every=None):
+        self.summarize = summarize
+        self.keep_turns = keep_turns
+        self.max_prompt_tokens = max_prompt_tokens
+        # 旧轮次攒够这么多轮才折叠一次，避免每轮都调用摘要
+        self.compact_every = compact_every or keep_turns
+
+    @staticmethod
+    def _split(history):
+        pinned = 0
+        while pinned < len(history) and history[pinned]["role"] == "system" \
+                and not is_auto_continue_note(history[pinned]):
+            pinned += 1
+        return history[:pinned], history[pinned:]
+
+    def _window_start(self, rest, keep_turns):
+        # 从倒数第 keep_turns 条用户消息处切开
+        seen = 0
+        for i in range(len(rest) - 1, -1, -1):
+            if rest[i]["role"] == "user":
+                seen += 1
+                if seen == keep_turns:
+                    return i
+        return 0
+
+    def plan(self, history):
+        """
+        挑出窗口之外、该折叠进摘要的旧轮次，不调用模型。不需要折叠时返回 None。
+        返回的是快照：之后 history 被追加或改写，apply 时会核对这些旧轮次还在原处。
+        """
+        if self.summarize is None:
+            return None
+
+        pinned, rest = self._split(history)
+        user_turns = sum(1 for m in rest if m["role"] == "user")
+        if user_turns < self.keep_turns + self.compact_every:
+            return None
+
+        start = self._window_start(rest, self.keep_turns)
+        older = [m for m in rest[:start] if m["role"] in ("user", "assistant")]
+        if not older:
+            return None
+
+        summary_msg = next((m for m in pinned if is_summary(m)), None)
+        return {
+            "previous": summary_msg["content"][len(SUMMARY_MARK) + 1:] if summary_msg else "",
+            "older": [dict(m) for m in older],
+            "folded": [dict(m) for m in rest[:start]],
+        }
+
+    def run_plan(self, plan):
+        """调用摘要模型，返回摘要文本；失败返回 None（下次再试，期间只截断不压缩）。"""
+        try:
+            return self.summarize(plan["previous"], plan["older"])
+        except Exception as e:
+            print("⚠️ 对话摘要失败，本轮只截断不压缩：", str(e))
+            return None
+
+    def apply(self, history, plan, summary):
+        """把摘要写回 history（原地修改）。被折叠的旧轮次已经不在原处（例如会话被清空过）时放弃，返回是否写回。"""
+        pinned, rest = self._split(history)
+        folded = plan["folded"]
+        if summary is None or rest[:len(folded)] != folded:
+            return False
+
+        summary_msg = {"role": "system", "content": f"{SUMMARY_MARK}：{summary}"}
+        summary_idx = next((i for i, m in enumerate(pinned) if is_summary(m)), None)
+        if summary_idx is not None:
+            pinned[summary_idx] = summary_msg
+        else:
+            pinned.append(summary_msg)
+        history[:] = pinned + rest[len(folded):]
+        return True
+
+    def compact(self, history):
+        """同步地把窗口之外的旧轮次折叠进摘要消息（原地修改 history），返回是否发生了折叠。"""
+        plan = self.plan(history)
+        if plan is None:
+            return False
+        return self.apply(history, plan, self.run_plan(plan))
+
+    def build(self, history, max_tokens=200):
+        """返回 (本次要发送的消息列表, 选用的模型)，不修改 history。"""
+        pinned, rest = self._split(history)
+
+        # 只保留末尾那条（当前这次）自动续说提示，之前的都是过期指令
+        rest = [m for i, m in enumerate(rest) if not is_auto_continue_note(m) or i == len(rest) - 1]
+
+        window = rest[self._window_start(rest, self.keep_turns):]
+        budget = self.max_prompt_tokens - count_message_tokens(pinned)
+        while len(window) > 1 and count_message_tokens(window) > budget:
+            window = window[1:]
+
+        messages = pinned + window
+        return messages, pick_model(count_message_tokens(messages), max_tokens)
+
+    def prepare(self, history, max_tokens=200):
+        # 只读已经写回 history 的摘要；生成摘要交给 BackgroundCompactor，在回复发出之后做
+        return self.build(history, max_tokens)
+
+
+# ========== 后台摘要 ==========
+class BackgroundCompactor:
+    """
+    回复发出之后再压缩上下文：submit 在调用方手里取一份快照，单个后台线程调用摘要模型；
+    摘要生成好先放着，等调用方下一轮组装上下文前用 apply 写回。history 只在调用方自己的线程
+    （或会话锁）里修改，后台线程从不碰它，也就不用和知识库注入、追加新消息抢着改。
+    同一个 key 同时只有一个摘要在生成或等待写回。
+    """
+
+    def __init__(self, window, max_queue=1000, name="context-compaction"):
+        self.window = window
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._busy = set()      # 排队中、生成中或等待写回的 key
+        self._ready = {}        # key -> (plan, summary)
+        self._dropped = set()   # 生成期间被 discard 的 key
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, key, history):
+        """需要折叠时把快照交给后台线程，返回是否提交。"""
+        with self._lock:
+            if key in self._busy:
+                return False
+            plan = self.window.plan(history)
+            if plan is None:
+                return False
+            try:
+                self._queue.put_nowait((key, plan))
+            except queue.Full:
+                return False
+            self._busy.add(key)
+            return True
+
+    def apply(self, key, history):
+        """有已经生成好的摘要就写回 history，返回是否修改了 history。"""
+        with self._lock:
+            if key not in self._ready:
+                return False
+            plan, summary = self._ready.pop(key)
+            self._busy.discard(key)
+        return self.window.apply(history, plan, summary)
+
+    def discard(self, key):
+        # 会话被淘汰时丢掉它还没写回的摘要；还在排队或生成中的，生成完直接丢弃
+        with self._lock:
+            if self._ready.pop(key, None) is not None:
+                self._busy.discard(key)
+            elif key in self._busy:
+                self._dropped.add(key)
+
+    def _loop(self):
+        while True:
+            key, plan = self._queue.get()
+            summary = self.window.run_plan(plan)
+            with self._lock:
+                if summary is None or key in self._dropped:
+                    self._busy.discard(key)
+                    self._dropped.discard(key)
+                else:
+                    self._ready[key] = (plan, summary)
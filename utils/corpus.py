@@ -0,0 +1,95 @@
+import json
+import mmap
+import os
+from array import array
+
+import numpy as np
+
+from utils.preprocess import iter_esconv_pairs
+
+
+def compiled_paths(prefix):
+    return prefix + ".blob", prefix + ".offsets.npy", prefix + ".meta.json"
+
+
+def source_stamp(json_path):
+    st = os.stat(json_path)
+    return {"source": os.path.abspath(json_path), "size": st.st_size, "mtime": st.st_mtime}
+
+
+def compile_corpus(json_path, prefix):
+    """
+    把 ESConv.json 编译成「UTF-8 数据块 + 偏移表」：第 i 条问答对是 blob[offsets[i]:offsets[i+1]]，
+    内容是 JSON 数组 [question, answer]。逐条流式写出，编号与 load_esconv 的顺序一致，也就是 FAISS 里的 id。
+    """
+    blob_path, offsets_path, meta_path = compiled_paths(prefix)
+    offsets = array("Q", [0])
+    with open(blob_path + ".tmp", "wb") as f:
+        for p in iter_esconv_pairs(json_path):
+            data = json.dumps([p["question"], p["answer"]], ensure_ascii=False).encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    count = len(offsets) - 1
+
+    with open(offsets_path + ".tmp", "wb") as f:
+        np.save(f, np.frombuffer(offsets, dtype=np.uint64))
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(dict(source_stamp(json_path), count=count), f, ensure_ascii=False)
+
+    # 元数据最后替换，读的一方以它为准判断是否已编译完成
+    os.replace(blob_path + ".tmp", blob_path)
+    os.replace(offsets_path + ".tmp", offsets_path)
+    os.replace(meta_path + ".tmp", meta_path)
+    print(f"✅ 语料已编译：{count} 条问答对 → {blob_path}")
+    return count
+
+
+def is_compiled(json_path, prefix):
+    _, _, meta_path = compiled_paths(prefix)
+    if not os.path.exists(meta_path):
+        return False
+    if not os.path.exists(json_path):
+        return True
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    stamp = source_stamp(json_path)
+    return meta.get("size") == stamp["size"] and meta.get("mtime") == stamp["mtime"]
+
+
+class MappedCorpus:
+    """按 id 随机读取问答对，数据块与偏移表都是内存映射，常驻内存与语料大小无关。"""
+
+    def __init__(self, prefix):
+        blob_path, offsets_path, _ = compiled_paths(prefix)
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+        self._file = open(blob_path, "rb")
+        size = os.path.getsize(blob_path)
+        self._blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(idx)
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        question, answer = json.loads(self._blob[start:end].decode("utf-8"))
+        return {"question": question, "answer": answer}
+
+    def close(self):
+        if isinstance(self._blob, mmap.mmap):
+            self._blob.close()
+        self._file.close()
+
+
+def load_corpus(json_path, prefix=None):
+    # 第一次（或 ESConv.json 变了之后）编译一次，之后直接映射
+    prefix = prefix or os.path.splitext(json_path)[0] + "_corpus"
+    if not is_compiled(json_path, prefix):
+        compile_corpus(json_path, prefix)
+    return MappedCorpus(prefix)
+
+
+if __name__ == "__main__":
+    compile_corpus("Data/ESConv.json", "Data/ESConv_corpus")
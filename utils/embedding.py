@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from utils.embedding_cache import EmbeddingCache, DEFAULT_CACHE_DIR
+from utils.instrumentation import timed
+
+
+_models = {}
+_services = {}
+_lock = threading.Lock()
+_service_lock = threading.Lock()
+
+
+def get_model(model_name):
+    # 同一个进程里每个模型只加载一次
+    with _lock:
+        model = _models.get(model_name)
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+            model = SentenceTransformer(model_name)
+            _models[model_name] = model
+        return model
+
+
+def as_float32(embeddings):
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+class EmbeddingService:
+    """
+    共享一个模型实例的编码服务。多个线程（多个会话）同时调用 encode 时，
+    后台线程把 max_wait 秒内到达的请求拼成一批（最多 max_batch_size 条）一起编码，再按请求拆回去。
+    单次就已经够一整批的调用直接编码，不进队列。
+    传入 cache_dir 时先查持久化向量缓存，只编码没见过的文本。
+    """
+
+    def __init__(self, model_name, max_batch_size=64, max_wait=0.005, cache_dir=None):
+        self.model_name = model_name
+        self.model = get_model(model_name)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache = EmbeddingCache(model_name, self.dimension, cache_dir) if cache_dir else None
+
+        self._pending = []
+        self._cond = threading.Condition()
+        self.counters = {"requests": 0, "batches": 0, "texts": 0}
+        self._thread = threading.Thread(target=self._loop, name=f"embed-{model_name}", daemon=True)
+        self._thread.start()
+
+    @property
+    def dimension(self):
+        return self.model.get_sentence_embedding_dimension()
+
+    @timed("encoding")
+    def encode(self, texts, show_progress_bar=False):
+        if isinstance(texts, str):
+            texts = [texts]
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+
+        if self.cache is None:
+            return self._encode(texts, show_progress_bar)
+
+        embeddings, missing = self.cache.get_many(texts)
+        if missing:
+            todo = list(dict.fromkeys(texts[i] for i in missing))
+            fresh = self._encode(todo, show_progress_bar)
+            rows = {text: row for row, text in enumerate(todo)}
+            embeddings[missing] = fresh[[rows[texts[i]] for i in missing]]
+            self.cache.put_many(todo, fresh)
+        return embeddings
+
+    def _encode(self, texts, show_progress_bar=False):
+        if len(texts) >= self.max_batch_size:
+            with self._cond:
+                self.counters["requests"] += 1
+                self.counters["batches"] += 1
+                self.counters["texts"] += len(texts)
+            return as_float32(self.model.encode(texts, batch_size=self.max_batch_size,
+                                                show_progress_bar=show_progress_bar))
+
+        future = Future()
+        with self._cond:
+            self._pending.append((texts, future))
+            self.counters["requests"] += 1
+            self._cond.notify()
+        return future.result()
+
+    # ========== 微批处理 ==========
+    def _take_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = time.time() + self.max_wait
+            while sum(len(t) for t, _ in self._pending) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, size = [], 0
+            while self._pending and (not batch or size + len(self._pending[0][0]) <= self.max_batch_size):
+                texts, future = self._pending.pop(0)
+                batch.append((texts, future))
+                size += len(texts)
+            self.counters["batches"] += 1
+            self.counters["texts"] += size
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._take_batch()
+            all_texts = [t for texts, _ in batch for t in texts]
+            try:
+                embeddings = as_float32(self.model.encode(all_texts, batch_size=self.max_batch_size))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            offset = 0
+            for texts, future in batch:
+                future.set_result(embeddings[offset:offset + len(texts)].copy())
+                offset += len(texts)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self.counters)
+            stats["pending"] = len(self._pending)
+        stats["avg_batch"] = round(stats["texts"] / stats["batches"], 2) if stats["batches"] else 0.0
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+
+def get_embedding_service(model_name, max_batch_size=None, max_wait=None):
+    with _service_lock:
+        service = _services.get(model_name)
+        if service is None:
+            # EMBED_CACHE=0 关闭持久化向量缓存
+            use_cache = os.getenv("EMBED_CACHE", "1") != "0"
+            service = EmbeddingService(
+                model_name,
+                max_batch_size=max_batch_size or int(os.getenv("EMBED_MAX_BATCH", "64")),
+                max_wait=max_wait if max_wait is not None else float(os.getenv("EMBED_MAX_WAIT_MS", "5")) / 1000,
+                cache_dir=os.getenv("EMBED_CACHE_DIR", DEFAULT_CACHE_DIR) if use_cache else None,
+            )
+            _services[model_name] = service
+        return service
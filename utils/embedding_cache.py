@@ -0,0 +1,150 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Data", "embedding_cache")
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    持久化的向量缓存：每个模型一个目录，vectors.f32 是按行追加的 float32 矩阵（memmap 读写），
+    index.sqlite3 记录 文本哈希 → 行号。分配行号在 SQLite 写锁里完成，多个进程可以共用同一份缓存。
+    """
+
+    def __init__(self, model_name, dimension, cache_dir=DEFAULT_CACHE_DIR, grow_rows=4096):
+        self.model_name = model_name
+        self.dimension = dimension
+        self.grow_rows = grow_rows
+        self.dir = os.path.join(cache_dir, re.sub(r"[^\w.-]+", "_", model_name))
+        os.makedirs(self.dir, exist_ok=True)
+        self.vectors_path = os.path.join(self.dir, "vectors.f32")
+        self.index_path = os.path.join(self.dir, "index.sqlite3")
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._mm = None
+        self.counters = {"hits": 0, "misses": 0}
+
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS vectors (hash TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('dimension', ?)", (str(dimension),))
+        stored = int(conn.execute("SELECT value FROM meta WHERE key = 'dimension'").fetchone()[0])
+        if stored != dimension:
+            raise ValueError(f"缓存 {self.dir} 的向量维度是 {stored}，与模型的 {dimension} 不一致")
+        if not os.path.exists(self.vectors_path):
+            open(self.vectors_path, "wb").close()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    # ========== memmap ==========
+    def _capacity(self):
+        return os.path.getsize(self.vectors_path) // (4 * self.dimension)
+
+    def _map(self, min_rows):
+        # 文件被（本进程或别的进程）扩容后重新映射
+        if self._mm is None or self._mm.shape[0] < min_rows:
+            rows = self._capacity()
+            if rows == 0:
+                return None
+            self._mm = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(rows, self.dimension))
+        return self._mm
+
+    def _ensure_capacity(self, rows):
+        capacity = self._capacity()
+        if capacity >= rows:
+            return
+        new_rows = max(rows, capacity + self.grow_rows)
+        # 先解除本进程的映射再改文件大小：Windows 上不允许对已映射的文件 truncate；_map 随后会重新映射
+        if self._mm is not None:
+            self._mm.flush()
+            mm, self._mm = self._mm, None
+            del mm
+        with open(self.vectors_path, "r+b") as f:
+            f.truncate(new_rows * 4 * self.dimension)
+
+    # ========== 读写 ==========
+    def get_many(self, texts):
+        """返回 (与 texts 对齐的向量矩阵, 未命中的下标列表)；未命中的行为 0。"""
+        hashes = [text_hash(t) for t in texts]
+        found = {}
+        conn = self._conn()
+        unique = list(dict.fromkeys(hashes))
+        for i in range(0, len(unique), 500):
+            chunk = unique[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            for h, row in conn.execute(f"SELECT hash, row FROM vectors WHERE hash IN ({marks})", chunk):
+                found[h] = row
+
+        out = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        missing = []
+        with self._lock:
+            if found:
+                mm = self._map(max(found.values()) + 1)
+            for i, h in enumerate(hashes):
+                row = found.get(h)
+                if row is None:
+                    missing.append(i)
+                else:
+                    out[i] = mm[row]
+            self.counters["hits"] += len(texts) - len(missing)
+            self.counters["misses"] += len(missing)
+        return out, missing
+
+    def put_many(self, texts, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        items = {}
+        for text, vec in zip(texts, vectors):
+            items.setdefault(text_hash(text), vec)
+
+        conn = self._conn()
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                hashes = list(items)
+                existing = set()
+                for i in range(0, len(hashes), 500):
+                    chunk = hashes[i:i + 500]
+                    marks = ",".join("?" * len(chunk))
+                    existing.update(r[0] for r in conn.execute(f"SELECT hash FROM vectors WHERE hash IN ({marks})", chunk))
+                new = [h for h in hashes if h not in existing]
+                if not new:
+                    conn.execute("COMMIT")
+                    return
+
+                start = conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM vectors").fetchone()[0]
+                self._ensure_capacity(start + len(new))
+                mm = self._map(start + len(new))
+                for offset, h in enumerate(new):
+                    mm[start + offset] = items[h]
+                mm.flush()
+                conn.executemany("INSERT INTO vectors (hash, row) VALUES (?, ?)",
+                                 [(h, start + offset) for offset, h in enumerate(new)])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats["rows"] = len(self)
+        return stats
@@ -0,0 +1,66 @@
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    """
+    进程间的排他锁文件：POSIX 用 fcntl.flock，Windows 用 msvcrt.locking。
+    进程退出时操作系统会自动释放，不会留下需要手动清理的死锁。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+
+    def acquire(self, blocking=True, poll=0.1, timeout=None):
+        """拿到锁返回 True；blocking=False 或等了 timeout 秒仍被别的进程（或本进程另一个 FileLock）占用时返回 False。"""
+        if self._f is not None:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        f = open(self.path, "a+")
+        give_up = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except OSError:
+                if not blocking or (give_up is not None and time.monotonic() >= give_up):
+                    f.close()
+                    return False
+                time.sleep(poll if give_up is None else max(0.0, min(poll, give_up - time.monotonic())))
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+        self._f = f
+        return True
+
+    def release(self):
+        if self._f is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+            else:
+                self._f.seek(0)
+                msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,349 @@
+import csv
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import faiss
+import numpy as np
+
+from utils.corpus import load_corpus
+from utils.file_lock import FileLock
+from utils.instrumentation import timed
+from utils.embedding import get_embedding_service
+from utils.vector_index import (MULTILINGUAL_INDEX_PATH, MULTILINGUAL_MODEL, load_index_meta, meta_path,
+                                save_index_meta, set_search_params, search_index)
+
+
+# ========== 版本指针：<index>.current 里记着当前生效的索引文件名 ==========
+def pointer_path(index_path):
+    return index_path + ".current"
+
+
+def resolve_index_path(index_path):
+    pointer = pointer_path(index_path)
+    if not os.path.exists(pointer):
+        return index_path
+    with open(pointer, "r", encoding="utf-8") as f:
+        name = f.read().strip()
+    return os.path.join(os.path.dirname(index_path), name)
+
+
+def publish_version(index, meta, index_path):
+    # 新版本写到独立文件，最后用 os.replace 原子地切换指针，正在读旧版本的进程不受影响
+    version = meta.get("version", 0) + 1
+    stem, ext = os.path.splitext(index_path)
+    path = f"{stem}.v{version}{ext}"
+    meta = dict(meta, version=version, count=index.ntotal)
+    faiss.write_index(index, path)
+    save_index_meta(path, meta)
+
+    pointer = pointer_path(index_path)
+    with open(pointer + ".tmp", "w", encoding="utf-8") as f:
+        f.write(os.path.basename(path))
+    os.replace(pointer + ".tmp", pointer)
+    prune_versions(index_path, keep_from=version - 1)
+    return path, meta
+
+
+def prune_versions(index_path, keep_from):
+    """
+    删掉版本号小于 keep_from 的 .vN 索引和元数据。每个版本都是完整的一份索引，不删磁盘会一直涨；
+    上一个版本先留着，检索进程可能还在加载它。不带版本号的原始索引不动。
+    """
+    stem, ext = os.path.splitext(index_path)
+    folder = os.path.dirname(index_path) or "."
+    pattern = re.compile(re.escape(os.path.basename(stem)) + r"\.v(\d+)" + re.escape(ext) + "$")
+    for name in os.listdir(folder):
+        match = pattern.match(name)
+        if match and int(match.group(1)) < keep_from:
+            path = os.path.join(folder, name)
+            for stale in (path, meta_path(path)):
+                if os.path.exists(stale):
+                    os.remove(stale)
+
+
+# ========== 新增语料：追加写的 JSONL，删除也是追加一条墓碑 ==========
+class IngestStore:
+    def __init__(self, path="Data/ingested_pairs.jsonl"):
+        self.path = path
+        self.pairs = {}
+        self.tombstones = set()
+        self.fingerprints = {}
+        self.max_id = -1
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        self._apply(json.loads(line))
+
+    @staticmethod
+    def fingerprint(question, answer):
+        return hashlib.sha256(f"{question}\n{answer}".encode("utf-8")).hexdigest()
+
+    def _apply(self, record):
+        if record.get("deleted"):
+            self.tombstones.add(record["id"])
+            return
+        self.pairs[record["id"]] = record
+        self.fingerprints[self.fingerprint(record["question"], record["answer"])] = record["id"]
+        self.max_id = max(self.max_id, record["id"])
+
+    def _append(self, records):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        for record in records:
+            self._apply(record)
+
+    def add(self, pairs, first_id, source="chat_logs"):
+        """写入新的问答对（跳过已有的），返回 [(id, question)]，id 从 first_id 起单调递增、不复用。"""
+        records, next_id, seen = [], max(first_id, self.max_id + 1), set()
+        for p in pairs:
+            fp = self.fingerprint(p["question"], p["answer"])
+            if fp in seen or (fp in self.fingerprints and self.fingerprints[fp] not in self.tombstones):
+                continue
+            seen.add(fp)
+            records.append({"id": next_id, "question": p["question"], "answer": p["answer"],
+                            "source": source, "ts": time.time()})
+            next_id += 1
+        self._append(records)
+        return [(r["id"], r["question"]) for r in records]
+
+    def delete(self, ids):
+        self._append([{"id": int(i), "deleted": True, "ts": time.time()} for i in ids])
+
+    def get(self, idx):
+        if idx in self.tombstones:
+            return None
+        return self.pairs.get(idx)
+
+
+# ========== 从对话日志里挑高分、脱敏的问答对 ==========
+_PII_PATTERNS = [
+    (re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+"), "[邮箱]"),
+    (re.compile(r"https?://\S+"), "[链接]"),
+    (re.compile(r"(?<!\d)1[3-9]\d{9}(?!\d)"), "[手机号]"),
+    (re.compile(r"\d{6,}"), "[数字]"),
+]
+
+
+def anonymize(text):
+    text = re.sub(r"^\[(reply|auto|自动续说)\]\s*", "", str(text).strip())
+    text = re.sub(r"\s*\[auto\]\s*", " ", text)
+    for pattern, repl in _PII_PATTERNS:
+        text = pattern.sub(repl, text)
+    return text.strip()
+
+
+def pairs_from_ratings(ratings_csv, min_score=8.0):
+    # ai_ratings.csv 里三项分数都不低于 min_score 的轮次
+    pairs = []
+    with open(ratings_csv, "r", encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            try:
+                scores = [float(row[k]) for k in ("Empathy_Current", "Appropriateness_Current", "Relevance_Current")]
+            except (KeyError, ValueError):
+                continue
+            if min(scores) < min_score:
+                continue
+            question, answer = anonymize(row["Context"]), anonymize(row["AI_Response"])
+            if question and answer and question != "[auto_continue]":
+                pairs.append({"question": question, "answer": answer})
+    return pairs
+
+
+# ========== 增量写入索引 ==========
+def ensure_id_map(index):
+    """
+    让索引支持 add_with_ids：IVF 本身支持；其他类型换成 IndexIDMap2，已有向量的 id 就是行号。
+    IndexIDMap2 只能包空索引，所以第一次转换时要把向量取出来重新加一遍（之后的版本都已是 IDMap2）。
+    """
+    if isinstance(index, (faiss.IndexIVF, faiss.IndexIDMap2)):
+        return index
+    vectors = index.reconstruct_n(0, index.ntotal)
+    empty = faiss.clone_index(index)
+    empty.reset()
+    wrapped = faiss.IndexIDMap2(empty)
+    wrapped.add_with_ids(vectors, np.arange(index.ntotal, dtype=np.int64))
+    return wrapped
+
+
+def supports_remove(index):
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    return not isinstance(inner, faiss.IndexHNSW)
+
+
+def needs_translation(meta):
+    # 英文索引（translate 检索模式）检索时查询先翻译成英文，写入的问句也要先翻译再编码
+    return meta.get("model") != MULTILINGUAL_MODEL
+
+
+def ingest(pairs=(), delete_ids=(), index_path=MULTILINGUAL_INDEX_PATH, json_path="Data/ESConv.json",
+           store_path="Data/ingested_pairs.jsonl", source="chat_logs", translate=None):
+    """
+    默认写入多语言索引，与应用默认的 RETRIEVAL_MODE=multilingual 一致，中文问句直接编码。
+    写入英文索引时必须给 translate（文本列表 -> 英文列表，例如 Translator.translate_many），否则报错。
+    """
+    # 整个过程占住排他锁：两个 ingest 同时跑会读到同一个 max_id、发出重复的 id，还会写同一个 .vN
+    with FileLock(index_path + ".ingest.lock"):
+        return _ingest(pairs, delete_ids, index_path, json_path, store_path, source, translate)
+
+
+def _ingest(pairs, delete_ids, index_path, json_path, store_path, source, translate):
+    current = resolve_index_path(index_path)
+    index = ensure_id_map(faiss.read_index(current))
+    meta = load_index_meta(current)
+    base_count = meta.get("base_count") or len(load_corpus(json_path))
+    meta["base_count"] = base_count
+    if needs_translation(meta) and translate is None:
+        raise ValueError(f"{index_path} 是英文索引（{meta.get('model')}），写入前需要提供 translate 把问句翻译成英文")
+    store = IngestStore(store_path)
+
+    # 只编码新增的部分；上次写了语料却没来得及发布索引的条目（id 大于 max_indexed_id）一并补上
+    store.add(list(pairs), first_id=base_count, source=source)
+    indexed_upto = meta.get("max_indexed_id", base_count - 1)
+    added = sorted((i, r["question"]) for i, r in store.pairs.items()
+                   if i > indexed_upto and i not in store.tombstones)
+    if added:
+        questions = [q for _, q in added]
+        if needs_translation(meta):
+            questions = translate(questions)
+        model = get_embedding_service(meta["model"])
+        vectors = model.encode(questions)
+        if meta.get("normalize"):
+            faiss.normalize_L2(vectors)
+        index.add_with_ids(vectors, np.array([i for i, _ in added], dtype=np.int64))
+        meta["max_indexed_id"] = added[-1][0]
+
+    delete_ids = [int(i) for i in delete_ids]
+    if delete_ids:
+        store.delete(delete_ids)
+        if supports_remove(index):
+            index.remove_ids(np.array(delete_ids, dtype=np.int64))
+        # HNSW 删不掉，只靠墓碑在检索时过滤
+
+    if not added and not delete_ids:
+        print("ℹ️ 没有需要写入的变更")
+        return current, meta
+
+    path, meta = publish_version(index, meta, index_path)
+    print(f"✅ 新增 {len(added)} 条、删除 {len(delete_ids)} 条，当前索引版本：{path}")
+    return path, meta
+
+
+# ========== 运行时：发现新版本后原子替换 ==========
+class RetrievalIndex:
+    """
+    检索用的索引 + 语料视图。每隔 check_interval 秒看一次版本指针，变了就在后台加载新版本，
+    加载完成后一次性替换引用，查询不会被打断。id 小于 base_count 的去编译好的 ESConv 语料里取，其余去新增语料里取。
+    """
+
+    def __init__(self, index_path=MULTILINGUAL_INDEX_PATH, json_path="Data/ESConv.json",
+                 store_path="Data/ingested_pairs.jsonl", check_interval=10):
+        self.index_path = index_path
+        self.json_path = json_path
+        self.store_path = store_path
+        self.check_interval = check_interval
+        self.corpus = load_corpus(json_path)
+        self._lock = threading.Lock()
+        self._loading = False
+        self._last_check = time.time()
+        self._state = self._load(resolve_index_path(index_path))
+
+    def _load(self, path):
+        index = faiss.read_index(path)
+        meta = load_index_meta(path)
+        set_search_params(index, meta)
+        store = IngestStore(self.store_path) if os.path.exists(self.store_path) else None
+        return {"path": path, "index": index, "meta": meta, "store": store}
+
+    @property
+    def meta(self):
+        return self._state["meta"]
+
+    @property
+    def version(self):
+        # 当前生效的索引文件，检索缓存以它区分版本
+        return self._state["path"]
+
+    def maybe_reload(self):
+        now = time.time()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        path = resolve_index_path(self.index_path)
+        if path == self._state["path"]:
+            return
+        with self._lock:
+            if self._loading:
+                return
+            self._loading = True
+        threading.Thread(target=self._reload, args=(path,), daemon=True).start()
+
+    def _reload(self, path):
+        try:
+            self._state = self._load(path)
+            print(f"🔄 已切换到新的索引版本：{path}")
+        except Exception as e:
+            print("⚠️ 加载新索引失败，继续使用旧版本：", str(e))
+        finally:
+            with self._lock:
+                self._loading = False
+
+    def get(self, idx):
+        state = self._state
+        store = state["store"]
+        if store is not None and idx in store.tombstones:
+            return None
+        if idx < len(self.corpus):
+            return self.corpus[idx]
+        return store.get(idx) if store is not None else None
+
+    @timed("faiss_search")
+    def search(self, query_vectors, top_k):
+        """返回最相近的 top_k 条问答对（跳过已删除的）。"""
+        state = self._state
+        store = state["store"]
+        extra = min(len(store.tombstones), top_k * 4) if store is not None else 0
+        _, I = search_index(state["index"], state["meta"], query_vectors, top_k + extra)
+
+        entries = []
+        for idx in I[0]:
+            if idx < 0:
+                continue
+            entry = self.get(int(idx))
+            if entry is not None:
+                entries.append(entry)
+            if len(entries) == top_k:
+                break
+        return entries
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="把新的问答对增量写入检索索引")
+    parser.add_argument("--index", default=MULTILINGUAL_INDEX_PATH,
+                        help="默认写入多语言索引；写入英文索引时会先调用模型把问句翻译成英文")
+    parser.add_argument("--ratings", help="ai_ratings.csv 路径，取三项分数都达标的轮次")
+    parser.add_argument("--min-score", type=float, default=8.0)
+    parser.add_argument("--delete", type=int, nargs="*", default=[], help="要删除的问答对 id")
+    args = parser.parse_args()
+
+    new_pairs = pairs_from_ratings(args.ratings, args.min_score) if args.ratings else []
+    translate = None
+    if needs_translation(load_index_meta(resolve_index_path(args.index))):
+        from dotenv import load_dotenv
+        from utils.llm import create_llm_gateway
+        from utils.translation import Translator
+
+        load_dotenv("API.env")
+        llm = create_llm_gateway(os.getenv("MOONSHOT_API_KEY"), os.getenv("MOONSHOT_BASE_URL"))
+        translate = Translator(llm, cache_path=os.getenv("TRANSLATION_CACHE_PATH", "Data/translation_cache.sqlite3")).translate_many
+    ingest(new_pairs, args.delete, index_path=args.index, translate=translate)
@@ -0,0 +1,190 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+
+# 秒；覆盖缓存命中（毫秒级）到长上下文模型调用（几十秒）
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_NOOP = nullcontext()
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# ========== 指标注册表 ==========
+class Instrumentation:
+    """
+    进程内的轻量指标：按阶段的耗时直方图、错误 / 超时 / 重试计数、活跃会话与在途模型调用等即时值，
+    以 Prometheus 文本格式导出。各模块用 timed("阶段") 做上下文管理器或装饰器，用 inc(...) 计数。
+    enabled=False 时 timed 返回共享的空上下文、inc 直接返回，几乎没有开销。
+    """
+
+    def __init__(self, enabled=True, buckets=DEFAULT_BUCKETS, prefix="chatbot"):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._histograms = {}   # (名字, 标签) -> _Histogram
+        self._counters = {}     # (名字, 标签) -> 数值
+        self._gauges = {}       # 名字 -> (说明, 回调)，回调返回数值或 {标签字典元组: 数值}
+        self._help = {}
+
+    # ========== 写入 ==========
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, _labels_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = _Histogram(self.buckets)
+            hist.observe(seconds)
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge(self, name, fn, help=""):
+        """注册一个取值回调，导出时才调用（例如 lambda: session_memory.stats()["sessions"]）。"""
+        self._gauges[name] = (help, fn)
+
+    def describe(self, name, help):
+        self._help[name] = help
+
+    @contextmanager
+    def _timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.inc("stage_errors_total", stage=stage, error=type(e).__name__)
+            raise
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+
+    def timed(self, stage):
+        """
+        with metrics.timed("faiss_search"): ...      或      @metrics.timed("translation")
+        耗时记入 stage_seconds{stage=...}，抛出的异常另记 stage_errors_total。
+        """
+        return _Timed(self, stage)
+
+    # ========== 导出 ==========
+    def render(self):
+        lines = []
+        p = self.prefix
+        with self._lock:
+            histograms = {k: (list(h.counts), h.sum, h.count) for k, h in self._histograms.items()}
+            counters = dict(self._counters)
+
+        def header(name, kind):
+            full = f"{p}_{name}"
+            if name in self._help:
+                lines.append(f"# HELP {full} {self._help[name]}")
+            lines.append(f"# TYPE {full} {kind}")
+            return full
+
+        for name in sorted({n for n, _ in histograms}):
+            full = header(name, "histogram")
+            for (n, key), (counts, total, count) in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, c in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += c
+                    lines.append(f"{full}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{full}_sum{_format_labels(key)} {total}")
+                lines.append(f"{full}_count{_format_labels(key)} {count}")
+
+        for name in sorted({n for n, _ in counters}):
+            full = header(name, "counter")
+            for (n, key), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{full}{_format_labels(key)} {value}")
+
+        for name, (help, fn) in sorted(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception as e:
+                print(f"⚠️ 指标 {name} 取值失败：{e}")
+                continue
+            full = f"{p}_{name}"
+            if help:
+                lines.append(f"# HELP {full} {help}")
+            lines.append(f"# TYPE {full} gauge")
+            if isinstance(value, dict):
+                for labels, v in sorted(value.items()):
+                    lines.append(f"{full}{_format_labels(labels)} {v}")
+            else:
+                lines.append(f"{full} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class _Timed:
+    # 同时可以当上下文管理器和装饰器用；禁用时两种用法都不计时
+    __slots__ = ("_metrics", "_stage", "_ctx")
+
+    def __init__(self, metrics, stage):
+        self._metrics = metrics
+        self._stage = stage
+        self._ctx = None
+
+    def __enter__(self):
+        self._ctx = self._metrics._timer(self._stage) if self._metrics.enabled else _NOOP
+        return self._ctx.__enter__()
+
+    def __exit__(self, *exc):
+        return self._ctx.__exit__(*exc)
+
+    def __call__(self, fn):
+        metrics, stage = self._metrics, self._stage
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return fn(*args, **kwargs)
+            with metrics._timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+
+
+# 进程内共享的一份，METRICS_ENABLED=0 时关闭
+metrics = Instrumentation(enabled=os.getenv("METRICS_ENABLED", "1") != "0")
+metrics.describe("stage_seconds", "Latency of each request pipeline stage in seconds")
+metrics.describe("stage_errors_total", "Exceptions raised inside a pipeline stage")
+metrics.describe("llm_retries_total", "Model calls retried after a retryable error")
+metrics.describe("llm_timeouts_total", "Model calls that timed out")
+metrics.describe("llm_failures_total", "Model calls that failed after all retries")
+timed = metrics.timed
+inc = metrics.inc
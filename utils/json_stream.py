@@ -0,0 +1,147 @@
+import json
+
+
+class TextFieldExtractor:
+    """
+    从流式返回的 JSON 片段中增量取出某个顶层字符串字段（默认 "text"）。
+    每次 feed 返回该字段新解码出来的文字，finish 返回剩余未输出的部分。
+    """
+
+    def __init__(self, field="text"):
+        self.field = field
+        self.raw = []
+        self.emitted = []
+
+        self._depth = 0
+        self._in_string = False
+        self._string_buf = []
+        self._last_string = None
+        self._expect_value = False
+        self._in_target = False
+        self._target_done = False
+        self._escape = ""
+        self._high_surrogate = None     # 已解码、等下一个 \uXXXX 低位代理来配对的高位代理
+        self._leading = True
+
+    # ========== 解析 ==========
+    def feed(self, chunk):
+        if not chunk:
+            return ""
+        self.raw.append(chunk)
+        if self._target_done:
+            return ""
+
+        out = []
+        for ch in chunk:
+            if self._in_string:
+                self._feed_string_char(ch, out)
+                if self._target_done:
+                    break
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_buf = []
+                self._in_target = self._expect_value and self._depth == 1
+                self._expect_value = False
+            elif ch in "{[":
+                self._depth += 1
+                self._expect_value = False
+            elif ch in "}]":
+                self._depth -= 1
+                self._expect_value = False
+            elif ch == ":":
+                self._expect_value = self._last_string == self.field
+                self._last_string = None
+            elif ch == ",":
+                self._expect_value = False
+                self._last_string = None
+
+        return self._emit("".join(out))
+
+    def _feed_string_char(self, ch, out):
+        if self._escape:
+            self._escape += ch
+            decoded = self._decode_escape()
+            if decoded is not None:
+                self._escape = ""
+                self._append_decoded(decoded, out)
+            return
+
+        # 高位代理后面紧跟的不是转义，配不成对，按 U+FFFD 输出，当前字符照常处理（可能就是字符串结尾的引号）
+        if self._high_surrogate is not None and ch != "\\":
+            self._high_surrogate = None
+            self._append("\ufffd", out)
+
+        if ch == "\\":
+            self._escape = ch
+        elif ch == '"':
+            self._in_string = False
+            if self._in_target:
+                self._in_target = False
+                self._target_done = True
+            else:
+                self._last_string = "".join(self._string_buf)
+        else:
+            self._append(ch, out)
+
+    def _decode_escape(self):
+        seq = self._escape
+        if seq[1] != "u":
+            return json.loads(f'"{seq}"')
+        if len(seq) < 6:
+            return None
+        return chr(int(seq[2:6], 16))
+
+    def _append_decoded(self, text, out):
+        # 代理对可能被切在两个分片里：高位先存着，等到下一个转义再决定；落单的代理一律换成 U+FFFD
+        code = ord(text)
+        if self._high_surrogate is not None:
+            high, self._high_surrogate = self._high_surrogate, None
+            if 0xDC00 <= code <= 0xDFFF:
+                self._append(chr(0x10000 + ((high - 0xD800) << 10) + (code - 0xDC00)), out)
+                return
+            self._append("\ufffd", out)
+        if 0xD800 <= code <= 0xDBFF:
+            self._high_surrogate = code
+        elif 0xDC00 <= code <= 0xDFFF:
+            self._append("\ufffd", out)
+        else:
+            self._append(text, out)
+
+    def _append(self, text, out):
+        if self._in_target:
+            out.append(text)
+        else:
+            self._string_buf.append(text)
+
+    def _emit(self, text):
+        if self._leading:
+            text = text.lstrip()
+            if not text:
+                return ""
+            self._leading = False
+        self.emitted.append(text)
+        return text
+
+    # ========== 收尾 ==========
+    def finish(self):
+        """返回最终完整文本中尚未 feed 出去的部分（非 JSON 输出时回退为原文）。"""
+        raw = "".join(self.raw)
+        try:
+            content = json.loads(raw)
+            final = str(content.get(self.field, "")).strip() if isinstance(content, dict) else raw.strip()
+        except json.JSONDecodeError:
+            final = raw.strip()
+
+        sent = "".join(self.emitted)
+        if final.startswith(sent):
+            rest = final[len(sent):]
+        else:
+            rest = ""
+        self.emitted.append(rest)
+        return rest
+
+    @property
+    def text(self):
+        return "".join(self.emitted).strip()
@@ -0,0 +1,290 @@
+import asyncio
+import concurrent.futures
+import math
+import os
+import queue
+import random
+import threading
+import time
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from utils.admission import Overloaded
+from utils.instrumentation import metrics
+
+
+# 各模型单次请求的默认超时（秒）：上下文越长首字越慢，略放宽，但都是用户在等的交互调用，不宜比 20 秒长太多
+DEFAULT_TIMEOUTS = {
+    "moonshot-v1-8k": 20,
+    "moonshot-v1-32k": 25,
+    "moonshot-v1-128k": 30,
+}
+
+# 一次调用（含所有重试和退避）最多花多少秒
+DEFAULT_TOTAL_TIMEOUT = 30
+
+# 这些状态码值得重试：限流、超时、冲突以及所有 5xx
+RETRY_STATUS = {408, 409, 429}
+
+_DONE = object()
+
+
+def parse_timeouts(spec):
+    """解析 "moonshot-v1-8k=20,moonshot-v1-32k=40" 形式的配置。"""
+    timeouts = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            model, seconds = item.split("=", 1)
+            timeouts[model.strip()] = float(seconds)
+    return timeouts
+
+
+class _Completions:
+    def __init__(self, gateway):
+        self._gateway = gateway
+
+    def create(self, stream=False, **kwargs):
+        if stream:
+            return self._gateway.stream(**kwargs)
+        return self._gateway.complete(**kwargs)
+
+
+class _Chat:
+    def __init__(self, gateway):
+        self.completions = _Completions(gateway)
+
+
+class LLMGateway:
+    """
+    进程内共享的模型调用层。所有请求都在一个后台事件循环里用同一个 AsyncOpenAI 发出（连接池复用），
+    由信号量限制同时在途的请求数，可选按 rpm 匀速放行；429 / 5xx / 连接错误按带抖动的指数退避重试，
+    有 Retry-After 时以它为准。单次请求的超时按模型区分，整次调用（含重试）不超过 total_timeout；
+    超时默认不重试（retry_timeouts），用户已经等满一个超时了，再来一遍只会更久。
+    单次调用可以用 deadline=秒数、retry_timeouts=True 覆盖这两项。
+
+    同步代码调用 complete / stream（Flask 处理函数、翻译、摘要、自动续说），协程里调用 acomplete。
+    还提供与 OpenAI 客户端相同的 chat.completions.create 入口，原来接收 client 的代码可以直接换成网关。
+    """
+
+    def __init__(self, api_key=None, base_url=None, max_concurrency=8, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0, timeouts=None, default_timeout=20,
+                 total_timeout=DEFAULT_TOTAL_TIMEOUT, retry_timeouts=False, pool_size=None, rpm=0):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.default_timeout = default_timeout
+        self.total_timeout = total_timeout
+        self.retry_timeouts = retry_timeouts
+        self.pool_size = pool_size or max_concurrency * 2
+        self.rpm = rpm
+
+        self._loop = None
+        self._client = None
+        self._start_lock = threading.Lock()
+        self._semaphore = None
+        self._next_slot = 0.0
+
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "retries": 0, "failures": 0, "in_flight": 0, "waiting": 0,
+                         "latency_total": 0.0, "latency_max": 0.0}
+        self.chat = _Chat(self)
+
+    # ========== 后台事件循环 ==========
+    def _ensure_loop(self):
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="llm-gateway", daemon=True).start()
+                self._client = AsyncOpenAI(
+                    api_key=self.api_key,
+                    base_url=self.base_url,
+                    max_retries=0,     # 重试由网关统一做
+                    http_client=openai.DefaultAsyncHttpxClient(limits=httpx.Limits(
+                        max_connections=self.pool_size,
+                        max_keepalive_connections=self.pool_size,
+                    )),
+                )
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._loop = loop
+        return self._loop
+
+    def close(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._client.close(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+    # ========== 限流与重试 ==========
+    def timeout_for(self, model):
+        return self.timeouts.get(model, self.default_timeout)
+
+    async def _throttle(self):
+        # 按 rpm 均匀放行，不攒突发
+        if not self.rpm:
+            return
+        now = self._loop.time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 60.0 / self.rpm
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _retry_delay(self, error, attempt, timeout, retry_timeouts=False):
+        """
+        返回下次重试前要等的秒数；不该重试时返回 None。等待不超过 backoff_max 和本次请求的超时，
+        服务端要求的 Retry-After 比这更长时不再原地等（会一直占着会话锁和准入名额），
+        直接抛 Overloaded，由调用方回 429 + Retry-After。
+        """
+        if attempt >= self.max_retries:
+            return None
+        retry_after = None
+        if isinstance(error, openai.APIStatusError):
+            if error.status_code not in RETRY_STATUS and error.status_code < 500:
+                return None
+            try:
+                retry_after = float(error.response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        elif not isinstance(error, openai.APIConnectionError):
+            return None
+        elif isinstance(error, openai.APITimeoutError) and not retry_timeouts:
+            return None
+        cap = min(self.backoff_max, timeout)
+        if retry_after is not None:
+            if retry_after > cap:
+                raise Overloaded(math.ceil(retry_after), reason="upstream rate limited") from error
+            return min(cap, retry_after + random.uniform(0, self.backoff_base))
+        return random.uniform(0, min(cap, self.backoff_base * 2 ** attempt))
+
+    def _count(self, **deltas):
+        with self._lock:
+            for key, delta in deltas.items():
+                self.counters[key] += delta
+
+    async def _run(self, kwargs, on_chunk=None):
+        kwargs = dict(kwargs)
+        deadline = self._loop.time() + (kwargs.pop("deadline", None) or self.total_timeout)
+        retry_timeouts = kwargs.pop("retry_timeouts", self.retry_timeouts)
+        per_try = kwargs.pop("timeout", None) or self.timeout_for(kwargs.get("model"))
+        if on_chunk is not None:
+            kwargs["stream"] = True
+
+        attempt = 0
+        while True:
+            # 单次超时不超过整次调用剩下的时间
+            kwargs["timeout"] = max(1.0, min(per_try, deadline - self._loop.time()))
+            await self._throttle()
+            self._count(waiting=1)
+            async with self._semaphore:
+                self._count(waiting=-1, in_flight=1, requests=1)
+                start = time.perf_counter()
+                started = False
+                try:
+                    result = await self._client.chat.completions.create(**kwargs)
+                    if on_chunk is not None:
+                        async for chunk in result:
+                            started = True
+                            on_chunk(chunk)
+                    return result
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # 流式输出已经吐出内容后不能重试，否则前端会收到重复的片段
+                    try:
+                        delay = None if started else self._retry_delay(e, attempt, kwargs["timeout"], retry_timeouts)
+                    except Overloaded:
+                        self._count(failures=1)
+                        metrics.inc("llm_failures_total", model=kwargs.get("model"))
+                        raise
+                    if isinstance(e, openai.APITimeoutError):
+                        metrics.inc("llm_timeouts_total", model=kwargs.get("model"))
+                    # 等完再试就超出整次调用的期限了，不如现在就失败
+                    if delay is not None and self._loop.time() + delay + 1 >= deadline:
+                        delay = None
+                    if delay is None:
+                        self._count(failures=1)
+                        metrics.inc("llm_failures_total", model=kwargs.get("model"))
+                        raise
+                finally:
+                    elapsed = time.perf_counter() - start
+                    with self._lock:
+                        self.counters["in_flight"] -= 1
+                        self.counters["latency_total"] += elapsed
+                        self.counters["latency_max"] = max(self.counters["latency_max"], elapsed)
+                    metrics.observe("stage_seconds", elapsed, stage="llm", model=kwargs.get("model"))
+            self._count(retries=1)
+            metrics.inc("llm_retries_total", model=kwargs.get("model"))
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    # ========== 对外接口 ==========
+    def _hard_limit(self, kwargs):
+        # 兜底：排队等信号量、限流的时间也算进去，留 1 秒余量给事件循环调度
+        return (kwargs.get("deadline") or self.total_timeout) + 1
+
+    async def acomplete(self, **kwargs):
+        loop = self._ensure_loop()
+        future = asyncio.run_coroutine_threadsafe(self._run(kwargs), loop)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self._hard_limit(kwargs))
+        except asyncio.TimeoutError:
+            future.cancel()
+            metrics.inc("llm_timeouts_total", model=kwargs.get("model"))
+            raise
+
+    def complete(self, **kwargs):
+        loop = self._ensure_loop()
+        future = asyncio.run_coroutine_threadsafe(self._run(kwargs), loop)
+        try:
+            return future.result(timeout=self._hard_limit(kwargs))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            metrics.inc("llm_timeouts_total", model=kwargs.get("model"))
+            raise
+
+    def stream(self, **kwargs):
+        """同步生成器，逐个产出流式分片；调用方提前停止迭代时取消后台请求。"""
+        loop = self._ensure_loop()
+        chunks = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self._run(kwargs, on_chunk=chunks.put_nowait), loop)
+        future.add_done_callback(lambda _: chunks.put_nowait(_DONE))
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is _DONE:
+                    break
+                yield chunk
+            future.result()
+        finally:
+            if not future.done():
+                future.cancel()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        done = stats["requests"] - stats["in_flight"]
+        stats["latency_avg"] = round(stats.pop("latency_total") / done, 3) if done else 0.0
+        stats["latency_max"] = round(stats["latency_max"], 3)
+        stats["max_concurrency"] = self.max_concurrency
+        stats["rpm"] = self.rpm
+        return stats
+
+
+def create_llm_gateway(api_key=None, base_url=None):
+    # 其余配置从环境变量读取，需要先 load_dotenv("API.env")
+    return LLMGateway(
+        api_key=api_key or os.getenv("MOONSHOT_API_KEY"),
+        base_url=base_url or os.getenv("MOONSHOT_BASE_URL"),
+        max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+        timeouts=parse_timeouts(os.getenv("LLM_TIMEOUTS")),
+        total_timeout=float(os.getenv("LLM_TOTAL_TIMEOUT", str(DEFAULT_TOTAL_TIMEOUT))),
+        retry_timeouts=os.getenv("LLM_RETRY_TIMEOUTS", "0") == "1",
+        rpm=int(os.getenv("LLM_RPM", "0")),
+    )
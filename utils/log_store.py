@@ -0,0 +1,333 @@
+import codecs
+import csv
+import json
+import os
+import re
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from utils.log_writer import LOG_FIELDS, rotated_files
+
+
+# ========== 统一的日志结构 ==========
+# 原始 chat_logs.csv（不同时期的列不一样）和两种归档 CSV 都先转成这个结构再入库
+SCHEMA = pa.schema([
+    ("timestamp", pa.timestamp("us")),     # UTC
+    ("user_id", pa.string()),
+    ("user_input", pa.string()),
+    ("model_reply", pa.string()),
+    ("chat_type", pa.string()),
+    ("elapsed", pa.float64()),
+    ("score", pa.float64()),
+])
+COLUMNS = SCHEMA.names
+
+# 按 UTC 日期 / 用户分区：date=2025-07-14/user_id=Alice/part-*.parquet
+PARTITIONING = ds.partitioning(pa.schema([("date", pa.string()), ("user_id", pa.string())]), flavor="hive")
+
+# 各种历史表头 → 统一列名
+COLUMN_ALIASES = {
+    "TIME": "timestamp", "时间": "timestamp",
+    "USER NAME": "user_id", "说话人": "user_id",
+    "USER INPUT/AUTO CONTINUE": "user_input", "内容": "user_input",
+    "AI REPLY": "model_reply", "AI回应": "model_reply",
+}
+
+AUTO_CONTINUE_INPUT = "[auto_continue]"
+
+
+def canonicalize(df):
+    """把任意一种表头的日志 DataFrame 转成 SCHEMA 的列和类型。"""
+    df = df.rename(columns=COLUMN_ALIASES)
+    out = pd.DataFrame(index=df.index)
+
+    ts = df["timestamp"] if "timestamp" in df else pd.Series(None, index=df.index, dtype=object)
+    numeric = pd.to_numeric(ts, errors="coerce")
+    # 两种来源的精度可能不同（整秒 / 纳秒），先统一成微秒再合并，否则按位置赋值会因精度不符报错
+    parsed = pd.to_datetime(numeric, unit="s", errors="coerce").astype("datetime64[us]")
+    # 归档 CSV 里是格式化好的时间字符串
+    text_ts = numeric.isna() & ts.notna()
+    if text_ts.any():
+        text_parsed = pd.to_datetime(ts[text_ts], errors="coerce", format="mixed").dt.floor("us")
+        parsed[text_ts] = text_parsed.astype("datetime64[us]")
+    out["timestamp"] = parsed
+
+    for col in ("user_id", "user_input", "model_reply"):
+        out[col] = df[col].astype("string") if col in df else pd.Series(pd.NA, index=df.index, dtype="string")
+
+    chat_type = df["chat_type"].astype("string") if "chat_type" in df else pd.Series(pd.NA, index=df.index, dtype="string")
+    # 早期日志没有 chat_type，按输入补上
+    inferred = (out["user_input"] == AUTO_CONTINUE_INPUT).map({True: "auto_continue", False: "manual"})
+    out["chat_type"] = chat_type.fillna(inferred.astype("string"))
+
+    for col in ("elapsed", "score"):
+        out[col] = pd.to_numeric(df[col], errors="coerce") if col in df else float("nan")
+    return out[COLUMNS]
+
+
+def to_table(df):
+    df = canonicalize(df) if list(df.columns) != COLUMNS else df
+    df = df.assign(
+        date=df["timestamp"].dt.strftime("%Y-%m-%d").fillna("unknown"),
+        user_id=df["user_id"].fillna(""),
+    ).sort_values(["user_id", "timestamp"], kind="stable")
+    return pa.Table.from_pandas(df, schema=SCHEMA.append(pa.field("date", pa.string())), preserve_index=False)
+
+
+# ========== 写入 ==========
+# 每次增量归档都会给涉及的每个 日期/用户 分区各写一个小文件；一个分区超过这么多个文件就合并成一个
+COMPACT_AFTER = int(os.getenv("LOG_STORE_COMPACT_FILES", "16"))
+
+
+def append_partitions(df, store_dir, compact_after=COMPACT_AFTER):
+    """
+    把一批记录追加进列式存储，每次写新文件，不改动已有分区。返回写入的行数。
+    写完后检查本次涉及的分区，文件数超过 compact_after 的就地合并（compact_after 为 0 时不合并）。
+    """
+    if df.empty:
+        return 0
+    table = to_table(df)
+    written = []
+    ds.write_dataset(
+        table,
+        store_dir,
+        format="parquet",
+        partitioning=PARTITIONING,
+        basename_template=f"part-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        file_visitor=lambda f: written.append(f.path),
+    )
+    if compact_after:
+        for folder in sorted({os.path.dirname(path) for path in written}):
+            compact_partition(folder, compact_after)
+    return table.num_rows
+
+
+def _part_files(folder):
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if name.startswith("part-") and name.endswith(".parquet"))
+
+
+def _finish_compaction(folder):
+    # 上次合并中断时留下的清单：新文件已经就位就删掉被合并的旧文件，否则丢弃没写完的临时文件
+    manifest = os.path.join(folder, "_compacting.json")
+    if not os.path.exists(manifest):
+        return
+    with open(manifest, "r", encoding="utf-8") as f:
+        plan = json.load(f)
+    if os.path.exists(os.path.join(folder, plan["target"])):
+        for name in plan["sources"]:
+            path = os.path.join(folder, name)
+            if os.path.exists(path):
+                os.remove(path)
+    tmp = os.path.join(folder, plan["tmp"])
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    os.remove(manifest)
+
+
+def compact_partition(folder, compact_after=COMPACT_AFTER):
+    """
+    把一个 日期/用户 分区目录里的 part-*.parquet 合并成一个文件，文件数不超过 compact_after 时不动。
+    先写以 _ 开头的临时文件（读取时会被忽略），记下清单后再改名、删旧文件，中途中断下次会接着收尾，
+    不会出现新旧文件同时可见、同一条记录读出两遍。返回合并掉的文件数。
+    """
+    _finish_compaction(folder)
+    sources = _part_files(folder)
+    if len(sources) <= compact_after:
+        return 0
+
+    # 分区列在目录名里，文件本身只有其余的列
+    table = pa.concat_tables([pq.ParquetFile(path).read() for path in sources])
+    table = table.sort_by("timestamp")
+    target = f"part-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}-compacted.parquet"
+    tmp = "_" + target + ".tmp"
+    pq.write_table(table, os.path.join(folder, tmp))
+
+    manifest = os.path.join(folder, "_compacting.json")
+    with open(manifest, "w", encoding="utf-8") as f:
+        json.dump({"target": target, "tmp": tmp, "sources": [os.path.basename(p) for p in sources]}, f)
+    os.replace(os.path.join(folder, tmp), os.path.join(folder, target))
+    _finish_compaction(folder)
+    return len(sources)
+
+
+def compact_store(store_dir, compact_after=COMPACT_AFTER):
+    """把整个存储里文件数超过 compact_after 的分区都合并一遍（例如改小阈值之后）。返回合并掉的文件数。"""
+    total = 0
+    for folder, _, files in os.walk(store_dir):
+        if any(name.startswith("part-") or name == "_compacting.json" for name in files):
+            total += compact_partition(folder, compact_after)
+    return total
+
+
+# ========== 读取 ==========
+def open_store(store_dir):
+    return ds.dataset(store_dir, format="parquet", partitioning=PARTITIONING)
+
+
+def read_logs(store_dir, users=None, start=None, end=None, columns=None):
+    """
+    只读需要的分区：users 是用户列表，start / end 是 "YYYY-MM-DD"（含两端）。
+    返回按 user_id、timestamp 排好序的 DataFrame。
+    """
+    dataset = open_store(store_dir)
+    condition = None
+
+    def both(a, b):
+        return b if a is None else a & b
+
+    if users is not None:
+        condition = both(condition, ds.field("user_id").isin(list(users)))
+    if start is not None:
+        condition = both(condition, ds.field("date") >= start)
+    if end is not None:
+        condition = both(condition, ds.field("date") <= end)
+
+    wanted = list(columns) if columns else COLUMNS
+    for key in ("user_id", "timestamp"):
+        if key not in wanted:
+            wanted.append(key)
+    df = dataset.to_table(columns=wanted, filter=condition).to_pandas()
+    df = df.sort_values(["user_id", "timestamp"], kind="stable").reset_index(drop=True)
+    return df[list(columns)] if columns else df[COLUMNS]
+
+
+# ========== 增量读取原始 CSV ==========
+def _complete_records(text):
+    """
+    逐条解析 CSV 文本，产出 (记录, 该记录结束处的字符偏移)，只产出已经完整写完的记录。
+    文件可能正被写入，完整与否以 csv 解析器自己的状态为准：记录是在某一行的换行处（引号外）结束的才算完整；
+    解析器读到文本末尾才交出的记录（最后一行没写完，或者引号还没闭合）到此为止，留到下次再读。
+    """
+    lines = re.findall(r"[^\n]*\n|[^\n]+$", text)    # 只按 \n 切，字段里的其他换行符原样保留
+    state = {"chars": 0, "last": "", "exhausted": False}
+
+    def feed():
+        for line in lines:
+            state["chars"] += len(line)
+            state["last"] = line
+            yield line
+        state["exhausted"] = True
+
+    for record in csv.reader(feed()):
+        if state["exhausted"] or not state["last"].endswith("\n"):
+            return
+        yield record, state["chars"]
+
+
+def read_new_rows(path, offset, header=None, quarantine=None):
+    """
+    从 offset 字节处读出新增的完整记录，返回 (DataFrame, 新的 offset, 表头)。
+    offset 为 0 时第一行是表头；否则沿用上次记下的表头。
+    新的 offset 停在最后一条完整记录的末尾，没写完的记录下次重读；
+    完整但列数对不上的记录写进 quarantine（CSV 路径，为 None 时只打印），不会悄悄丢掉。
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        raw = f.read()
+    # 末尾可能截在多字节字符中间，留到下次
+    text = codecs.getincrementaldecoder("utf-8")().decode(raw, final=False)
+
+    rows, rejected, consumed = [], [], 0
+    for record, end in _complete_records(text):
+        start, consumed = consumed, end
+        if not record:      # 空行
+            continue
+        if header is None:
+            header = [record[0].lstrip("\ufeff")] + record[1:]
+            continue
+        # 旧文件的表头是 5 列（带 score），改版后追加的行是 LOG_FIELDS 的 6 列，两种都认
+        if len(record) == len(header):
+            rows.append(dict(zip(header, record)))
+        elif len(record) == len(LOG_FIELDS):
+            rows.append(dict(zip(LOG_FIELDS, record)))
+        else:
+            rejected.append([path, offset + len(text[:start].encode("utf-8"))] + record)
+    if rejected:
+        print(f"⚠️ {path}：{len(rejected)} 条记录列数不对，已放入 {quarantine or '（未指定隔离文件）'}")
+        if quarantine:
+            _append_quarantine(quarantine, rejected)
+    new_offset = offset + len(text[:consumed].encode("utf-8"))
+    return pd.DataFrame(rows), new_offset, header
+
+
+def quarantine_path(store_dir):
+    # 以 _ 开头，读取数据集时会被忽略
+    return os.path.join(store_dir, "_quarantine.csv")
+
+
+def _append_quarantine(path, records):
+    # 每行：来源文件、记录起始字节、原始各列
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a", encoding="utf-8", newline="") as f:
+        csv.writer(f, quoting=csv.QUOTE_ALL).writerows(records)
+
+
+def import_csv(path, store_dir):
+    """一次性导入已有的归档 CSV（TIME/USER NAME/… 或 时间/说话人/… 表头）。"""
+    df = pd.read_csv(path, encoding="utf-8-sig", dtype=str, keep_default_na=False, na_values=[""])
+    written = append_partitions(df, store_dir)
+    print(f"📥 {path}：导入 {written} 条")
+    return written
+
+
+# ========== 水位线 ==========
+def watermark_path(store_dir):
+    return os.path.join(store_dir, "_watermark.json")
+
+
+def load_watermark(store_dir):
+    path = watermark_path(store_dir)
+    if not os.path.exists(path):
+        return {"files": {}, "rows": 0}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_watermark(store_dir, watermark):
+    os.makedirs(store_dir, exist_ok=True)
+    path = watermark_path(store_dir)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(watermark, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def archive_incremental(source, store_dir):
+    """
+    把 source（及其轮转出的 .1、.2 …）里水位线之后的记录追加进 store_dir。
+    水位线按文件的 inode 记录读到的字节位置，轮转改名不影响；文件被截断或重建时从头读。
+    """
+    watermark = load_watermark(store_dir)
+    files = watermark["files"]
+    seen, total = {}, 0
+
+    for path in rotated_files(source):
+        st = os.stat(path)
+        key = str(st.st_ino)
+        state = files.get(key, {"offset": 0, "header": None})
+        if st.st_size < state["offset"]:
+            state = {"offset": 0, "header": None}
+        if st.st_size > state["offset"]:
+            df, offset, header = read_new_rows(path, state["offset"], state["header"],
+                                               quarantine=quarantine_path(store_dir))
+            written = append_partitions(df, store_dir)
+            total += written
+            state = {"offset": offset, "header": header}
+            print(f"📥 {path}：新增 {written} 条")
+        seen[key] = dict(state, path=path)
+        # 每个文件写完就推进水位线，中断后不会重复入库
+        watermark["files"] = dict(files, **seen)
+        save_watermark(store_dir, watermark)
+
+    # 已经轮转出保留范围的文件不再记录
+    watermark["files"] = seen
+    watermark["rows"] += total
+    watermark["updated_at"] = time.time()
+    save_watermark(store_dir, watermark)
+    return total
@@ -0,0 +1,268 @@
+import atexit
+import csv
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from utils.instrumentation import timed
+
+
+# chat_logs.csv 的列，也是 JSONL / SQLite 里的固定字段
+LOG_FIELDS = ["timestamp", "user_id", "user_input", "model_reply", "chat_type", "elapsed"]
+
+
+# ========== 输出端 ==========
+class _RotatingFile:
+    """追加写的文本文件，超过 max_bytes 时依次改名为 path.1、path.2 … 只保留 backups 份。"""
+
+    def __init__(self, path, max_bytes=0, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._f = None
+
+    def _open(self):
+        if self._f is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._f = open(self.path, "a", encoding="utf-8", newline="")
+            self.on_open(self._f)
+        return self._f
+
+    def on_open(self, f):
+        pass
+
+    def rotate(self):
+        self.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def write_batch(self, records):
+        f = self._open()
+        for record in records:
+            self.write_record(f, record)
+        f.flush()
+        if self.max_bytes and f.tell() >= self.max_bytes:
+            self.rotate()
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+class CSVSink(_RotatingFile):
+    def __init__(self, path, fields=LOG_FIELDS, **kwargs):
+        super().__init__(path, **kwargs)
+        self.fields = fields
+        self._writer = None
+
+    def on_open(self, f):
+        self._writer = csv.DictWriter(f, fieldnames=self.fields, quoting=csv.QUOTE_ALL, extrasaction="ignore")
+        if f.tell() == 0:
+            self._writer.writeheader()
+
+    def write_record(self, f, record):
+        self._writer.writerow(record)
+
+
+class JSONLSink(_RotatingFile):
+    def __init__(self, path, fields=LOG_FIELDS, **kwargs):
+        super().__init__(path, **kwargs)
+        self.fields = fields
+
+    def write_record(self, f, record):
+        f.write(json.dumps({k: record.get(k) for k in self.fields}, ensure_ascii=False) + "\n")
+
+
+class SQLiteSink:
+    """固定表结构的 SQLite 输出，一批记录一个事务。只在写线程里使用。"""
+
+    def __init__(self, path, fields=LOG_FIELDS, table="chat_logs"):
+        self.path = path
+        self.fields = fields
+        self.table = table
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            columns = ", ".join(self.fields)
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (id INTEGER PRIMARY KEY, {columns})")
+        return self._conn
+
+    def write_batch(self, records):
+        conn = self._connect()
+        marks = ", ".join("?" * len(self.fields))
+        with conn:
+            conn.executemany(
+                f"INSERT INTO {self.table} ({', '.join(self.fields)}) VALUES ({marks})",
+                [tuple(r.get(k) for k in self.fields) for r in records],
+            )
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+# ========== 后台写线程 ==========
+class LogWriter:
+    """
+    请求线程只把记录放进队列就返回；后台线程攒够 batch_size 条或每隔 flush_interval 秒写一批，
+    所有文件只由这一个线程打开和写入，不会出现交错的行。队列满了直接丢弃并计数，不阻塞请求。
+    """
+
+    def __init__(self, sinks, batch_size=100, flush_interval=1.0, max_queue=10000, name="log-writer"):
+        self.sinks = list(sinks)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self.counters = {"written": 0, "batches": 0, "dropped": 0, "errors": 0}
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, record):
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.counters["dropped"] += 1
+            return False
+
+    def _loop(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+        for sink in self.sinks:
+            sink.close()
+
+    @timed("log_write")
+    def _write(self, batch):
+        for sink in self.sinks:
+            try:
+                sink.write_batch(batch)
+            except Exception as e:
+                self.counters["errors"] += 1
+                print(f"⚠️ 日志写入失败（{type(sink).__name__}）：{e}")
+        self.counters["written"] += len(batch)
+        self.counters["batches"] += 1
+        for _ in batch:
+            self._queue.task_done()
+
+    def flush(self):
+        """等队列里已有的记录都落盘。"""
+        self._queue.join()
+
+    def close(self, timeout=5):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        return dict(self.counters, queued=self._queue.qsize())
+
+
+def create_log_writer(csv_path="chat_logs.csv", fields=LOG_FIELDS):
+    """
+    CHAT_LOG_SINKS：逗号分隔的 csv / jsonl / sqlite，默认只写 csv（保持现有格式）；
+    jsonl、sqlite 文件与 csv 同名换扩展名。CHAT_LOG_MAX_MB 为 0 时不轮转。
+    """
+    stem = os.path.splitext(csv_path)[0]
+    rotation = {
+        "max_bytes": int(float(os.getenv("CHAT_LOG_MAX_MB", "50")) * 1024 * 1024),
+        "backups": int(os.getenv("CHAT_LOG_BACKUPS", "5")),
+    }
+    sinks = []
+    for kind in os.getenv("CHAT_LOG_SINKS", "csv").split(","):
+        kind = kind.strip()
+        if kind == "csv":
+            sinks.append(CSVSink(csv_path, fields, **rotation))
+        elif kind == "jsonl":
+            sinks.append(JSONLSink(stem + ".jsonl", fields, **rotation))
+        elif kind == "sqlite":
+            sinks.append(SQLiteSink(stem + ".sqlite3", fields))
+        elif kind:
+            raise ValueError(f"未知的日志输出: {kind}（可选 csv, jsonl, sqlite）")
+    return LogWriter(
+        sinks,
+        batch_size=int(os.getenv("CHAT_LOG_BATCH", "100")),
+        flush_interval=float(os.getenv("CHAT_LOG_FLUSH_SECONDS", "1")),
+    )
+
+
+# ========== 导出为 chat_logs.csv 的格式 ==========
+def rotated_files(path):
+    """按从旧到新的顺序返回 path.N … path.1、path 里存在的文件。"""
+    backups = []
+    i = 1
+    while os.path.exists(f"{path}.{i}"):
+        backups.append(f"{path}.{i}")
+        i += 1
+    files = backups[::-1]
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def iter_records(path, fields=LOG_FIELDS, table="chat_logs"):
+    if path.endswith(".jsonl"):
+        for name in rotated_files(path):
+            with open(name, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+    elif path.endswith((".sqlite3", ".db")):
+        conn = sqlite3.connect(path)
+        try:
+            for row in conn.execute(f"SELECT {', '.join(fields)} FROM {table} ORDER BY id"):
+                yield dict(zip(fields, row))
+        finally:
+            conn.close()
+    else:
+        raise ValueError(f"不支持的日志文件: {path}")
+
+
+def export_csv(path, out_path, fields=LOG_FIELDS):
+    count = 0
+    with open(out_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, quoting=csv.QUOTE_ALL, extrasaction="ignore")
+        writer.writeheader()
+        for record in iter_records(path, fields):
+            writer.writerow(record)
+            count += 1
+    print(f"✅ 已导出 {count} 条记录 → {out_path}")
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="把 JSONL / SQLite 对话日志导出成 chat_logs.csv 的格式")
+    parser.add_argument("source", help="chat_logs.jsonl 或 chat_logs.sqlite3")
+    parser.add_argument("output", help="输出的 CSV 路径")
+    args = parser.parse_args()
+    export_csv(args.source, args.output)
@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+# ========== 功能词类别 ==========
+# 参照 LIWC 的功能词分类；词表从原来 calc_lsm 的停用词扩充而来
+CATEGORIES = {
+    "personal_pronoun": ["我", "你", "他", "她", "它", "我们", "你们", "他们", "她们", "咱们", "自己", "您"],
+    "impersonal_pronoun": ["这", "那", "这个", "那个", "这些", "那些", "这样", "那样", "什么", "哪", "谁"],
+    "auxiliary": ["的", "了", "着", "过", "地", "得"],
+    "copula_preposition": ["是", "在", "把", "被", "给", "对", "从", "跟", "和", "向"],
+    "negation": ["不", "没", "没有", "别", "无", "未"],
+    "adverb": ["就", "都", "也", "还", "又", "才", "很", "太", "更", "最", "真"],
+    "conjunction": ["但", "但是", "因为", "所以", "如果", "而且", "或者", "可是", "然后"],
+    "modal_particle": ["啊", "啦", "嘛", "呢", "吧", "吗", "呀", "哦", "嗯"],
+}
+CATEGORY_NAMES = list(CATEGORIES)
+WORD_CATEGORY = {word: i for i, words in enumerate(CATEGORIES.values()) for word in words}
+
+SEGMENT_CACHE_SIZE = int(os.getenv("LSM_SEGMENT_CACHE", "100000"))
+
+_warm_lock = threading.Lock()
+_warmed = False
+
+
+def warm_up():
+    """启动时加载 jieba 词典（约 1 秒），避免第一次分词时才初始化。返回耗时秒数。"""
+    global _warmed
+    with _warm_lock:
+        if _warmed:
+            return 0.0
+        import jieba
+        start = time.perf_counter()
+        jieba.initialize()
+        _warmed = True
+        return time.perf_counter() - start
+
+
+@lru_cache(maxsize=SEGMENT_CACHE_SIZE)
+def segment(text):
+    # 每句只切一次；同一句话（例如反复出现的开场白）直接命中缓存
+    import jieba
+    return tuple(t for t in jieba.lcut(text) if t.strip())
+
+
+def count_matrix(texts):
+    """
+    返回 (counts, totals)：counts 是 (len(texts), 类别数) 的功能词计数，totals 是每句的词数。
+    相同文本只计算一次。
+    """
+    codes, uniques = pd.factorize(pd.Series(texts, dtype=object).fillna(""))
+    counts = np.zeros((len(uniques), len(CATEGORY_NAMES)), dtype=np.float64)
+    totals = np.zeros(len(uniques), dtype=np.float64)
+    for row, text in enumerate(uniques):
+        tokens = segment(str(text))
+        totals[row] = len(tokens)
+        hits = [WORD_CATEGORY[t] for t in tokens if t in WORD_CATEGORY]
+        if hits:
+            counts[row] = np.bincount(hits, minlength=len(CATEGORY_NAMES))
+    return counts[codes], totals[codes]
+
+
+# ========== LSM ==========
+def lsm(counts_a, totals_a, counts_b, totals_b, eps=1e-4):
+    """
+    逐行计算 LSM：每个类别的占比 p = 计数 / 总词数，LSM_c = 1 - |p_a - p_b| / (p_a + p_b + eps)，
+    再对所有类别取平均。两边都没有词的行记为 NaN。
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p_a = counts_a / totals_a[:, None]
+        p_b = counts_b / totals_b[:, None]
+    scores = (1 - np.abs(p_a - p_b) / (p_a + p_b + eps)).mean(axis=1)
+    scores[(totals_a == 0) | (totals_b == 0)] = np.nan
+    return scores
+
+
+def speaker_lsm(df, pairs=None, user_col="user_input", reply_col="model_reply", speaker_col="user_id"):
+    """
+    一次算出所有说话人的 LSM：
+    - LSM：说话人全部输入与 AI 全部回应的功能词计数各自相加后比较；
+    - LSM_turn：pairs（每行一轮，列 user_id / user_text / ai_text）逐轮计算后按说话人取平均。
+    返回以说话人为索引的 DataFrame。
+    """
+    user_rows = df[df[user_col].notna()]
+    reply_rows = df[df[reply_col].notna()]
+    user_counts, user_totals = count_matrix(user_rows[user_col].tolist())
+    reply_counts, reply_totals = count_matrix(reply_rows[reply_col].tolist())
+
+    def per_speaker(speakers, counts, totals):
+        return pd.DataFrame(np.column_stack([counts, totals]), index=speakers.to_numpy()).groupby(level=0).sum()
+
+    speakers = pd.Index(df[speaker_col].dropna().unique()).sort_values()
+    u = per_speaker(user_rows[speaker_col], user_counts, user_totals).reindex(speakers, fill_value=0.0).to_numpy()
+    r = per_speaker(reply_rows[speaker_col], reply_counts, reply_totals).reindex(speakers, fill_value=0.0).to_numpy()
+    result = pd.DataFrame({"LSM": lsm(u[:, :-1], u[:, -1], r[:, :-1], r[:, -1]), "LSM_turn": np.nan}, index=speakers)
+
+    if pairs is not None and len(pairs):
+        a_counts, a_totals = count_matrix(pairs["user_text"].tolist())
+        b_counts, b_totals = count_matrix(pairs["ai_text"].tolist())
+        turn = pd.Series(lsm(a_counts, a_totals, b_counts, b_totals), index=pairs[speaker_col].to_numpy())
+        result["LSM_turn"] = turn.groupby(level=0).mean().reindex(speakers)
+    return result
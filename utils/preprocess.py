@@ -1,14 +1,38 @@
 import json
 import os
+import re
+
+_SKIP = re.compile(r"[\s,]*")
 
-def load_esconv(file_path):
-    import json
 
+def iter_dialogs(file_path, chunk_size=1 << 20):
+    """
+    逐个产出 ESConv.json 顶层数组里的对话，不把整个文件读进内存。
+    每次读 chunk_size 个字符，用 raw_decode 从缓冲区里切出完整的对象，剩下不完整的部分留到下次拼接。
+    """
+    decoder = json.JSONDecoder()
     with open(file_path, 'r', encoding='utf-8') as f:
-        raw_data = json.load(f)
+        buf = f.read(chunk_size).lstrip()
+        if not buf.startswith("["):
+            raise ValueError(f"{file_path} 不是 JSON 数组")
+        pos = 1
+        while True:
+            pos = _SKIP.match(buf, pos).end()
+            if buf.startswith("]", pos):
+                return
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                more = f.read(chunk_size)
+                if not more:
+                    raise
+                buf, pos = buf[pos:] + more, 0
+                continue
+            yield obj
 
-    pairs = []
-    for dialog in raw_data:
+
+def iter_esconv_pairs(file_path):
+    for dialog in iter_dialogs(file_path):
         previous = None
         for turn in dialog["dialog"]:
             speaker = turn["speaker"]
@@ -17,24 +41,27 @@ def load_esconv(file_path):
             if speaker == "seeker":
                 previous = content  # 保存 seeker 的问题
             elif speaker == "supporter" and previous:
-                pairs.append({
+                yield {
                     "question": previous,
                     "answer": content
-                })
+                }
                 previous = None  # 匹配完清空
 
-    return pairs
 
-def save_moonshot_format(pairs, output_path="Data/moonshot_dataset.json"):
-    output = []
-    for question, answer in pairs:
-        item = {
-            "messages": [
-                {"role": "user", "content": question},
-                {"role": "assistant", "content": answer}
-            ]
-        }
-        output.append(item)
+def load_esconv(file_path):
+    return list(iter_esconv_pairs(file_path))
+
 
+def save_moonshot_format(pairs, output_path="Data/moonshot_dataset.json"):
+    # pairs 是 load_esconv / iter_esconv_pairs 产出的 {"question", "answer"}，逐条写出
     with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(output, f, ensure_ascii=False, indent=2)
+        f.write("[")
+        for i, p in enumerate(pairs):
+            item = {
+                "messages": [
+                    {"role": "user", "content": p["question"]},
+                    {"role": "assistant", "content": p["answer"]}
+                ]
+            }
+            f.write(("," if i else "") + "\n" + json.dumps(item, ensure_ascii=False, indent=2))
+        f.write("\n]")
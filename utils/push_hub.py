@@ -0,0 +1,50 @@
+import queue
+import threading
+
+
+class PushHub:
+    """
+    按 user_id 管理推送订阅（SSE 长连接）。一个用户可以同时开多个标签页，
+    每个连接对应一个队列；publish 没有任何在线连接时返回 False。
+    返回 True 只表示放进了某个连接的队列，连接可能已经断开（要到下一次心跳写失败才会退订），
+    需要确认送达的内容由调用方另外保存，等连接真正写出后再清掉。
+    """
+
+    def __init__(self, max_queue=32):
+        self.max_queue = max_queue
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        q = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers.setdefault(user_id, []).append(q)
+        return q
+
+    def unsubscribe(self, user_id, q):
+        with self._lock:
+            subs = self._subscribers.get(user_id, [])
+            if q in subs:
+                subs.remove(q)
+            if not subs:
+                self._subscribers.pop(user_id, None)
+
+    def publish(self, user_id, payload):
+        with self._lock:
+            subs = list(self._subscribers.get(user_id, []))
+
+        delivered = False
+        for q in subs:
+            try:
+                q.put_nowait(payload)
+                delivered = True
+            except queue.Full:
+                # 客户端卡住不读，丢掉这条，避免拖住生产者
+                pass
+        return delivered
+
+    def subscriber_count(self, user_id=None):
+        with self._lock:
+            if user_id is not None:
+                return len(self._subscribers.get(user_id, []))
+            return sum(len(subs) for subs in self._subscribers.values())
@@ -0,0 +1,124 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DeadlineScheduler:
+    """
+    按截止时间触发任务的定时堆 + 有界线程池。
+    同一个 key 只保留最新一次 schedule 的截止时间（旧的堆条目出堆时直接丢弃），
+    同一个 key 正在执行时不会重复派发。
+    """
+
+    def __init__(self, handler, max_workers=8, name="scheduler", lateness_window=1000):
+        self.handler = handler
+        self.name = name
+        self._heap = []
+        self._deadlines = {}
+        self._in_flight = set()
+        self._waiting = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._max_workers = max_workers
+        self._thread = None
+        self._stopped = False
+
+        self._lateness = deque(maxlen=lateness_window)
+        self._fired = 0
+        self._deduped = 0
+        self._failed = 0
+
+    # ========== 对外接口 ==========
+    def schedule(self, key, deadline):
+        with self._cond:
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, next(self._seq), key))
+            self._cond.notify()
+
+    def cancel(self, key):
+        with self._cond:
+            self._deadlines.pop(key, None)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name=f"{self.name}-timer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._pool.shutdown(wait=wait)
+
+    # ========== 调度循环 ==========
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    deadline, _, key = self._heap[0]
+                    delay = deadline - time.time()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+                    heapq.heappop(self._heap)
+                    # 已被 cancel 或被更新的截止时间取代
+                    if self._deadlines.get(key) != deadline:
+                        continue
+                    del self._deadlines[key]
+                    if key in self._in_flight:
+                        self._deduped += 1
+                        continue
+                    self._in_flight.add(key)
+                    self._waiting += 1
+                    break
+                else:
+                    return
+            self._pool.submit(self._run, key, deadline)
+
+    def _run(self, key, deadline):
+        started = time.time()
+        with self._cond:
+            self._waiting -= 1
+            self._fired += 1
+            self._lateness.append(started - deadline)
+        try:
+            self.handler(key, deadline)
+        except Exception as e:
+            with self._cond:
+                self._failed += 1
+            print(f"[{key}] ❌ {self.name} 任务失败: {e}")
+        finally:
+            with self._cond:
+                self._in_flight.discard(key)
+
+    # ========== 指标 ==========
+    def metrics(self):
+        with self._cond:
+            lateness = sorted(self._lateness)
+            now = time.time()
+            overdue = [now - d for d in self._deadlines.values() if d <= now]
+            result = {
+                "scheduled": len(self._deadlines),
+                "overdue": len(overdue),
+                "queue_depth": self._waiting,
+                "in_flight": len(self._in_flight),
+                "max_workers": self._max_workers,
+                "fired": self._fired,
+                "deduped": self._deduped,
+                "failed": self._failed,
+            }
+
+        if lateness:
+            result["lateness_avg"] = round(sum(lateness) / len(lateness), 3)
+            result["lateness_p95"] = round(lateness[min(len(lateness) - 1, int(len(lateness) * 0.95))], 3)
+            result["lateness_max"] = round(lateness[-1], 3)
+        result["oldest_overdue"] = round(max(overdue), 3) if overdue else 0.0
+        return result
@@ -0,0 +1,77 @@
+import queue
+import random
+import threading
+
+
+class ScoringPipeline:
+    """
+    后台打分流水线：回复发出去之后把 (用户输入, 回复, 日志记录) 丢进队列，
+    由工作线程调用 score_fn 打分、把分数写回记录再交给 on_scored 落盘，用户不用等。
+    sample_rate < 1 时只抽样一部分轮次打分；队列满了直接放弃打分，不阻塞对话。
+    """
+
+    def __init__(self, score_fn, on_scored=None, workers=2, sample_rate=1.0, max_queue=1000):
+        self.score_fn = score_fn
+        self.on_scored = on_scored
+        self.sample_rate = sample_rate
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self.counters = {"submitted": 0, "sampled_out": 0, "dropped": 0, "scored": 0, "failed": 0}
+
+        self._workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name=f"scoring-{i}", daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def submit(self, user_text, reply, record=None):
+        """排队打分，返回 False 表示这一轮不打分（未抽中或队列已满），调用方自行落盘。"""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self._count("sampled_out")
+            return False
+        try:
+            self._queue.put_nowait((user_text, reply, record if record is not None else {}))
+        except queue.Full:
+            self._count("dropped")
+            return False
+        self._count("submitted")
+        return True
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            user_text, reply, record = job
+            try:
+                record["score"] = self.score_fn(user_text, reply)
+                self._count("scored")
+            except Exception as e:
+                record["score"] = None
+                self._count("failed")
+                print("⚠️ 后台打分失败：", str(e))
+            try:
+                if self.on_scored:
+                    self.on_scored(record)
+            except Exception as e:
+                print("⚠️ 打分结果写入失败：", str(e))
+            finally:
+                self._queue.task_done()
+
+    def shutdown(self, timeout=10):
+        # 先让队列里剩下的任务跑完，再让工作线程退出
+        for _ in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats["queue_depth"] = self._queue.qsize()
+        return stats
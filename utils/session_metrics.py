@@ -0,0 +1,234 @@
+import math
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from utils.lsm import CATEGORY_NAMES, count_matrix, lsm, warm_up
+
+
+def _finite(value, digits=4):
+    # JSON 里不能有 NaN
+    return None if value is None or math.isnan(value) else round(float(value), digits)
+
+
+class _Session:
+    __slots__ = ("user_counts", "user_tokens", "reply_counts", "reply_tokens", "nclid", "turns",
+                 "auto_turns", "lsm_turn_sum", "lsm_turn_n", "updated_at", "last")
+
+    def __init__(self):
+        self.user_counts = np.zeros(len(CATEGORY_NAMES))
+        self.user_tokens = 0.0
+        self.reply_counts = np.zeros(len(CATEGORY_NAMES))
+        self.reply_tokens = 0.0
+        self.nclid = None
+        self.turns = 0
+        self.auto_turns = 0
+        self.lsm_turn_sum = 0.0
+        self.lsm_turn_n = 0
+        self.updated_at = 0.0
+        self.last = None        # 最近一轮：自动续说要接到它的回复后面重算
+
+    def lsm(self):
+        return lsm(self.user_counts[None], np.array([self.user_tokens]),
+                   self.reply_counts[None], np.array([self.reply_tokens]))[0]
+
+    def snapshot(self, user_id):
+        return {
+            "user_id": user_id,
+            "turns": self.turns,
+            "auto_turns": self.auto_turns,
+            "LSM": _finite(self.lsm()),
+            "LSM_turn": _finite(self.lsm_turn_sum / self.lsm_turn_n) if self.lsm_turn_n else None,
+            "nCLiD": _finite(self.nclid),
+            "function_words": {
+                name: {"user": int(u), "reply": int(r)}
+                for name, u, r in zip(CATEGORY_NAMES, self.user_counts, self.reply_counts)
+            },
+            "updated_at": self.updated_at,
+        }
+
+
+# ========== 在线会话质量指标 ==========
+class SessionMetrics:
+    """
+    对话过程中按会话累加 LSM / nCLiD，口径与 Score_Test/score_lsm_nclid.py 一致：
+    功能词计数向量逐轮相加，nCLiD 按 w = (d + w) / 2 逐轮递推，每轮只做常数量的计算。
+    请求线程只把这一轮放进队列；分词（有缓存）和句向量编码在后台线程里做，不拖慢回复。
+
+    自动续说和离线清洗（Score_Test/cleaning.py 的 merge_auto_continue）一样以空格接到上一轮回复后面，
+    不单独算一轮：这一轮的功能词计数、逐轮 LSM 和距离都按接好的回复重算，nCLiD 从这一轮之前的值重新递推。
+    会话开头还没有任何一轮时的自动续说，离线会丢掉，这里也不计。
+    """
+
+    def __init__(self, encode=None, max_sessions=10000, window=600, max_queue=10000):
+        self.encode = encode            # texts -> 向量矩阵；为 None 时不计算 nCLiD
+        self.max_sessions = max_sessions
+        self.window = window
+        self._sessions = OrderedDict()
+        self._recent = deque(maxlen=100000)     # [时间, 逐轮 LSM, 逐轮距离]，用于最近 window 秒的汇总；接上自动续说时原地更新
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.counters = {"observed": 0, "dropped": 0, "errors": 0}
+        self._thread = threading.Thread(target=self._loop, name="session-metrics", daemon=True)
+        self._thread.start()
+
+    def observe(self, user_id, user_text, reply, chat_type="manual"):
+        try:
+            self._queue.put_nowait((time.time(), user_id, user_text, reply, chat_type))
+            return True
+        except queue.Full:
+            self.counters["dropped"] += 1
+            return False
+
+    def _loop(self):
+        # 词典预热失败（例如没装 jieba）只记一次错误，线程照常取队列，不让 observe 一直堆到丢弃
+        try:
+            warm_up()
+        except Exception as e:
+            self.counters["errors"] += 1
+            print(f"⚠️ 分词词典预热失败：{e}")
+        while True:
+            item = self._queue.get()
+            try:
+                self._update(*item)
+                self.counters["observed"] += 1
+            except Exception as e:
+                self.counters["errors"] += 1
+                print(f"⚠️ 会话指标更新失败：{e}")
+            finally:
+                self._queue.task_done()
+
+    def _score_turn(self, user_text, reply, user_vec=None):
+        counts, tokens = count_matrix([user_text, reply])
+        turn = {
+            "user_text": user_text, "reply": reply,
+            "reply_counts": counts[1], "reply_tokens": tokens[1],
+            "lsm": lsm(counts[:1], tokens[:1], counts[1:], tokens[1:])[0],
+            "distance": None, "user_vec": None,
+        }
+        if self.encode is not None:
+            if user_vec is None:
+                user_vec, reply_vec = np.asarray(self.encode([user_text, reply]), dtype=np.float64)
+            else:
+                reply_vec = np.asarray(self.encode([reply]), dtype=np.float64)[0]
+            norms = np.linalg.norm(user_vec) * np.linalg.norm(reply_vec)
+            # 零向量的相似度记为 0，与 sklearn 的 cosine_similarity 一致
+            turn["distance"] = 1.0 - (float(user_vec @ reply_vec / norms) if norms else 0.0)
+            turn["user_vec"] = user_vec
+        return turn, counts[0], tokens[0]
+
+    def _update(self, ts, user_id, user_text, reply, chat_type):
+        reply = "" if reply is None else str(reply)
+        if chat_type == "auto_continue":
+            # 只有这个后台线程会改 last，读它不用加锁
+            session = self._sessions.get(user_id)
+            last = session.last if session is not None else None
+            if last is None:
+                return
+            turn, _, _ = self._score_turn(last["user_text"], f"{last['reply']} {reply.strip()}", last["user_vec"])
+            with self._lock:
+                session = self._session(user_id)
+                session.reply_counts += turn["reply_counts"] - last["reply_counts"]
+                session.reply_tokens += turn["reply_tokens"] - last["reply_tokens"]
+                if not math.isnan(last["lsm"]):
+                    session.lsm_turn_sum -= last["lsm"]
+                    session.lsm_turn_n -= 1
+                self._finish_turn(session, ts, turn, last["nclid_before"], last["recent"])
+                session.auto_turns += 1
+            return
+
+        user_text = "" if user_text is None else str(user_text)
+        turn, user_counts, user_tokens = self._score_turn(user_text, reply)
+        with self._lock:
+            session = self._session(user_id)
+            session.user_counts += user_counts
+            session.user_tokens += user_tokens
+            session.reply_counts += turn["reply_counts"]
+            session.reply_tokens += turn["reply_tokens"]
+            session.turns += 1
+            recent = [ts, None, None]
+            self._recent.append(recent)
+            self._finish_turn(session, ts, turn, session.nclid, recent)
+
+    @staticmethod
+    def _finish_turn(session, ts, turn, nclid_before, recent):
+        # 调用方持有 self._lock；turn 是会话的最近一轮（新的一轮，或接上自动续说后重算的那一轮）
+        if not math.isnan(turn["lsm"]):
+            session.lsm_turn_sum += turn["lsm"]
+            session.lsm_turn_n += 1
+        if turn["distance"] is not None:
+            session.nclid = turn["distance"] if nclid_before is None else (turn["distance"] + nclid_before) / 2
+        session.updated_at = ts
+        recent[:] = [ts, turn["lsm"], turn["distance"]]
+        session.last = dict(turn, nclid_before=nclid_before, recent=recent)
+
+    def _session(self, user_id):
+        # 调用方持有 self._lock；超过 max_sessions 时丢掉最久没更新的会话
+        session = self._sessions.get(user_id)
+        if session is None:
+            session = self._sessions[user_id] = _Session()
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(user_id)
+        return session
+
+    # ========== 查询 ==========
+    def session(self, user_id):
+        with self._lock:
+            session = self._sessions.get(user_id)
+            return None if session is None else session.snapshot(user_id)
+
+    def aggregate(self):
+        now = time.time()
+        with self._lock:
+            snapshots = [s.snapshot(uid) for uid, s in self._sessions.items()]
+            recent = [(l, d) for ts, l, d in self._recent if ts >= now - self.window]
+
+        def mean(values):
+            values = [v for v in values if v is not None and not math.isnan(v)]
+            return _finite(sum(values) / len(values)) if values else None
+
+        return {
+            "sessions": len(snapshots),
+            "turns": sum(s["turns"] for s in snapshots),
+            "auto_turns": sum(s["auto_turns"] for s in snapshots),
+            "LSM": mean([s["LSM"] for s in snapshots]),
+            "LSM_turn": mean([s["LSM_turn"] for s in snapshots]),
+            "nCLiD": mean([s["nCLiD"] for s in snapshots]),
+            # 最近 window 秒内所有轮次的平均，质量回退几分钟内就能看到
+            "recent": {
+                "window": self.window,
+                "turns": len(recent),
+                "LSM_turn": mean([l for l, _ in recent]),
+                "distance": mean([d for _, d in recent]),
+            },
+            "queued": self._queue.qsize(),
+            **self.counters,
+        }
+
+    def flush(self):
+        """等队列里已有的轮次都算完。"""
+        self._queue.join()
+
+
+def create_session_metrics():
+    """
+    SESSION_METRICS_MODEL：算 nCLiD 用的句向量模型，与离线打分相同；设为空串则只算 LSM。
+    模型在后台线程第一次用到时才加载。
+    """
+    model_name = os.getenv("SESSION_METRICS_MODEL", "all-MiniLM-L6-v2")
+
+    def _encode(texts):
+        from utils.embedding import get_embedding_service
+        return get_embedding_service(model_name).encode(texts)
+
+    return SessionMetrics(
+        encode=_encode if model_name else None,
+        max_sessions=int(os.getenv("SESSION_METRICS_MAX", "10000")),
+        window=int(os.getenv("SESSION_METRICS_WINDOW", "600")),
+    )
@@ -0,0 +1,250 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def estimate_session_size(session):
+    # 粗略估算一个会话占用的字节数（按 UTF-8 计）
+    return len(json.dumps(session, ensure_ascii=False).encode("utf-8"))
+
+
+# ========== 进程内后端：OrderedDict 做 LRU ==========
+class MemoryBackend:
+    lock_dir = None     # 只在本进程内，进程内的会话锁就够了
+
+    def __init__(self):
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._total = 0
+
+    def load(self, user_id):
+        session = self._data.get(user_id)
+        if session is not None:
+            self._data.move_to_end(user_id)
+        return session
+
+    def store(self, user_id, session, size):
+        self._data[user_id] = session
+        self._data.move_to_end(user_id)
+        self._total += size - self._sizes.get(user_id, 0)
+        self._sizes[user_id] = size
+
+    def delete(self, user_id):
+        self._data.pop(user_id, None)
+        self._total -= self._sizes.pop(user_id, 0)
+
+    def user_ids(self):
+        return list(self._data.keys())
+
+    def idle_before(self, cutoff):
+        return [uid for uid, s in self._data.items() if s.get("last_active", 0) < cutoff]
+
+    def lru_order(self):
+        return list(self._data.keys())
+
+    def total_size(self):
+        return self._total
+
+    def count(self):
+        return len(self._data)
+
+
+# ========== SQLite 后端：重启后保留，多个 worker 进程共用 ==========
+class SQLiteBackend:
+    """
+    会话落盘，服务重启后还在，同一台机器上的多个 worker 进程可以共用一个库（WAL 模式，每次都从库里读）。
+    每次请求都是 读-改-写 整个会话，所以同一个用户的请求必须跨进程串行：
+    lock_dir 给 SessionLocks 用（见 utils/admission.py），在这个目录下用锁文件做跨进程的会话锁。
+    """
+
+    def __init__(self, path="sessions.sqlite3"):
+        self.path = path
+        self.lock_dir = path + ".locks"
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " user_id TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " last_active REAL NOT NULL,"
+            " last_access REAL NOT NULL,"
+            " size INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_access ON sessions(last_access)")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, user_id):
+        conn = self._conn()
+        row = conn.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE sessions SET last_access = ? WHERE user_id = ?", (time.time(), user_id))
+        return json.loads(row[0])
+
+    def store(self, user_id, session, size):
+        self._conn().execute(
+            "INSERT INTO sessions (user_id, data, last_active, last_access, size) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, last_active = excluded.last_active,"
+            " last_access = excluded.last_access, size = excluded.size",
+            (user_id, json.dumps(session, ensure_ascii=False), session.get("last_active", 0), time.time(), size),
+        )
+
+    def delete(self, user_id):
+        self._conn().execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def user_ids(self):
+        return [r[0] for r in self._conn().execute("SELECT user_id FROM sessions")]
+
+    def idle_before(self, cutoff):
+        rows = self._conn().execute("SELECT user_id FROM sessions WHERE last_active < ?", (cutoff,))
+        return [r[0] for r in rows]
+
+    def lru_order(self):
+        rows = self._conn().execute("SELECT user_id FROM sessions ORDER BY last_access")
+        return [r[0] for r in rows]
+
+    def total_size(self):
+        return self._conn().execute("SELECT COALESCE(SUM(size), 0) FROM sessions").fetchone()[0]
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+# ========== 会话存储 ==========
+class SessionStore:
+    """
+    有上限的会话存储：空闲超过 idle_ttl 秒的会话被清理；会话总数或总字节数超出预算时，
+    按最近最少使用（LRU）淘汰；单个会话的 history 超过 max_history 条时丢掉最早的消息
+    （保留开头的 system 消息）。会话改完之后要调用 save 才会落到后端。
+    """
+
+    def __init__(self, backend=None, idle_ttl=3600, max_sessions=10000,
+                 max_bytes=256 * 1024 * 1024, max_history=200, sweep_interval=60, on_evict=None):
+        self.backend = backend or MemoryBackend()
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.max_history = max_history
+        self.sweep_interval = sweep_interval
+        self.on_evict = on_evict
+        self._lock = threading.RLock()
+        self._last_sweep = time.time()
+        self.evicted = {"idle": 0, "budget": 0}
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def get(self, user_id, default=None):
+        with self._lock:
+            session = self.backend.load(user_id)
+        return default if session is None else session
+
+    def get_or_create(self, user_id, factory):
+        with self._lock:
+            session = self.backend.load(user_id)
+            if session is None:
+                session = factory()
+                self._store(user_id, session)
+            return session
+
+    def save(self, user_id, session):
+        with self._lock:
+            self._store(user_id, session)
+            self._enforce_budget(keep=user_id)
+            if time.time() - self._last_sweep > self.sweep_interval:
+                self.evict_idle()
+
+    def delete(self, user_id):
+        with self._lock:
+            self.backend.delete(user_id)
+
+    def items(self):
+        for user_id in self.backend.user_ids():
+            session = self.get(user_id)
+            if session is not None:
+                yield user_id, session
+
+    def _store(self, user_id, session):
+        self._trim_history(session)
+        self.backend.store(user_id, session, estimate_session_size(session))
+
+    def _trim_history(self, session):
+        history = session.get("history")
+        if not history or len(history) <= self.max_history:
+            return
+        # 开头连续的 system 消息（人设、背景、摘要）不动，从其后最早的消息开始丢
+        pinned = 1
+        while pinned < len(history) and history[pinned].get("role") == "system":
+            pinned += 1
+        overflow = len(history) - self.max_history
+        del history[pinned:pinned + overflow]
+
+    # ========== 淘汰 ==========
+    def evict_idle(self, now=None):
+        now = now or time.time()
+        with self._lock:
+            self._last_sweep = now
+            expired = self.backend.idle_before(now - self.idle_ttl)
+            for user_id in expired:
+                self._evict(user_id, "idle")
+        return expired
+
+    def _enforce_budget(self, keep=None):
+        if self.backend.count() <= self.max_sessions and self.backend.total_size() <= self.max_bytes:
+            return
+        for user_id in self.backend.lru_order():
+            if user_id == keep:
+                continue
+            self._evict(user_id, "budget")
+            if self.backend.count() <= self.max_sessions and self.backend.total_size() <= self.max_bytes:
+                break
+
+    def _evict(self, user_id, reason):
+        self.backend.delete(user_id)
+        self.evicted[reason] += 1
+        if self.on_evict:
+            self.on_evict(user_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": self.backend.count(),
+                "bytes": self.backend.total_size(),
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "evicted_idle": self.evicted["idle"],
+                "evicted_budget": self.evicted["budget"],
+            }
+
+
+def create_session_store(on_evict=None):
+    # 根据环境变量选后端与上限。多个 worker（例如 gunicorn -w 4）要用 SESSION_BACKEND=sqlite 共用会话，
+    # 会话锁按 backend.lock_dir 跨进程；memory 后端各进程各一份，只适合单 worker
+    backend_name = os.getenv("SESSION_BACKEND", "memory").lower()
+    if backend_name == "sqlite":
+        backend = SQLiteBackend(os.getenv("SESSION_DB_PATH", "sessions.sqlite3"))
+    elif backend_name == "memory":
+        backend = MemoryBackend()
+    else:
+        raise ValueError(f"未知的 SESSION_BACKEND: {backend_name}")
+
+    return SessionStore(
+        backend,
+        idle_ttl=float(os.getenv("SESSION_IDLE_TTL", "3600")),
+        max_sessions=int(os.getenv("SESSION_MAX_SESSIONS", "10000")),
+        max_bytes=int(float(os.getenv("SESSION_MEMORY_BUDGET_MB", "256")) * 1024 * 1024),
+        max_history=int(os.getenv("SESSION_MAX_HISTORY", "200")),
+        on_evict=on_evict,
+    )
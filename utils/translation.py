@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from utils.instrumentation import timed
+
+
+TRANSLATE_PROMPT = "请将以下中文翻译为英文，不要输出任何其他内容。"
+BATCH_PROMPT = (
+    "请将 JSON 数组中的每一条中文分别翻译为英文，"
+    "只输出 JSON 对象 {\"translations\": [...]}，顺序和条数与输入完全一致。"
+)
+
+
+def text_key(text, model):
+    return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+
+class Translator:
+    """
+    中译英服务：按内容哈希缓存，进程内 LRU + SQLite 磁盘缓存，同一句话整个部署只翻译一次。
+    并发请求同一句话时只有一个线程真正调用模型，其余等待结果。
+    """
+
+    def __init__(self, client, model="moonshot-v1-8k", cache_path="Data/translation_cache.sqlite3",
+                 max_memory_items=4096):
+        self.client = client
+        self.model = model
+        self.cache_path = cache_path
+        self.max_memory_items = max_memory_items
+
+        self._memory = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "batch_calls": 0}
+
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+            conn = self._conn()
+            conn.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, source TEXT, target TEXT)")
+
+    # ========== 缓存 ==========
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.cache_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _lookup(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return self._memory[key]
+
+        if self.cache_path:
+            row = self._conn().execute("SELECT target FROM translations WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._remember(key, row[0])
+                with self._lock:
+                    self.counters["disk_hits"] += 1
+                return row[0]
+        return None
+
+    def _remember(self, key, target):
+        with self._lock:
+            self._memory[key] = target
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def _store(self, key, source, target):
+        self._remember(key, target)
+        if self.cache_path:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO translations (key, source, target) VALUES (?, ?, ?)",
+                (key, source, target),
+            )
+
+    # ========== 调用模型 ==========
+    def _call_one(self, text):
+        res = self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": TRANSLATE_PROMPT},
+                {"role": "user", "content": text}
+            ],
+            temperature=0.7,
+        )
+        return res.choices[0].message.content.strip()
+
+    def _call_batch(self, texts):
+        res = self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": BATCH_PROMPT},
+                {"role": "user", "content": json.dumps(texts, ensure_ascii=False)}
+            ],
+            temperature=0.7,
+            response_format={"type": "json_object"},
+        )
+        with self._lock:
+            self.counters["batch_calls"] += 1
+        try:
+            translations = json.loads(res.choices[0].message.content)["translations"]
+        except (json.JSONDecodeError, KeyError, TypeError):
+            translations = None
+        if not isinstance(translations, list) or len(translations) != len(texts):
+            # 批量结果对不上就逐条翻译
+            return [self._call_one(t) for t in texts]
+        return [str(t).strip() for t in translations]
+
+    # ========== 对外接口 ==========
+    def translate(self, text):
+        return self.translate_many([text])[0]
+
+    @timed("translation")
+    def translate_many(self, texts):
+        keys = [text_key(t, self.model) for t in texts]
+        results = {}
+        owned, waiting = {}, {}
+
+        for key, text in zip(keys, texts):
+            if key in results or key in owned or key in waiting:
+                continue
+            cached = self._lookup(key)
+            if cached is not None:
+                results[key] = cached
+                continue
+            with self._lock:
+                event = self._inflight.get(key)
+                if key in self._memory:
+                    # 查缓存到加锁之间被别的线程翻译好了
+                    results[key] = self._memory[key]
+                elif event is None:
+                    self._inflight[key] = threading.Event()
+                    owned[key] = text
+                    self.counters["misses"] += 1
+                else:
+                    waiting[key] = event
+
+        if owned:
+            try:
+                sources = list(owned.values())
+                targets = self._call_batch(sources) if len(sources) > 1 else [self._call_one(sources[0])]
+                for key, source, target in zip(owned, sources, targets):
+                    self._store(key, source, target)
+                    results[key] = target
+            finally:
+                with self._lock:
+                    for key in owned:
+                        self._inflight.pop(key).set()
+
+        for key, event in waiting.items():
+            event.wait()
+            cached = self._lookup(key)
+            if cached is None:
+                # 别的线程翻译失败了，就自己再翻一次
+                source = texts[keys.index(key)]
+                cached = self._call_one(source)
+                self._store(key, source, cached)
+            results[key] = cached
+
+        return [results[k] for k in keys]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_items"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
@@ -1,35 +1,389 @@
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from utils.preprocess import load_esconv    # 从你的预处理里复用函数
+from utils.preprocess import iter_esconv_pairs    # 从你的预处理里复用函数
+from utils.corpus import source_stamp
+from utils.embedding import get_embedding_service, as_float32
+import itertools
+import json
 import os
+import shutil
+import time
 
-def build_faiss_index():
-    # 加载问答对
-    file_path = os.path.join(os.path.dirname(__file__), "..", "Data", "ESConv.json")
-    pairs = load_esconv(file_path)
+DEFAULT_MODEL = "all-MiniLM-L6-v2"
+MULTILINGUAL_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+DEFAULT_INDEX_PATH = "Data/esconv_faiss.index"
+MULTILINGUAL_INDEX_PATH = "Data/esconv_faiss_multilingual.index"
 
-    # 准备模型和问题
-    model = SentenceTransformer("all-MiniLM-L6-v2")
-    questions = [q for q, a in pairs]
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+METRICS = ("cosine", "l2")
+
+# 调参时依次尝试的搜索宽度
+NPROBE_CANDIDATES = (1, 2, 4, 8, 16, 32, 64, 128)
+EF_SEARCH_CANDIDATES = (16, 32, 64, 128, 256, 512)
+
+# 流式构建：每块编码 / 写入的条数，IVF 每个聚类中心抽多少训练样本
+BUILD_CHUNK_SIZE = 1024
+TRAIN_POINTS_PER_LIST = 64
+
+
+# ========== 索引元数据（与索引文件放在一起）==========
+def meta_path(index_path):
+    return index_path + ".meta.json"
+
+
+def save_index_meta(index_path, meta):
+    with open(meta_path(index_path), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+
+def load_index_meta(index_path):
+    path = meta_path(index_path)
+    if not os.path.exists(path):
+        # 没有元数据的旧索引：IndexFlatL2 + 未归一化的 MiniLM 向量
+        return {"index_type": "flat", "metric": "l2", "normalize": False, "model": DEFAULT_MODEL}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ========== 构建 ==========
+def default_nlist(n):
+    # 经验值 4·√n，同时保证每个聚类中心至少有 39 个训练点
+    return int(max(1, min(4 * np.sqrt(n), n // 39)))
+
+
+def create_index(index_type, dimension, metric="cosine", nlist=None, pq_m=16, hnsw_m=32):
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == "cosine" else faiss.METRIC_L2
+    if index_type == "flat":
+        return faiss.IndexFlatIP(dimension) if metric == "cosine" else faiss.IndexFlatL2(dimension)
+    if index_type == "hnsw":
+        return faiss.IndexHNSWFlat(dimension, hnsw_m, faiss_metric)
+
+    quantizer = faiss.IndexFlatIP(dimension) if metric == "cosine" else faiss.IndexFlatL2(dimension)
+    if index_type == "ivf_flat":
+        return faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss_metric)
+    if index_type == "ivf_pq":
+        if dimension % pq_m:
+            raise ValueError(f"pq_m={pq_m} 必须整除向量维度 {dimension}")
+        return faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, 8, faiss_metric)
+    raise ValueError(f"未知的索引类型: {index_type}（可选 {', '.join(INDEX_TYPES)}）")
+
+
+def set_search_params(index, meta):
+    if meta.get("nprobe") and hasattr(index, "nprobe"):
+        index.nprobe = meta["nprobe"]
+    if meta.get("ef_search") and hasattr(index, "hnsw"):
+        index.hnsw.efSearch = meta["ef_search"]
+
+
+def iter_chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Progress:
+    """按条数统计进度和吞吐，每隔 every 秒打印一次。"""
+
+    def __init__(self, stage, total=None, done=0, every=5.0):
+        self.stage = stage
+        self.total = total
+        self.done = done
+        self.every = every
+        self._start_done = done
+        self._start = self._last = time.perf_counter()
+
+    def rate(self):
+        elapsed = time.perf_counter() - self._start
+        return (self.done - self._start_done) / elapsed if elapsed > 0 else 0.0
+
+    def update(self, n):
+        self.done += n
+        now = time.perf_counter()
+        if now - self._last >= self.every:
+            self._last = now
+            self._print()
+
+    def _print(self, prefix="⏳"):
+        total = f"/{self.total}" if self.total else ""
+        print(f"{prefix} {self.stage}：{self.done}{total} 条，{self.rate():.0f} 条/秒")
+
+    def finish(self):
+        self._print("✅")
+
+
+# ========== 编码断点：<index>.build/ 下按顺序追加已编码的向量 ==========
+def checkpoint_paths(index_path):
+    directory = index_path + ".build"
+    return directory, os.path.join(directory, "vectors.f32"), os.path.join(directory, "state.json")
+
+
+def open_checkpoint(index_path, key, restart=False):
+    """
+    返回上次中断时的状态（done 条已编码，complete 是否已编码完）。
+    key 记录来源文件、模型和度量，任何一项变了旧断点就作废。
+    """
+    directory, vectors_path, state_path = checkpoint_paths(index_path)
+    if not restart and os.path.exists(state_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("key") == key:
+            # 截掉最后一块写了向量但没来得及记进 state 的部分
+            with open(vectors_path, "r+b") as f:
+                f.truncate(state["done"] * 4 * key["dimension"])
+            return state
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    open(vectors_path, "wb").close()
+    state = {"key": key, "done": 0, "complete": False}
+    save_checkpoint(index_path, state)
+    return state
+
+
+def save_checkpoint(index_path, state):
+    _, _, state_path = checkpoint_paths(index_path)
+    with open(state_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def encode_questions(questions, model, index_path, state, normalize, chunk_size):
+    """分块编码并追加到断点文件，每块落盘后更新 state；已完成的部分直接跳过。"""
+    _, vectors_path, _ = checkpoint_paths(index_path)
+    if state["complete"]:
+        print(f"⏩ 沿用断点里已编码的 {state['done']} 条向量")
+        return state["done"]
+    if state["done"]:
+        print(f"⏩ 从第 {state['done']} 条继续编码")
+
+    progress = Progress("编码", done=state["done"])
+    with open(vectors_path, "ab") as f:
+        for chunk in iter_chunks(itertools.islice(questions, state["done"], None), chunk_size):
+            embeddings = as_float32(model.encode(chunk))
+            if normalize:
+                faiss.normalize_L2(embeddings)
+            f.write(embeddings.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+            state["done"] += len(chunk)
+            save_checkpoint(index_path, state)
+            progress.update(len(chunk))
+    state["complete"] = True
+    save_checkpoint(index_path, state)
+    progress.finish()
+    return state["done"]
+
+
+def training_sample(vectors, size, seed=0):
+    if len(vectors) <= size:
+        return np.ascontiguousarray(vectors[:])
+    rng = np.random.default_rng(seed)
+    ids = np.sort(rng.choice(len(vectors), size=size, replace=False))
+    return np.ascontiguousarray(vectors[ids])
+
+
+def build_faiss_index(model_name=DEFAULT_MODEL, index_path=DEFAULT_INDEX_PATH, index_type="flat",
+                      metric="cosine", nlist=None, pq_m=16, hnsw_m=32, target_recall=0.95, top_k=3,
+                      json_path=None, chunk_size=BUILD_CHUNK_SIZE, restart=False):
+    """
+    流式构建索引：逐个对话读取语料，按 chunk_size 分块编码并追加到磁盘上的断点文件，
+    再从 memmap 分块训练 / 写入索引。常驻内存只和块大小、训练样本数有关，与语料总量无关；
+    中途中断后重新运行会从断点继续，restart=True 则从头来。
+    """
+    json_path = json_path or os.path.join(os.path.dirname(__file__), "..", "Data", "ESConv.json")
+
+    # 准备模型（检索时用什么模型编码查询，建索引就必须用同一个）
+    model = get_embedding_service(model_name)
+    dimension = model.dimension
+    normalize = metric == "cosine"     # 余弦相似度 = 归一化后的内积
+    key = dict(source_stamp(json_path), model=model_name, metric=metric, dimension=dimension)
+    state = open_checkpoint(index_path, key, restart=restart)
 
     # 编码
-    embeddings = model.encode(questions, show_progress_bar=True)
+    questions = (p["question"] for p in iter_esconv_pairs(json_path))
+    count = encode_questions(questions, model, index_path, state, normalize, chunk_size)
+    if not count:
+        raise ValueError(f"{json_path} 里没有可用的问答对")
+    _, vectors_path, _ = checkpoint_paths(index_path)
+    vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(count, dimension))
+
+    # 构建索引（IVF 用抽样训练）
+    nlist = nlist or default_nlist(count)
+    index = create_index(index_type, dimension, metric, nlist=nlist, pq_m=pq_m, hnsw_m=hnsw_m)
+    if not index.is_trained:
+        train_size = max(nlist * TRAIN_POINTS_PER_LIST, 256 * 39 if index_type == "ivf_pq" else 0)
+        sample = training_sample(vectors, train_size)
+        print(f"🏋️ 训练 {index_type}（nlist={nlist}，样本 {len(sample)} 条）...")
+        index.train(sample)
+        del sample
+
+    progress = Progress("写入索引", total=count)
+    for start in range(0, count, chunk_size):
+        chunk = np.ascontiguousarray(vectors[start:start + chunk_size])
+        index.add(chunk)
+        progress.update(len(chunk))
+    progress.finish()
+
+    meta = {
+        "index_type": index_type,
+        "metric": metric,
+        "normalize": normalize,
+        "model": model_name,
+        "dimension": dimension,
+        "count": index.ntotal,
+    }
+    if index_type.startswith("ivf"):
+        meta["nlist"] = nlist
+    if index_type == "ivf_pq":
+        meta["pq_m"] = pq_m
+    if index_type == "hnsw":
+        meta["hnsw_m"] = hnsw_m
+
+    # 近似索引：用精确检索做基准，调到满足目标召回率的最小搜索宽度
+    if index_type != "flat":
+        report = tune_index(index, meta, vectors, top_k=top_k, target_recall=target_recall)
+        print_report(report)
+
+    # 保存索引；成功后断点就没用了
+    set_search_params(index, meta)
+    faiss.write_index(index, index_path)
+    save_index_meta(index_path, meta)
+    del vectors
+    shutil.rmtree(checkpoint_paths(index_path)[0], ignore_errors=True)
+    print(f"✅ FAISS 索引已构建并保存：{index_path}（{model_name}, {index_type}/{metric}，{count} 条）")
+
+    return index, meta
+
+
+# ========== 召回率 / 延迟评估 ==========
+def sample_queries(embeddings, n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(len(embeddings), size=min(n, len(embeddings)), replace=False)
+    return np.ascontiguousarray(embeddings[ids])
+
+
+def measure(index, queries, ground_truth, top_k):
+    # 逐条查询计时，贴近线上每次只查一条的情况
+    start = time.perf_counter()
+    results = np.vstack([index.search(queries[i:i + 1], top_k)[1] for i in range(len(queries))])
+    latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    hits = sum(len(set(r) & set(g)) for r, g in zip(results, ground_truth))
+    return hits / (len(queries) * top_k), latency_ms
 
-    # 构建索引
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(np.array(embeddings))
 
-    # 保存索引
-    faiss.write_index(index, "Data/esconv_faiss.index")
-    print("✅ FAISS 索引已构建并保存！")
+def exact_search(embeddings, queries, metric, top_k, chunk_size=65536):
+    """分块精确检索，embeddings 可以是 memmap，每次只有一块在内存里。"""
+    larger_is_better = metric == "cosine"
+    best_d = np.full((len(queries), top_k), -np.inf if larger_is_better else np.inf, dtype=np.float32)
+    best_i = np.full((len(queries), top_k), -1, dtype=np.int64)
+    for start in range(0, len(embeddings), chunk_size):
+        flat = create_index("flat", embeddings.shape[1], metric)
+        flat.add(np.ascontiguousarray(embeddings[start:start + chunk_size]))
+        D, I = flat.search(queries, top_k)
+        D = np.hstack([best_d, D])
+        I = np.hstack([best_i, np.where(I >= 0, I + start, -1)])
+        order = np.argsort(-D if larger_is_better else D, axis=1, kind="stable")[:, :top_k]
+        best_d = np.take_along_axis(D, order, axis=1)
+        best_i = np.take_along_axis(I, order, axis=1)
+    return best_d, best_i
+
+
+def tune_index(index, meta, embeddings, top_k=3, target_recall=0.95, n_queries=500):
+    """
+    把各档搜索宽度与精确检索对比，返回报告，并把选中的参数写进 meta。
+    基准一行的延迟是分块批量精确检索的平均值，只作量级参考。
+    """
+    queries = sample_queries(embeddings, n_queries)
+    start = time.perf_counter()
+    _, ground_truth = exact_search(embeddings, queries, meta["metric"], top_k)
+    flat_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    report = [{"setting": "flat (基准)", "recall": 1.0, "latency_ms": flat_ms}]
+
+    if meta["index_type"] == "hnsw":
+        param, candidates = "ef_search", EF_SEARCH_CANDIDATES
+    else:
+        param, candidates = "nprobe", [c for c in NPROBE_CANDIDATES if c <= meta["nlist"]]
+
+    chosen = None
+    for value in candidates:
+        set_search_params(index, {param: value})
+        recall, ms = measure(index, queries, ground_truth, top_k)
+        report.append({"setting": f"{param}={value}", "recall": recall, "latency_ms": ms})
+        if chosen is None and recall >= target_recall:
+            chosen = value
+    meta[param] = chosen or candidates[-1]
+    meta["tuned_recall_target"] = target_recall
+    return report
+
+
+def print_report(report):
+    print(f"{'设置':<16}{'recall@k':>10}{'毫秒/查询':>12}")
+    for row in report:
+        print(f"{row['setting']:<16}{row['recall']:>10.4f}{row['latency_ms']:>12.3f}")
+
+
+def benchmark_index(index_path, top_k=3, n_queries=500):
+    # 对已保存的索引重新出一份召回率-延迟报告；向量从索引里还原（PQ 还原的是量化后的近似向量）
+    index, meta = load_index(index_path)
+    if hasattr(index, "make_direct_map"):
+        index.make_direct_map()
+    embeddings = index.reconstruct_n(0, index.ntotal)
+    report = tune_index(index, dict(meta), embeddings, top_k=top_k,
+                        target_recall=meta.get("tuned_recall_target", 0.95), n_queries=n_queries)
+    print_report(report)
+    return report
+
+
+# ========== 运行时加载与检索 ==========
+def load_index(index_path):
+    index = faiss.read_index(index_path)
+    meta = load_index_meta(index_path)
+    set_search_params(index, meta)
+    return index, meta
+
+
+def search_index(index, meta, query_vectors, top_k):
+    query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+    if meta.get("normalize"):
+        query_vectors = query_vectors.copy()
+        faiss.normalize_L2(query_vectors)
+    return index.search(query_vectors, top_k)
 
-    return index, pairs, model
 
 def encode_text(text, model):
+    # model 可以是 SentenceTransformer，也可以是共享的 EmbeddingService
     embedding = model.encode([text])
-    return embedding.astype("float32")
+    return np.ascontiguousarray(embedding, dtype=np.float32)
 
 if __name__ == "__main__":
-    build_faiss_index()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="构建 ESConv 检索索引")
+    parser.add_argument("--multilingual", action="store_true",
+                        help="用多语言编码器建索引，检索时可直接用中文查询，不用先翻译")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat")
+    parser.add_argument("--metric", choices=METRICS, default="cosine")
+    parser.add_argument("--nlist", type=int, default=None, help="IVF 聚类数，默认按语料量估算")
+    parser.add_argument("--pq-m", type=int, default=16, help="IVF-PQ 子向量个数，需整除向量维度")
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--benchmark", action="store_true", help="不重建，只对已有索引出召回率-延迟报告")
+    parser.add_argument("--source", default=None, help="语料 JSON，默认 Data/ESConv.json")
+    parser.add_argument("--chunk-size", type=int, default=BUILD_CHUNK_SIZE)
+    parser.add_argument("--restart", action="store_true", help="丢弃上次中断留下的断点，从头编码")
+    args = parser.parse_args()
+
+    model_name = MULTILINGUAL_MODEL if args.multilingual else DEFAULT_MODEL
+    index_path = MULTILINGUAL_INDEX_PATH if args.multilingual else DEFAULT_INDEX_PATH
+
+    if args.benchmark:
+        benchmark_index(index_path)
+    else:
+        build_faiss_index(model_name, index_path, index_type=args.index_type, metric=args.metric,
+                          nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m,
+                          target_recall=args.target_recall, json_path=args.source,
+                          chunk_size=args.chunk_size, restart=args.restart)